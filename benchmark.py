@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Benchmarks update cycles against a local mock DreamHost API.
+
+Each run starts a mock_dreamhost server (in its own process, so it doesn't
+count towards our memory use) with an account of the given size, builds a
+dhfleet for the given number of hostnames, and runs update cycles. By
+default the addresses change every cycle, so every hostname's records are
+replaced; --steady keeps them the same, to measure an idle cycle. Every
+changed hostname's records are listed each cycle, as they are when a full
+reconcile is due; --cached uses the records cached by the previous cycle
+instead, as the dæmon does in between. With
+--provider memory, the cycles run against dhprovider.memory, holding the
+same records, instead of the mock server: only planning and applying the
+changes is measured, without any network.
+
+    ./benchmark.py --hosts 1,100,1000 --records 10,10000,100000
+
+Reports cycles per second, API calls per cycle, p50/p99 cycle and API
+request latency (provider call latency, with --provider memory), and peak
+RSS.
+
+--startup instead times one-shot invocations of dhdynupdate.py, as run from
+cron or a DHCP/PPP hook:
+
+    ./benchmark.py --startup 20
+"""
+
+import argparse
+import ipaddress
+import itertools
+import multiprocessing
+import os
+import queue
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import dhexec
+from dhfleet import dhfleet
+import dhprovider
+import http_access
+import mock_dreamhost
+
+def percentile(values, fraction):
+    """The value at fraction (0-1) of the sorted values"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def serve(account_size, latency, error_rate, url_queue):
+    """Run a mock DreamHost server; its URL is put on url_queue"""
+    server = mock_dreamhost.mock_dreamhost(
+                 account=mock_dreamhost.mock_account(account_size),
+                 latency=latency, error_rate=error_rate)
+    url_queue.put(server.api_url)
+    server.serve_forever()
+
+def cycle_addresses(cycle, steady):
+    """The addresses to publish in a cycle"""
+    if steady:
+        cycle = 0
+    return [ipaddress.ip_address("192.0.2.%d" % (cycle % 250 + 1)),
+            ipaddress.ip_address("2001:db8:1::%x" % (cycle + 1))]
+
+def timed(function, latencies):
+    """function, appending the time each call takes to latencies"""
+    def timed_function(*function_args, **function_kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*function_args, **function_kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return timed_function
+
+def run(hosts, records, args, results):
+    """Benchmark one configuration; the results (or the traceback, as
+    "error") are put on results"""
+    try:
+        run_configuration(hosts, records, args, results)
+    except Exception:
+        results.put({"error": traceback.format_exc()})
+
+def run_configuration(hosts, records, args, results):
+    server = None
+    if args.provider == "dreamhost":
+        url_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, daemon=True,
+                                         args=(records, args.latency,
+                                               args.error_rate, url_queue))
+        server.start()
+    try:
+        host_configs = [("key%d" % (index % args.keys),
+                         "bench%d.example.com" % (index))
+                        for index in range(hosts)]
+        api_latencies = []
+        if server is not None:
+            api_url = url_queue.get(timeout=60)
+            fleet = dhfleet(api_url, host_configs, {},
+                            max_concurrency=args.concurrency)
+            # Time every API request
+            fleet.dreamhost_accessor.request_get = timed(
+                fleet.dreamhost_accessor.request_get, api_latencies)
+            stats = http_access.http_access(api_url)
+        else:
+            provider = dhprovider.memory(
+                           records=mock_dreamhost.mock_account(records).records.values())
+            fleet = dhfleet("", host_configs, {}, max_concurrency=args.concurrency,
+                            provider=provider)
+            # Time every provider call
+            for name in ("list_records", "add_record", "remove_record", "replace"):
+                setattr(provider, name, timed(getattr(provider, name), api_latencies))
+
+        # The first cycle publishes everything; don't count it.
+        fleet.update_if_necessary(cycle_addresses(0, args.steady))
+        if server is not None:
+            stats.request_get({"cmd": "mock-reset", "key": "bench"})
+        api_latencies.clear()
+
+        cycle_latencies = []
+        start = time.perf_counter()
+        for cycle in range(1, args.cycles + 1):
+            if not args.cached:
+                # Make every changed hostname list its records
+                for host in fleet.hosts:
+                    host.records = None
+            cycle_start = time.perf_counter()
+            fleet.update_if_necessary(cycle_addresses(cycle, args.steady))
+            cycle_latencies.append(time.perf_counter() - cycle_start)
+        elapsed = time.perf_counter() - start
+
+        if server is not None:
+            calls = stats.request_get({"cmd": "mock-stats", "key": "bench"})["data"]
+            api_calls = sum(count for cmd, count in calls.items()
+                            if not cmd.startswith("mock-"))
+        else:
+            api_calls = len(api_latencies)
+        fleet.executor.shutdown()
+        results.put({
+            "hosts": hosts,
+            "records": records,
+            "cycles_per_second": args.cycles / elapsed,
+            "api_calls_per_cycle": api_calls / args.cycles,
+            "cycle_p50": percentile(cycle_latencies, 0.50),
+            "cycle_p99": percentile(cycle_latencies, 0.99),
+            "api_p50": percentile(api_latencies, 0.50),
+            "api_p99": percentile(api_latencies, 0.99),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+    finally:
+        if server is not None:
+            server.terminate()
+
+STARTUP_CONFIG = """[Global]
+api_url = %(api_url)s
+AF_INET = lo
+AF_INET6 = lo
+log_file = %(directory)s/dhdynupdate.log
+update_interval = 3600
+pidfile = %(directory)s/dhdynupdate.pid
+state_file = %(directory)s/state.json
+
+[bench]
+api_key = bench
+local_hostname = bench.example.com
+"""
+
+def startup(args):
+    """Time one-shot invocations of dhdynupdate.py"""
+    url_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, daemon=True,
+                                     args=(args.records_startup, args.latency,
+                                           0.0, url_queue))
+    server.start()
+    try:
+        api_url = url_queue.get(timeout=60)
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = os.path.join(directory, "dhdynupdate.conf")
+            with open(config_path, "w") as config_file:
+                config_file.write(STARTUP_CONFIG % {"api_url": api_url,
+                                                    "directory": directory})
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "dhdynupdate.py")
+            base = [sys.executable, script, "-f", config_path]
+            commands = [
+                ("python -c pass", [sys.executable, "-c", "pass"]),
+                ("--help", [sys.executable, script, "--help"]),
+                ("-m (monitor, one-shot)", base + ["-m"]),
+                ("-c (one-shot update)", base + ["-c", "bench"]),
+                ("--address (hook)", base + ["-c", "bench",
+                                             "--address", "192.0.2.1",
+                                             "--address", "2001:db8::1"]),
+            ]
+            print("%-24s %10s %10s" % ("invocation", "p50", "p90"))
+            for name, command in commands:
+                times = []
+                for run_number in range(args.startup):
+                    start = time.perf_counter()
+                    subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+                    times.append(time.perf_counter() - start)
+                print("%-24s %8.1fms %8.1fms" % (name,
+                                                 statistics.median(times) * 1000,
+                                                 percentile(times, 0.90) * 1000),
+                      flush=True)
+    finally:
+        server.terminate()
+
+def main(argv=None):
+    cmd_parser = argparse.ArgumentParser(description="Benchmark dhdynupdate update cycles")
+    cmd_parser.add_argument("--hosts", default="1,10,100",
+                            help="Comma separated numbers of hostnames to benchmark")
+    cmd_parser.add_argument("--records", default="10,1000,10000",
+                            help="Comma separated numbers of filler records in the account")
+    cmd_parser.add_argument("--keys", type=int, default=1,
+                            help="Number of distinct api_keys the hostnames are spread over")
+    cmd_parser.add_argument("--cycles", type=int, default=10,
+                            help="Number of update cycles to time")
+    cmd_parser.add_argument("--latency", type=float, default=0.0,
+                            help="Mean added latency per API request, in seconds")
+    cmd_parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="Fraction of API requests that fail")
+    cmd_parser.add_argument("--concurrency", type=int,
+                            default=dhexec.DEFAULT_CONCURRENCY,
+                            help="max_concurrency for API requests")
+    cmd_parser.add_argument("--provider", choices=("dreamhost", "memory"),
+                            default="dreamhost",
+                            help="Run against the mock DreamHost server, or the in-memory provider")
+    cmd_parser.add_argument("--cached", action="store_true", default=False,
+                            help="Use the records cached by the previous cycle, instead of listing them")
+    cmd_parser.add_argument("--steady", action="store_true", default=False,
+                            help="Don't change the addresses between cycles")
+    cmd_parser.add_argument("--startup", type=int, default=0, metavar="runs",
+                            help="Time runs one-shot invocations of dhdynupdate.py instead")
+    cmd_parser.add_argument("--records-startup", type=int, default=1000,
+                            help="Number of filler records in the account for --startup")
+    args = cmd_parser.parse_args(argv)
+
+    if args.startup:
+        startup(args)
+        return
+
+    print("%7s %7s %10s %10s %10s %10s %10s %10s %9s"
+          % ("hosts", "records", "cycles/s", "calls/cyc", "cyc p50",
+             "cyc p99", "api p50", "api p99", "RSS MB"))
+    for hosts, records in itertools.product(
+            [int(value) for value in args.hosts.split(",")],
+            [int(value) for value in args.records.split(",")]):
+        # Each configuration runs in a fresh process, so peak RSS is its own.
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run,
+                                          args=(hosts, records, args, results))
+        process.start()
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    result = {"error": "exited with status %s" % (process.exitcode)}
+                    break
+        process.join()
+        if "error" in result:
+            print("%d hosts, %d records failed: %s" % (hosts, records, result["error"]),
+                  file=sys.stderr)
+            sys.exit(1)
+        print("%7d %7d %10.2f %10.1f %9.1fms %9.1fms %9.2fms %9.2fms %9.1f"
+              % (result["hosts"], result["records"],
+                 result["cycles_per_second"], result["api_calls_per_cycle"],
+                 result["cycle_p50"] * 1000, result["cycle_p99"] * 1000,
+                 result["api_p50"] * 1000, result["api_p99"] * 1000,
+                 result["peak_rss_mb"]), flush=True)
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 et
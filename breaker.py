@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""
+Circuit breakers for the DreamHost API.
+
+While DreamHost is down, every request would wait out its timeouts and
+retries, holding up the whole update. Instead, after threshold requests in
+a row have failed, the endpoint's breaker opens, and requests fail
+straight away. Once reset_timeout seconds have passed, one request is let
+through as a probe (half-open): if it succeeds the breaker closes, and if
+it fails the breaker opens again for another reset_timeout.
+
+Each request counts once, after its retries, and only if it failed the
+way an unavailable server does (see http_access). There's one breaker
+per API URL, shared by every http_access object and thread in the
+process.
+"""
+
+import logging
+import metrics
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+# For the dhdynupdate_api_circuit_state metric
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+# One breaker per endpoint
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+class circuit_breaker():
+
+    def __init__(self, endpoint, threshold, reset_timeout):
+        """Opens after threshold failures in a row (0 never opens), and
+        probes again after reset_timeout seconds"""
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+        metrics.api_circuit_state.set(endpoint, value=STATE_VALUES[CLOSED])
+
+    def set_state(self, state):
+        if state != self.state:
+            logging.warning("Circuit breaker for %s is now %s", self.endpoint, state)
+            self.state = state
+            metrics.api_circuit_state.set(self.endpoint, value=STATE_VALUES[state])
+
+    def allow(self):
+        """May a request be sent? While half-open, only the probe may."""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and \
+               time.monotonic() - self.opened >= self.reset_timeout:
+                self.set_state(HALF_OPEN)
+                return True
+            return False
+
+    def is_open(self):
+        with self.lock:
+            return self.state == OPEN
+
+    def remaining(self):
+        """Seconds until the next probe, while open"""
+        with self.lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.opened + self.reset_timeout - time.monotonic())
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.set_state(CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or \
+               (self.threshold and self.failures >= self.threshold):
+                self.opened = time.monotonic()
+                self.set_state(OPEN)
+
+    def release(self):
+        """A request ended without telling us whether DreamHost is up (ie.
+        it was interrupted); if it was the probe, let another through"""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                # opened is left alone, so the next allow() probes again
+                self.set_state(OPEN)
+
+def get_breaker(endpoint, threshold, reset_timeout):
+    """The shared breaker for endpoint, with its settings updated"""
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = circuit_breaker(endpoint, threshold,
+                                                            reset_timeout)
+        breaker.threshold = threshold
+        breaker.reset_timeout = reset_timeout
+        return breaker
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Central aggregator: many agents report their addresses, one process talks
+to DreamHost.
+
+An agent (dhdynupdate --agent) reads its interfaces like a one-shot run,
+sends a report for each of its hostnames, and exits. A report is a small
+JSON object:
+
+    {"hostname": "host.example.com", "addresses": ["192.0.2.1", "2001:db8::1"],
+     "token": "<aggregator_token, if one is configured>"}
+
+sent either as the body of an HTTP POST to /report, or as a single UDP
+datagram. The aggregator (dhdynupdate --aggregator) keeps the latest report
+for each configured hostname, and once per interval publishes them all
+together through dhfleet, so each api_key is listed once per interval no
+matter how many agents use it. A hostname's latest report stands until the
+agent reports again.
+"""
+
+import hmac
+import ipaddress
+import json
+import logging
+import socket
+import socketserver
+import threading
+import urllib.parse
+
+DEFAULT_PORT = 8053
+REPORT_PATH = "/report"
+# Reports are tiny; anything bigger isn't one
+MAX_REPORT_SIZE = 8192
+
+def encode_report(hostname, addresses, token=""):
+    """The wire form of a report"""
+    report = {"hostname": hostname,
+              "addresses": [str(address) for address in addresses]}
+    if token:
+        report["token"] = token
+    return json.dumps(report).encode("utf-8")
+
+def parse_report(data, token=""):
+    """Decode a report; returns (hostname, list of ipaddress objects).
+    Raises ValueError if it's malformed, or token is set and doesn't
+    match."""
+    try:
+        report = json.loads(data.decode("utf-8"))
+        if token and not hmac.compare_digest(str(report.get("token", "")), token):
+            raise ValueError("Report has the wrong token")
+        hostname = report["hostname"]
+        if not isinstance(hostname, str) or not isinstance(report["addresses"], list) or \
+           not all(isinstance(address, str) for address in report["addresses"]):
+            raise ValueError("Malformed report")
+        addresses = [ipaddress.ip_address(address) for address in report["addresses"]]
+    except (UnicodeDecodeError, AttributeError, KeyError, TypeError) as error:
+        raise ValueError("Malformed report: %s" % (error))
+    return hostname, addresses
+
+def send_report(url, hostname, addresses, token="", timeout=5):
+    """Send a report to the aggregator at url: http://host:port/report, or
+    udp://host:port. Raises OSError if it couldn't be delivered (UDP
+    reports aren't acknowledged)."""
+    data = encode_report(hostname, addresses, token)
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme == "udp":
+        family = socket.AF_INET6 if ":" in parsed.hostname else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.sendto(data, (parsed.hostname, parsed.port or DEFAULT_PORT))
+        return
+    if parsed.scheme not in ("http", "https"):
+        raise ValueError("Unsupported aggregator URL %s" % (url))
+    # urllib is much quicker to import than requests, and agents exit
+    # straight away.
+    from urllib import request as url_request
+    request = url_request.Request(url, data=data, method="POST",
+                                  headers={"Content-Type": "application/json"})
+    with url_request.urlopen(request, timeout=timeout) as response:
+        response.read()
+
+class report_store():
+
+    def __init__(self, hostnames, token=""):
+        """Keeps the latest report for each of hostnames; reports for other
+        hostnames, or without token (if it's set), are refused."""
+        self.hostnames = set(hostnames)
+        self.token = token
+        self.reports = {}
+        self.lock = threading.Lock()
+
+    def add(self, data):
+        """Store a report in its wire form. Returns True if it was
+        accepted."""
+        try:
+            hostname, addresses = parse_report(data, self.token)
+        except ValueError as error:
+            logging.warning("Refusing report: %s", error)
+            return False
+        if hostname not in self.hostnames:
+            logging.warning("Refusing report for unconfigured hostname %s", hostname)
+            return False
+        logging.debug("Report for %s: %s", hostname, addresses)
+        with self.lock:
+            self.reports[hostname] = addresses
+        return True
+
+    def latest(self):
+        """The latest report of each hostname that has reported, as a dict
+        of hostname: addresses"""
+        with self.lock:
+            return dict(self.reports)
+
+class aggregator():
+
+    def __init__(self, store, address="127.0.0.1", port=DEFAULT_PORT):
+        """Receive reports for store (a report_store) on address:port, over
+        both HTTP and UDP; port 0 picks a free port (the same one for
+        both, where possible)."""
+        # Only imported by the aggregator
+        import http.server
+
+        class _report_handler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if self.path.split("?")[0] != REPORT_PATH:
+                    self.send_error(404)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", ""))
+                except ValueError:
+                    self.send_error(411)
+                    return
+                if length > MAX_REPORT_SIZE:
+                    self.send_error(413)
+                    return
+                if self.server.store.add(self.rfile.read(length)):
+                    self.send_response(204)
+                else:
+                    self.send_response(400)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        class _datagram_handler(socketserver.BaseRequestHandler):
+
+            def handle(self):
+                self.server.store.add(self.request[0])
+
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+
+        class _http_server(http.server.ThreadingHTTPServer):
+            address_family = family
+            daemon_threads = True
+
+        class _udp_server(socketserver.UDPServer):
+            address_family = family
+
+        self.http_server = _http_server((address, port), _report_handler)
+        self.http_server.store = store
+        self.udp_server = _udp_server((address, self.http_server.server_address[1]),
+                                      _datagram_handler)
+        self.udp_server.store = store
+        self.store = store
+
+    def netloc(self):
+        host, port = self.http_server.server_address[:2]
+        if ":" in host:
+            host = "[%s]" % (host)
+        return "%s:%d" % (host, port)
+
+    @property
+    def url(self):
+        """The HTTP URL agents report to"""
+        return "http://%s%s" % (self.netloc(), REPORT_PATH)
+
+    @property
+    def udp_url(self):
+        """The UDP URL agents report to"""
+        return "udp://%s" % (self.netloc())
+
+    def start(self):
+        """Serve from background threads"""
+        for name, server in (("aggregator-http", self.http_server),
+                             ("aggregator-udp", self.udp_server)):
+            threading.Thread(target=server.serve_forever, daemon=True,
+                             name=name).start()
+        logging.info("Receiving reports on %s and %s", self.url, self.udp_url)
+
+    def close(self):
+        for server in (self.http_server, self.udp_server):
+            server.shutdown()
+            server.server_close()
+
+# vim: ts=4 sw=4 et
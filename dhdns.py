@@ -28,201 +28,275 @@
 # those of the authors and should not be interpreted as representing official
 # policies, either expressed or implied.
 
-"""DreamHost DNS Accessor Object"""
+"""DNS Accessor Object; the records are kept by a dhprovider (DreamHost, by
+default)"""
 
 import copy
 import ipaddress
 import logging
-import os
-import sys
+import time
 
+import dhplan
+import dhprovider
 import http_access
 import interfaces
+import metrics
 
 class dhdns():
     api_key = ""
     local_hostname = ""
 
-    def __init__(self, api_key, api_url, local_hostname, configured_interfaces):
-        """Initialize dnsupdate"""
+    def __init__(self, api_key, api_url, local_hostname, configured_interfaces,
+                 interface=None, dreamhost_accessor=None, state=None,
+                 reconcile_interval=0, debounce_interval=0, verifier=None,
+                 history=None, provider=None):
+        """Initialize dnsupdate
+
+        interface and dreamhost_accessor may be shared between several dhdns
+        objects (see dhfleet); if they aren't provided, they're created.
+        provider (a dhprovider) keeps the records; by default, DreamHost
+        through dreamhost_accessor.
+
+        state is a dhstate object; if it has an entry for local_hostname, the
+        previously published addresses and DreamHost records are restored.
+        reconcile_interval is how often (in seconds) to list the DreamHost
+        records even if nothing changed; 0 disables. A changed address must
+        be stable for debounce_interval seconds before it's published.
+        verifier (a dhverify.verifier) checks that updates reach the
+        nameservers. Address changes and the operations sent are appended
+        to history (a dhhistory), if given."""
         # Pull configuration from config_settings
         self.api_key = api_key
         self.local_hostname = local_hostname
         self.configured_interfaces = configured_interfaces
-        self.interface = interfaces.interfaces(self.configured_interfaces)
+        if interface is None:
+            interface = interfaces.interfaces(self.configured_interfaces)
+        self.interface = interface
+        # Our own copy of the addresses; read-only DreamHost records remove
+        # entries from it, which mustn't affect other hostnames.
+        self.addresses = copy.copy(self.interface.addresses)
         self.prev_addresses = [ ipaddress.ip_address('127.0.0.1'), ipaddress.ip_address('::1') ]
-        # Set up http_accessor object.
-        try:
-            self.dreamhost_accessor = http_access.http_access(api_url)
-        except KeyError as error:
-            logging.critical("Could not set up DreamHost API communications. Error:  %s" % (error))
+        # DreamHost records for local_hostname as of the last update, and
+        # when they were last listed from DreamHost.
+        self.records = None
+        self.last_reconcile = None
+        self.reconcile_interval = reconcile_interval
+        self.state = state
+        # A change waiting out the debounce interval, and when it was seen
+        self.debounce_interval = debounce_interval
+        self.verifier = verifier
+        self.history = history
+        self.pending_addresses = None
+        self.pending_since = None
+        # The interface generation last found to match prev_addresses
+        self.checked_generation = None
+        # A dhsched.task deciding when to reconcile, instead of
+        # reconcile_interval (see dhfleet)
+        self.schedule = None
+        if state is not None:
+            host_state = state.get(local_hostname)
+            if host_state is not None:
+                logging.info("Restoring state for %s", local_hostname)
+                self.prev_addresses = [ipaddress.ip_address(address)
+                                       for address in host_state["addresses"]]
+                self.records = host_state["records"]
+                self.last_reconcile = host_state["last_reconcile"]
+        if provider is None:
+            # Set up http_accessor object.
+            if dreamhost_accessor is None:
+                try:
+                    dreamhost_accessor = http_access.http_access(api_url)
+                except KeyError as error:
+                    logging.critical("Could not set up DreamHost API communications. Error:  %s", error)
+            provider = dhprovider.dreamhost(dreamhost_accessor)
+        self.provider = provider
 
-    def update_if_necessary(self):
+    def update_if_necessary(self, addresses=None, dns_records=None):
         """Main dæmon loop - watches for changes to IP addresses on the host
         system, and if any are detected, an update of DreamHost is
-        triggered."""
-        # We really only want to update_addresses() if one or more of our
-        # IP addresses have changed.
-        update_ipv6 = True
-        update_ipv4 = True
-        logging.debug("Self.interface is:  %s" % (self.interface.addresses))
-        self.interface.addresses = self.interface.get_if_addresses(self.configured_interfaces)
-        for naddress in self.interface.addresses:
-            logging.debug("New address:  %s" % (naddress))
-            for paddress in self.prev_addresses:
-                logging.debug("Previous address:  %s" % (paddress))
-                if naddress == paddress:
-                    logging.debug("New %s = Old %s" % (naddress, paddress))
-                    if naddress.version == 6:
-                        update_ipv6 = False
-                    elif naddress.version == 4:
-                        update_ipv4 = False
-                    else:
-                        logging.warn("Error in address version retrieved:  %s" %
-                                    (naddress.version))
-                elif naddress.version == paddress.version:
-                    logging.debug("New %s != Old %s" % (naddress, paddress))
-                else:
-                    # Really not a very interesting metric, even on debug...
-                    # logging.debug("Address types do not match: New %s != Old %s" % (naddress, paddress))
-                    pass
-
-        # If we have detected a changed IP address, update_addresses(), and
-        # update the prev_addresses
-        if update_ipv6 or update_ipv4:
-            logging.debug("Resetting prev addresses: %s = %s" % (self.prev_addresses, self.interface.addresses))
-            self.prev_addresses = copy.copy(self.interface.addresses)
-            logging.info("Address change detected; updating DreamHost")
-            self.update_addresses()
-
-    def get_dh_dns_records(self):
-        """Get the current DreamHost DNS records"""
-        # Start by setting up a bit of data for the requests library.
-        request_params = {"key":self.api_key, "cmd":"dns-list_records", "format":"json"}
-        logging.info("Connecting to DreamHost API to obtain current DNS records")
-        dns_records = self.dreamhost_accessor.request_get(request_params)
-        dns_records = dns_records["data"]
-
-        # Get the current DNS records for our configured hostname
-        target_records=[]
-        for entry in dns_records:
-            # Only operate on editable entries...
-            if entry["editable"] == "1":
-                if "record" in entry:
-                    # Verify if our entry has the hostname we're looking for.
-                    # Multiple entries may, if we're using native dual-stack IPv4 &
-                    # IPv6.
-                    if entry["record"] == self.local_hostname:
-                        # Ignore CNAME,NS,PTR,NAPTR,SRV, and TXT records
-                        if entry['type'] not in ["CNAME","NS","PTR","NAPTR","SRV","TXT"]:
-                            logging.debug("Editable value:  %s" % entry)
-                            target_records.append(entry)
-                        else:
-                            logging.info("Ignoring %s.%s record" % (entry["record"], entry["type"]))
-            else: # read-only entry
-                logging.debug("Non-editable value:  %s" % entry)
-                if "record" in entry:
-                    if entry["record"] == self.local_hostname:
-                        # prevent a read-only record from being "added"
-                        dh_addr = ipaddress.ip_address(entry["value"])
-                        readonly_index = []
-                        for addr in self.interface.addresses:
-                            if addr.version == dh_addr.version:
-                                logging.info("Not operating on %s, as it's read-only" % (entry["record"]))
-                                readonly_index.append(self.interface.addresses.index(addr))
-                        for index in readonly_index:
-                            del self.interface.addresses[index]
-        return target_records
-
-    def remove_old_records(self, entry, matching_index):
-        """Determine if the IP address at DreamHost is out of date vs the ip
-        addresses determined by get_if_address(). If a local IP address isn't
-        found for an interface, than the corresponding entry in DNS will be
-        removed"""
-        dh_addr = ipaddress.ip_address(entry["value"])
-        for addr in self.interface.addresses:
-            logging.debug(entry)
-            logging.debug("dh_addr: %s - %s" % (dh_addr, dh_addr.version))
-            logging.debug("addr: %s - %s" % (addr, addr.version))
-            if addr.version == dh_addr.version:
-                if addr == dh_addr:
-                    logging.info("DreamHost DNS entry matches our address:  %s"
-                                 % (addr))
-                    matching_index.append(self.interface.addresses.index(addr))
-                else:
-                    logging.info("DreamHost DNS entry %s does not match our address:  %s"
-                                 % (dh_addr, addr))
-                    self.remove_record(entry)
+        triggered.
+
+        addresses and dns_records may be provided by the caller when they
+        have already been retrieved (ie. by dhfleet)."""
+        generation = None
+        if addresses is None:
+            self.interface.addresses = self.interface.get_if_addresses(self.configured_interfaces)
+            generation = self.interface.generation
+            if self.unchanged(generation):
+                return
+            addresses = self.interface.addresses
+        if self.address_changed(addresses, generation) or self.reconcile_due():
+            logging.info("Updating DreamHost for %s", self.local_hostname)
+            self.update_addresses(dns_records)
+            if self.state is not None:
+                self.state.save()
+
+    def reconcile_due(self):
+        """Is it time to list the DreamHost records, even though our addresses
+        haven't changed?"""
+        if self.last_reconcile is None:
+            return True
+        if self.schedule is not None:
+            return self.schedule.due()
+        return (self.reconcile_interval > 0 and
+                time.time() - self.last_reconcile >= self.reconcile_interval)
+
+    def needs_listing(self):
+        """Does the next update need a dns-list_records, or can it use the
+        records cached from the last update?"""
+        return self.records is None or self.reconcile_due()
+
+    def unchanged(self, generation):
+        """Can an update be skipped without even comparing addresses? True
+        if the interfaces are still at the generation that last matched our
+        published addresses, and no reconcile is due."""
+        return (generation is not None and
+                generation == self.checked_generation and
+                not self.reconcile_due())
+
+    def address_changed(self, addresses, generation=None):
+        """Compare addresses with the previously published addresses; returns
+        True if they differ, and have been stable for debounce_interval.
+        prev_addresses is updated once the new addresses have been
+        published.
+
+        generation is the interface generation addresses were read at, if
+        they were read from the interfaces."""
+        self.addresses = copy.copy(addresses)
+        if set(addresses) == set(self.prev_addresses):
+            if self.pending_addresses is not None:
+                logging.info("Addresses for %s changed back to %s; not updating",
+                             self.local_hostname, addresses)
+            self.pending_addresses = None
+            self.checked_generation = generation
+            return False
+        self.checked_generation = None
+
+        now = time.monotonic()
+        if self.pending_addresses is None or \
+           set(addresses) != set(self.pending_addresses):
+            # A new change; (re)start the debounce interval. If the address
+            # flaps, only the final one is published.
+            metrics.address_changes.inc()
+            logging.info("Address change detected for %s: %s -> %s",
+                         self.local_hostname, self.prev_addresses, addresses)
+            if self.history is not None:
+                self.history.address_changed(self.local_hostname,
+                                             self.prev_addresses, addresses)
+            self.pending_addresses = copy.copy(addresses)
+            self.pending_since = now
+        # Nothing has been published yet (or the last update failed); don't
+        # wait.
+        if self.last_reconcile is None:
+            return True
+        if now - self.pending_since < self.debounce_interval:
+            logging.info("Waiting %.0fs for the addresses of %s to settle",
+                         self.debounce_remaining(), self.local_hostname)
+            return False
+        return True
+
+    def debounce_remaining(self):
+        """Seconds until a pending change is published, or None if there's
+        no pending change"""
+        if self.pending_addresses is None:
+            return None
+        return max(0.0, self.pending_since + self.debounce_interval - time.monotonic())
+
+    def list_dh_dns_records(self, hostnames=None):
+        """Get the A and AAAA DNS records for hostnames (by default, just our
+        hostname) from the provider, indexed by dhplan.index_records()."""
+        if hostnames is None:
+            hostnames = [self.local_hostname]
+        return dhplan.index_records(self.provider.list_records(self.api_key, hostnames))
+
+    def plan_update(self, dns_records=None):
+        """Plan the changes needed to publish self.addresses. dns_records is
+        an index from list_dh_dns_records() or dhplan.index_records(); without
+        it, the records cached from our last update are used if they're still
+        fresh, and otherwise they're listed from DreamHost."""
+        self.reconciled = True
+        if dns_records is None:
+            if self.needs_listing():
+                dns_records = self.list_dh_dns_records()
+            else:
+                logging.info("Using cached DreamHost records for %s", self.local_hostname)
+                dns_records = dhplan.index_records(self.records)
+                self.reconciled = False
+        # Every record for our hostname, including read-only ones, for caching
+        self.host_records = []
+        for record_type in dhplan.MANAGED_TYPES:
+            self.host_records.extend(dns_records.get((self.local_hostname, record_type), []))
+        plan = dhplan.dhplan()
+        plan.plan_hostname(self.local_hostname, self.addresses, dns_records)
+        return plan
+
+    def apply_plan(self, plan):
+        """Send the operations in plan to the provider, and remember the
+        resulting records and published addresses"""
+        self.finish_plan(self.run_operations(plan.operations))
+        self.provider.flush()
+
+    def run_operations(self, operations, journal=None):
+        """Send operations to the provider as one batch, in order. Returns
+        a list of (operation, result) pairs, where result is True for a
+        successful remove, the added record for a successful add, or
+        None/False if the provider refused. Safe to call from several
+        threads at once, as long as they're working on different records.
+
+        If an add is refused, the removals of that record are skipped, so
+        the old record stays until the next update. Completed operations
+        are recorded in journal (a dhjournal), if given."""
+        results = []
+        for operation, result in self.provider.apply(self.api_key, operations):
+            results.append((operation, result))
+            if journal is not None and result:
+                journal.done(self.local_hostname, operation)
+        return results
+
+    def finish_plan(self, results):
+        """Remember the records and published addresses after the operations
+        in results (from run_operations()) have been sent"""
+        removed_records = []
+        added_records = []
+        update_failed = False
+        if results and self.history is not None:
+            self.history.operations(self.local_hostname, results)
+        for operation, result in results:
+            if not result:
+                update_failed = True
+                metrics.operation_failures.inc("dns-%s_record" % (operation.action))
+            elif operation.action == dhplan.REMOVE:
+                removed_records.append((operation.type, operation.value))
+                metrics.records_removed.inc(operation.type)
             else:
-                logging.debug("Address type (IPv4/IPv6) do not match")
-        return matching_index
-
-    def update_addresses(self):
-        """Check if an address needs to be updated, and builds a list of
-           entries to send off to DreamHost"""
-        # matching_address_index is to store addresses which "match" on both sides
-        # -- and don't need updating.
-        matching_address_index= []
-        # Remove editable entries that don't exist/are changing
-        # They will be re-added (with new values) in a moment.
-        for entry in self.get_dh_dns_records():
-            matching_address_index = self.remove_old_records(entry, matching_address_index)
-        # Remove addresses which do not need updating; reverse order or else
-        # the indexes will be wrongthe next time around.
-        for index in sorted(matching_address_index, reverse=True):
-            del self.interface.addresses[index]
-
-        # Add IP addresses detected from interfaces.
-        # NOTE:  we can't do much about readonly entries that aren't listed
-        # when we query DreamHost for DNS records. This means the shipping
-        # configuration file will fail if you have an IPv6 address.
-        for address in self.interface.addresses:
-            self.add_record(address)
-
-    def remove_record(self, entry):
-        """Remove old DNS records from DreamHost.  There is no option to modify
-        existing records; they must be deleted and then re-added."""
-        # We update the record by removing the old record, and adding a new one.
-        # DreamHost only allows `record`, `type`. and `value` for DNS
-        # record deletion; so we will create a new dict with those values.
-        # Start by building request parameters for the request library
-        request_params={key: entry[key] for key in ("record", "type", "value")}
-        # Add things we need - api.key, cmd, format...
-        request_params["key"] = self.api_key
-        request_params["cmd"] = "dns-remove_record"
-        request_params["format"] = "json"
-
-        # And now remove the old/nonmatching values from DreamHost
-        logging.info("Removing DNS entry with parameters: %s" %(request_params))
-        output = self.dreamhost_accessor.request_get(request_params)
-        if output["result"] != "success":
-            logging.error("Could not remove entry for address %s" % (request_params["value"]))
-
-    def add_record(self, address):
-        """Add new records to DreamHost.  There is no option to modify
-        existing records; they must be deleted and then re-added."""
-        # Create the requst parameters to add for the entry & record type
-        # Add has four fields:  record, type, value comment
-        
-        # First, we create the request parameters for the request library
-        request_params={}
-        request_params["key"] = self.api_key
-        request_params["cmd"] = "dns-add_record"
-        request_params["record"] = self.local_hostname
-        request_params["comment"] = "Automated DNS update by dhdynupdate"
-        request_params["format"] = "json"
-        request_params["value"] = address.compressed
-        if address.version == 4:
-            request_params["type"] = "A"
-        elif address.version == 6:
-            request_params["type"] = "AAAA"
+                added_records.append(result)
+                metrics.records_added.inc(operation.type)
+
+        # Remember what DreamHost now has for our hostname
+        self.records = [entry for entry in self.host_records
+                        if (entry["type"], entry["value"]) not in removed_records]
+        self.records.extend(added_records)
+        self.prev_addresses = copy.copy(self.addresses)
+        self.pending_addresses = None
+        if self.reconciled:
+            self.last_reconcile = time.time()
+            if self.schedule is not None:
+                # Check again sooner if DreamHost needed changing
+                self.schedule.done(bool(results), self.last_reconcile)
+        if update_failed:
+            # Don't trust the cache; list the records again next time.
+            self.last_reconcile = None
         else:
-            logging.critical("Invalid address type %s ! Exiting!" % (address))
-            sys.exit(7)
-
-        #And now that we have the parameters, we update DreamHost:
-        logging.info("Adding DNS entry with parameters: %s" %(request_params))
-        output = self.dreamhost_accessor.request_get(request_params)
-        if output["result"] != "success":
-            logging.error("Could not update entry for address %s" % (address))
+            metrics.last_sync.set(self.local_hostname, value=time.time())
+            if results and self.verifier is not None:
+                self.verifier.submit(self.local_hostname, self.prev_addresses)
+        if self.state is not None:
+            self.state.update(self.local_hostname, self.prev_addresses,
+                              self.records, self.last_reconcile)
+
+    def update_addresses(self, dns_records=None):
+        """Check if an address needs to be updated, and send the changes
+        off to DreamHost"""
+        self.apply_plan(self.plan_update(dns_records))
+
 # vim: ts=4 sw=4 et
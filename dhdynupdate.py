@@ -30,36 +30,422 @@
 
 import argparse
 import configparser
-import daemon
-import lockfile
+import contextlib
+import ipaddress
 import logging
-import netifaces
 import os
+import select
+import signal
+import socket
 import time
 import sys
-from dhdns import dhdns
+import dhexec
+import external_ip
+import dhaggregate
+from dhfleet import dhfleet
+from dhjournal import dhjournal
+from dhstate import dhstate
+import dhlog
+import dhmonitor
+import dhprovider
+import dhsched
+import dhsystemd
+import http_access
 import interfaces
+import metrics
+import netlink
 
-def setup_logger(logfile, log_level):
-    """Does logging setup, using python logging"""
+# Global options that are only read when dhdynupdate starts; changing them
+# needs a restart, rather than a reload.
+RESTART_OPTIONS = ("api_url", "http_pool_size", "max_concurrency", "log_file",
+                   "log_format", "log_max_bytes", "log_backup_count",
+                   "pidfile", "metrics_address", "metrics_port", "watch_mode",
+                   "state_file", "journal_file", "history_file",
+                   "monitor_socket", "aggregator_address", "aggregator_port",
+                   "provider", "provider_file")
+# Global options the scheduler is built from
+SCHEDULER_OPTIONS = ("update_interval", "AF_INET", "AF_INET6",
+                     "poll_backoff", "poll_jitter",
+                     "local_poll_interval", "local_poll_max_interval",
+                     "external_poll_interval", "external_poll_max_interval")
+
+def setup_logger(logfile, log_level, log_format="text",
+                 max_bytes=dhlog.DEFAULT_MAX_BYTES,
+                 backup_count=dhlog.DEFAULT_BACKUP_COUNT):
+    """Does logging setup, using python logging. The log file is appended
+    to, and written by a background thread."""
     try:
-        logger = logging.basicConfig(
-                 format='%(levelname)s:%(message)s',
-                 filename = logfile,
-                 filemode='w',
-                 level=log_level)
+        dhlog.setup(dhlog.file_handler(logfile, log_format, max_bytes,
+                                       backup_count),
+                    log_level)
     except PermissionError as error:
-        logging.critical("%s" % (error))
+        logging.critical("%s", error)
     except FileNotFoundError as error:
-        logging.critical("It's likely your logfile path is invalid: %s" % (logfile))
-        logging.critical("%s" % (error))
+        logging.critical("It's likely your logfile path is invalid: %s", logfile)
+        logging.critical("%s", error)
+    except ValueError as error:
+        logging.critical("%s", error)
+        sys.exit(2)
     except NameError as error:
-        logging.critical("%s" % (error))
+        logging.critical("%s", error)
     except:
-        logging.critical("Exception in setting up logging: %s" % (sys.exc_info()[0]))
+        logging.critical("Exception in setting up logging: %s", sys.exc_info()[0])
         logging.critical("Could not set up logging! Exiting!")
         sys.exit(2)
 
+def load_state(state_file):
+    """Returns a dhstate object for state_file, or None if it's not configured"""
+    if not state_file:
+        return None
+    return dhstate(state_file)
+
+def load_journal(journal_file):
+    """Returns a dhjournal object for journal_file, or None if it's not
+    configured"""
+    if not journal_file:
+        return None
+    return dhjournal(journal_file)
+
+def load_history(history_file):
+    """Returns a dhhistory object for history_file, or None if it's not
+    configured"""
+    if not history_file:
+        return None
+    # Only loaded when the history is kept
+    import dhhistory
+    try:
+        return dhhistory.dhhistory(history_file)
+    except (OSError, ValueError) as error:
+        logging.error("Not keeping the address history: %s", error)
+        return None
+
+def setup_verifier(global_config):
+    """Returns a dhverify.verifier configured from the Global section, or
+    None if no nameservers are configured"""
+    nameservers = global_config.get("verify_nameservers", "").replace(",", " ").split()
+    if not nameservers:
+        return None
+    # Only loaded when verification is configured
+    import dhverify
+    return dhverify.verifier(
+        nameservers,
+        float(global_config.get("verify_timeout", dhverify.DEFAULT_TIMEOUT)),
+        float(global_config.get("verify_max_wait", dhverify.DEFAULT_MAX_WAIT)),
+        protocol=global_config.get("verify_protocol", "udp"))
+
+def setup_profiler(profile_dir, profile_cycles):
+    """Returns a dhprofile.profiler writing to profile_dir"""
+    # Only loaded when profiling may be asked for
+    import dhprofile
+    return dhprofile.profiler(profile_dir, profile_cycles)
+
+def setup_retry_policy(global_config):
+    """Returns an http_access.retry_policy configured from the Global
+    section"""
+    defaults = http_access.DEFAULT_RETRY_POLICY
+    return http_access.retry_policy(
+        float(global_config.get("api_connect_timeout", defaults.connect_timeout)),
+        float(global_config.get("api_read_timeout", defaults.read_timeout)),
+        int(global_config.get("api_retries", defaults.retries)),
+        float(global_config.get("api_retry_backoff", defaults.backoff)),
+        float(global_config.get("api_retry_max_backoff", defaults.max_backoff)),
+        int(global_config.get("api_breaker_threshold", defaults.breaker_threshold)),
+        float(global_config.get("api_breaker_reset", defaults.breaker_reset)),
+        float(global_config.get("api_request_deadline", defaults.deadline)))
+
+def setup_provider(global_config):
+    """Returns the dhprovider configured from the Global section, or None
+    for DreamHost (the default), which dhfleet sets up itself"""
+    provider = global_config.get("provider", "dreamhost")
+    if provider == "dreamhost":
+        return None
+    if provider == "file":
+        if not global_config.get("provider_file"):
+            raise ValueError("provider = file needs a provider_file")
+        return dhprovider.memory(global_config["provider_file"])
+    raise ValueError("provider must be one of dreamhost, file")
+
+def setup_selector(global_config):
+    """Returns an address_selector configured from the Global section"""
+    return interfaces.address_selector(
+        global_config.get("address_selection", "first"),
+        global_config.get("address_scope", "all"),
+        global_config.get("address_allow", "").replace(",", " ").split(),
+        global_config.get("address_deny", "").replace(",", " ").split(),
+        global_config.getboolean("include_temporary", False),
+        global_config.getboolean("include_deprecated", False))
+
+def setup_scheduler(global_config, update_interval, configured_interfaces):
+    """Returns a dhsched.scheduler with a task for each address source in
+    use, configured from the Global section"""
+    scheduler = dhsched.scheduler(
+        float(global_config.get("poll_backoff", dhsched.DEFAULT_BACKOFF)),
+        float(global_config.get("poll_jitter", dhsched.DEFAULT_JITTER)))
+    for source in ("local", "external"):
+        used = [interface for interface in configured_interfaces.values()
+                if (interface == "-ipify.org") == (source == "external")]
+        if not used:
+            continue
+        interval = float(global_config.get(source + "_poll_interval", update_interval))
+        scheduler.schedule(source, interval,
+                           float(global_config.get(source + "_poll_max_interval",
+                                                   interval)))
+    return scheduler
+
+def setup_external_ip(global_config):
+    """Returns an external_ip object configured from the Global section"""
+    providers = {}
+    for addr_type, option in (("AF_INET", "external_ip_providers_v4"),
+                              ("AF_INET6", "external_ip_providers_v6")):
+        if global_config.get(option):
+            providers[addr_type] = global_config[option].replace(",", " ").split()
+    return external_ip.external_ip(
+        providers,
+        float(global_config.get("external_ip_timeout", external_ip.DEFAULT_TIMEOUT)),
+        float(global_config.get("external_ip_hedge_delay", external_ip.DEFAULT_HEDGE_DELAY)),
+        float(global_config.get("external_ip_cache_ttl", external_ip.DEFAULT_CACHE_TTL)),
+        int(global_config.get("external_ip_quorum", external_ip.DEFAULT_QUORUM)))
+
+def read_host_configs(config, config_names, agent=False):
+    """Returns a list of (api_key, local_hostname) for the config sections
+    in config_names"""
+    host_configs = []
+    for config_name in config_names:
+        # Agents don't talk to DreamHost, so don't need an api_key
+        if agent:
+            api_key = config[config_name].get("api_key", "")
+        else:
+            api_key = config[config_name]["api_key"]
+        host_configs.append((api_key, config[config_name]["local_hostname"]))
+    return host_configs
+
+def read_interfaces(global_config, hook_types=(), aggregator=False):
+    """Returns the configured interfaces that exist on this system, by
+    address family. Families in hook_types are skipped; the aggregator
+    doesn't use any."""
+    supported_address_families = ("AF_INET", "AF_INET6")
+    configured_interfaces = {}
+    system_interfaces = None
+    for addr_type in supported_address_families:
+        # The aggregator publishes the agents' addresses, not its own
+        if addr_type in hook_types or aggregator:
+            continue
+        interface = global_config[addr_type]
+        # Accept valid interfaces and special external lookup "interface"
+        if interface == "-ipify.org":
+            configured_interfaces[addr_type] = interface
+            continue
+        if system_interfaces is None:
+            system_interfaces = interfaces.interface_names()
+        if interface in system_interfaces:
+            configured_interfaces[addr_type] = interface
+    return configured_interfaces
+
+class config_reloader():
+
+    def __init__(self, configfile_path, config_names, running, watcher=None):
+        """Reloads the configuration file when SIGHUP is received.
+
+        config_names are the config sections in use, or None for all of
+        them; running is the Global section in use, as a dict. handle() is
+        the signal handler: it only sets requested, and wakes up wait() (or
+        the watcher), and the main loop calls reload() when it's ready."""
+        self.configfile_path = configfile_path
+        self.config_names = config_names
+        self.running = running
+        self.watcher = watcher
+        self.requested = False
+        # Written to by the signal handler; safer there than an Event's lock
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+
+    def handle(self, signum, frame):
+        self.requested = True
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            pass
+        if self.watcher is not None:
+            self.watcher.interrupt()
+
+    def wait(self, timeout):
+        """Sleep for timeout seconds, or until a reload is requested"""
+        if not self.requested:
+            select.select([self.wake_reader], [], [], timeout)
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        return self.requested
+
+    def reload(self, dh_fleet, store=None):
+        """Re-read the configuration file, and apply what changed to
+        dh_fleet (and the aggregator's report store, if given): hostnames
+        added or removed, interfaces and options. Hostnames that didn't
+        change keep their state, and the pooled connections and external
+        address cache are kept. If the file can't be used, the running
+        configuration is kept. Returns True if it was applied."""
+        self.requested = False
+        dhsystemd.notify("RELOADING=1")
+        logging.warning("Reloading %s...", self.configfile_path)
+        try:
+            applied = self.apply(dh_fleet, store)
+        finally:
+            dhsystemd.notify("READY=1")
+        return applied
+
+    def apply(self, dh_fleet, store):
+        config = configparser.ConfigParser()
+        try:
+            if len(config.read(self.configfile_path)) != 1:
+                raise ValueError("Error reading config file %s" % (self.configfile_path))
+            global_config = config["Global"]
+            config_names = self.config_names
+            if config_names is None:
+                config_names = [name for name in config.sections() if name != "Global"]
+            host_configs = read_host_configs(config, config_names)
+            configured_interfaces = read_interfaces(global_config,
+                                                    aggregator=store is not None)
+            update_interval = int(global_config["update_interval"])
+            requests_per_minute = float(global_config.get("api_requests_per_minute", "0"))
+            burst = int(global_config.get("api_burst", "1"))
+            debounce_interval = float(global_config.get("debounce_interval", "0"))
+            reconcile_interval = int(float(global_config.get(
+                                     "full_reconcile_interval", "24")) * 3600)
+            reconcile_max_interval = int(float(global_config.get(
+                                         "full_reconcile_max_interval", "0")) * 3600)
+            # Read by run_aggregator; checked here so a typo isn't applied
+            float(global_config.get("aggregate_interval", "60"))
+            selector = setup_selector(global_config)
+            retry_policy = setup_retry_policy(global_config)
+            running = dict(global_config)
+            changed = set(option for option in set(self.running) | set(running)
+                          if self.running.get(option) != running.get(option))
+            # Keep what we can, so caches stay warm
+            external = None
+            if "-ipify.org" in configured_interfaces.values() and \
+               (dh_fleet.interface.external is None or
+                any(option.startswith("external_ip_") for option in changed)):
+                external = setup_external_ip(global_config)
+            verifier = dh_fleet.verifier
+            if any(option.startswith("verify_") for option in changed):
+                verifier = setup_verifier(global_config)
+            scheduler = None
+            if store is None and dh_fleet.scheduler is not None and \
+               changed.intersection(SCHEDULER_OPTIONS):
+                scheduler = setup_scheduler(global_config, update_interval,
+                                            configured_interfaces)
+        except (KeyError, ValueError, configparser.Error) as error:
+            logging.error("Could not reload the configuration, keeping the running one: %s",
+                          error)
+            return False
+
+        for option in RESTART_OPTIONS:
+            if option in changed:
+                logging.warning("%s changed; restart dhdynupdate to use it", option)
+        old_verifier = dh_fleet.verifier
+        dh_fleet.set_options(reconcile_interval, reconcile_max_interval,
+                             debounce_interval, requests_per_minute, burst,
+                             verifier, scheduler, retry_policy)
+        if old_verifier is not None and old_verifier is not verifier:
+            old_verifier.shutdown()
+        if configured_interfaces != dh_fleet.configured_interfaces or \
+           external is not None or \
+           any(option.startswith(("address_", "include_")) for option in changed):
+            dh_fleet.set_interfaces(configured_interfaces, external, selector)
+            logging.warning("Interfaces are now %s", configured_interfaces)
+            if self.watcher is not None:
+                self.watcher.watch(configured_interfaces)
+        added, removed = dh_fleet.set_hosts(host_configs)
+        if store is not None:
+            store.hostnames = set(hostname for api_key, hostname in host_configs)
+            store.token = global_config.get("aggregator_token", "")
+        self.running = running
+        logging.warning("Reloaded configuration; hostnames added: %s, removed: %s, "
+                        "changed options: %s", added, removed, sorted(changed))
+        return True
+
+def start_metrics(metrics_address, metrics_port):
+    """Serve metrics, if metrics_port is configured"""
+    if not metrics_port:
+        return None
+    try:
+        return metrics.serve(metrics_address, int(metrics_port))
+    except OSError as error:
+        logging.error("Could not serve metrics on %s:%s: %s",
+                      metrics_address, metrics_port, error)
+        return None
+
+def setup_watcher(watch_mode, configured_interfaces):
+    """Returns a netlink_watcher if watch_mode is "netlink", or None to poll.
+    Falls back to polling if netlink isn't available."""
+    if watch_mode == "poll":
+        return None
+    try:
+        watcher = netlink.netlink_watcher(configured_interfaces)
+        logging.info("Watching for address changes using netlink")
+        return watcher
+    except (OSError, AttributeError) as error:
+        logging.warning("Netlink not available, polling instead: %s", error)
+        return None
+
+def wait_for_change(watcher, update_interval, reloader=None, watchdog=None):
+    """Sleep until the next update; with a watcher, wake up early if an
+    address changes, and with a reloader, if a reload is requested. With a
+    watchdog interval, systemd is told we're alive at least that often."""
+    deadline = time.monotonic() + update_interval
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (reloader is not None and reloader.requested):
+            return
+        if watchdog is not None:
+            remaining = min(remaining, watchdog)
+        if watcher is not None:
+            if watcher.wait(remaining):
+                logging.info("Address change event received")
+                return
+        elif reloader is not None:
+            reloader.wait(remaining)
+        else:
+            time.sleep(remaining)
+        if watchdog is not None:
+            dhsystemd.notify("WATCHDOG=1")
+
+def send_reports(url, token, host_configs, addresses):
+    """Agent mode: report addresses for each configured hostname to the
+    aggregator at url. Returns False if any report couldn't be sent."""
+    sent = True
+    for api_key, local_hostname in host_configs:
+        try:
+            dhaggregate.send_report(url, local_hostname, addresses, token)
+            logging.info("Reported %s for %s to %s", addresses, local_hostname, url)
+        except (OSError, ValueError) as error:
+            logging.error("Could not report to aggregator %s: %s", url, error)
+            sent = False
+    return sent
+
+def run_aggregator(dh_fleet, server, aggregate_interval, reloader=None,
+                   watchdog=None, profiler=None):
+    """Aggregator mode: publish the agents' latest reports every
+    aggregate_interval seconds"""
+    server.start()
+    while True:
+        if reloader is not None and reloader.requested and \
+           reloader.reload(dh_fleet, server.store):
+            aggregate_interval = float(reloader.running.get("aggregate_interval", "60"))
+        try:
+            with profiler.cycle() if profiler is not None else contextlib.nullcontext():
+                dh_fleet.update_reported(server.store.latest())
+            wait = dh_fleet.wait_time(aggregate_interval)
+        except http_access.api_unavailable as error:
+            # The reports are kept; they're published once DreamHost is back
+            wait = dh_fleet.retry_time()
+            logging.error("%s; trying again in %.0fs", error, wait)
+        dhsystemd.notify("WATCHDOG=1")
+        wait_for_change(None, wait, reloader, watchdog)
+
 def main(argv=None):
     """Command line parser, begins DaemonContext for main loop"""
     if argv is None:
@@ -70,6 +456,10 @@ def main(argv=None):
                             default=False, required=False,
                             dest="daemonize",
                             help="Execute %(prog)s as a dæmon")
+    cmd_parser.add_argument("--foreground", action='store_true',
+                            default=False, required=False,
+                            dest="foreground",
+                            help="With -d, run the dæmon loop without detaching (ie. for systemd Type=notify)")
     cmd_parser.add_argument("--debug", action='store', type=str,
                             default="WARNING", required=False,
                             dest="log_level", metavar="lvl",
@@ -80,15 +470,39 @@ def main(argv=None):
                             dest="configfile_path",
                             help="Configuration file path")
     config_name_default = "DreamHost API Test Account" 
-    cmd_parser.add_argument("-c", "--config", action='store',
-                            type=str, default=config_name_default,
+    cmd_parser.add_argument("-c", "--config", action='append',
+                            type=str, default=None,
                             required=False, metavar="config",
-                            dest="config_name",
-                            help="Configuration name; Conflicts with -m")
+                            dest="config_names",
+                            help="Configuration name; may be given more than once; Conflicts with -m")
+    cmd_parser.add_argument("-a", "--all", action='store_true',
+                            default=False, required=False,
+                            dest="all_configs",
+                            help="Update every configuration in the config file; Conflicts with -c and -m")
     cmd_parser.add_argument("-m", "--monitor-only", action='store_true',
                             default=False, required=False,
                             dest="monitor_only",
-                            help="Only monitor the configured interfaces - don't access DreamHost API; Conflicts with -c")
+                            help="Only monitor the configured interfaces - don't access DreamHost API; address changes are written as JSON lines to stdout (or monitor_socket); Conflicts with -c")
+    cmd_parser.add_argument("-p", "--plan", action='store_true',
+                            default=False, required=False,
+                            dest="plan_only",
+                            help="Print the DNS changes that would be made, without making them; Conflicts with -d and -m")
+    cmd_parser.add_argument("--address", action='append',
+                            type=str, default=[], required=False,
+                            metavar="addr", dest="hook_addresses",
+                            help="Publish addr instead of looking up the address of its family; may be given once per family (ie. from a DHCP or PPP hook); Conflicts with -d and -m")
+    cmd_parser.add_argument("--aggregator", action='store_true',
+                            default=False, required=False,
+                            dest="aggregator",
+                            help="Publish the addresses reported by agents, rather than our own; Conflicts with -m, -p and --address")
+    cmd_parser.add_argument("--agent", action='store_true',
+                            default=False, required=False,
+                            dest="agent",
+                            help="Report our addresses to the aggregator and exit, rather than contacting DreamHost; Conflicts with -d, -m, -p and --aggregator")
+    cmd_parser.add_argument("--profile", action='store', type=int,
+                            default=0, required=False,
+                            metavar="cycles", dest="profile_cycles",
+                            help="Profile the first cycles update cycles (CPU and memory) into profile_dir; SIGUSR1 profiles the next profile_cycles cycles of a running dæmon")
     args = cmd_parser.parse_args()
 
     # read configuration from file
@@ -112,26 +526,95 @@ def main(argv=None):
     else:
         log_level = 0
 
-    if args.monitor_only and not args.config_name in [config_name_default, ""]:
-        print("Cannot specify -c and -m")
+    if args.monitor_only and (args.config_names or args.all_configs):
+        print("Cannot specify -c or -a with -m")
+        sys.exit(4)
+    if args.all_configs and args.config_names:
+        print("Cannot specify -c and -a")
+        sys.exit(4)
+    if args.plan_only and (args.daemonize or args.monitor_only):
+        print("Cannot specify -p with -d or -m")
+        sys.exit(4)
+    if args.hook_addresses and (args.daemonize or args.monitor_only):
+        print("Cannot specify --address with -d or -m")
+        sys.exit(4)
+    if args.aggregator and (args.monitor_only or args.plan_only or args.hook_addresses):
+        print("Cannot specify --aggregator with -m, -p or --address")
+        sys.exit(4)
+    if args.agent and (args.daemonize or args.monitor_only or args.plan_only or
+                       args.aggregator):
+        print("Cannot specify --agent with -d, -m, -p or --aggregator")
+        sys.exit(4)
+    try:
+        hook_addresses = [ipaddress.ip_address(address) for address in args.hook_addresses]
+    except ValueError as error:
+        print(error)
         sys.exit(4)
+    # Families we were given an address for don't need to be looked up
+    hook_types = set("AF_INET" if address.version == 4 else "AF_INET6"
+                     for address in hook_addresses)
+
+    if args.all_configs:
+        config_names = [name for name in config.sections() if name != "Global"]
+    elif args.config_names:
+        config_names = args.config_names
+    else:
+        config_names = [config_name_default]
 
     # Get configuration settings
     try:
-        supported_address_families = ("AF_INET", "AF_INET6")
-        configured_interfaces = {}
         api_url = config["Global"]["api_url"]
+        pool_size = int(config["Global"].get("http_pool_size",
+                                             http_access.DEFAULT_POOL_SIZE))
+        max_concurrency = int(config["Global"].get("max_concurrency",
+                                                   dhexec.DEFAULT_CONCURRENCY))
+        requests_per_minute = float(config["Global"].get("api_requests_per_minute", "0"))
+        burst = int(config["Global"].get("api_burst", "1"))
+        debounce_interval = float(config["Global"].get("debounce_interval", "0"))
+        host_configs = []
         if not args.monitor_only:
-            api_key = config[args.config_name]["api_key"]
-            local_hostname = config[args.config_name]["local_hostname"]
+            host_configs = read_host_configs(config, config_names, args.agent)
+        aggregator_address = config["Global"].get("aggregator_address", "127.0.0.1")
+        aggregator_port = int(config["Global"].get("aggregator_port",
+                                                   dhaggregate.DEFAULT_PORT))
+        aggregator_url = config["Global"].get("aggregator_url",
+                             "http://127.0.0.1:%d%s" % (dhaggregate.DEFAULT_PORT,
+                                                        dhaggregate.REPORT_PATH))
+        aggregator_token = config["Global"].get("aggregator_token", "")
+        aggregate_interval = float(config["Global"].get("aggregate_interval", "60"))
         logfile = config["Global"]["log_file"]
+        log_format = config["Global"].get("log_format", "text")
+        log_max_bytes = int(config["Global"].get("log_max_bytes",
+                                                  dhlog.DEFAULT_MAX_BYTES))
+        log_backup_count = int(config["Global"].get("log_backup_count",
+                                                     dhlog.DEFAULT_BACKUP_COUNT))
         update_interval = int(config["Global"]["update_interval"])
+        watch_mode = config["Global"].get("watch_mode", "poll")
+        state_file = config["Global"].get("state_file", "")
+        journal_file = config["Global"].get("journal_file",
+                                            state_file + ".journal" if state_file else "")
+        history_file = config["Global"].get("history_file", "")
+        monitor_socket = config["Global"].get("monitor_socket", "")
+        metrics_address = config["Global"].get("metrics_address", "127.0.0.1")
+        metrics_port = config["Global"].get("metrics_port", "")
+        profile_dir = config["Global"].get("profile_dir", "/var/tmp/dhdynupdate")
+        profile_cycles = int(config["Global"].get("profile_cycles", "5"))
+        # Configured in hours
+        reconcile_interval = int(float(config["Global"].get(
+                                 "full_reconcile_interval", "24")) * 3600)
+        reconcile_max_interval = int(float(config["Global"].get(
+                                     "full_reconcile_max_interval", "0")) * 3600)
         pid_file = config["Global"]["pidfile"]
-        for addr_type in supported_address_families:
-            interface = config["Global"][addr_type]
-            # Accept valid interfaces and special external lookup "interface"
-            if interface in netifaces.interfaces() or interface == "-ipify.org":
-                configured_interfaces[addr_type] = interface
+        configured_interfaces = read_interfaces(config["Global"], hook_types,
+                                                args.aggregator)
+        # Only set up external lookups if they'll be used
+        external = None
+        if "-ipify.org" in configured_interfaces.values():
+            external = setup_external_ip(config["Global"])
+        selector = setup_selector(config["Global"])
+        retry_policy = setup_retry_policy(config["Global"])
+        provider = setup_provider(config["Global"])
+        verifier = setup_verifier(config["Global"])
     except KeyError as error:
         # Technically, logger isn't "configured" -- it'll dump messages to the
         # console.
@@ -147,54 +630,225 @@ def main(argv=None):
 #                         % (sys.exc_info()[0]))
         sys.exit(5)
 
+    if watch_mode not in ("poll", "netlink"):
+        print("watch_mode must be one of poll, netlink")
+        sys.exit(5)
+
 #   When in doubt, do not run as a daemon. Daemon keeps stack traces from being
 #   printed, and you're left wondering why the dæmon is quitting.
     if args.daemonize:
-        with daemon.DaemonContext(pidfile=lockfile.FileLock(pid_file)):
+        # Only needed by the dæmon; one-shot runs start faster without them.
+        if args.foreground:
+            context = contextlib.nullcontext()
+        else:
+            import daemon
+            import lockfile
+            context = daemon.DaemonContext(pidfile=lockfile.FileLock(pid_file))
+        with context:
             # set up logging; it's much easier to just set it up within the
             # DaemonContext. Outside the daemoncontext requires a lot more work...
-            setup_logger(logfile, log_level)
+            setup_logger(logfile, log_level, log_format, log_max_bytes,
+                         log_backup_count)
             logging.warning("Starting dhdynupdater...")
             try:
                 pf = open(pid_file, 'w')
                 pf.write("%s\n" % (os.getpid()))
                 pf.close()
             except:
-                logging.critical("Exception in setting up pidfile: %s" % (sys.exc_info()[0]))
+                logging.critical("Exception in setting up pidfile: %s", sys.exc_info()[0])
                 sys.exit(6)
-            if not args.monitor_only:
+            start_metrics(metrics_address, metrics_port)
+            watcher = None
+            if not args.aggregator:
+                watcher = setup_watcher(watch_mode, configured_interfaces)
+            reloader = config_reloader(args.configfile_path,
+                                       None if args.all_configs else config_names,
+                                       dict(config["Global"]), watcher)
+            signal.signal(signal.SIGHUP, reloader.handle)
+            watchdog = dhsystemd.watchdog_interval()
+            profiler = setup_profiler(profile_dir, profile_cycles)
+            signal.signal(signal.SIGUSR1, profiler.handle)
+            if args.profile_cycles:
+                profiler.request(args.profile_cycles)
+            if args.aggregator:
+                try:
+                    dh_fleet = dhfleet(api_url, host_configs, configured_interfaces,
+                                       pool_size, load_state(state_file),
+                                       reconcile_interval, max_concurrency,
+                                       external, requests_per_minute, burst,
+                                       debounce_interval, selector,
+                                       journal=load_journal(journal_file),
+                                       verifier=verifier,
+                                       history=load_history(history_file),
+                                       retry_policy=retry_policy,
+                                       provider=provider)
+                    server = dhaggregate.aggregator(
+                                 dhaggregate.report_store(
+                                     [hostname for api_key, hostname in host_configs],
+                                     aggregator_token),
+                                 aggregator_address, aggregator_port)
+                    dhsystemd.notify("READY=1")
+                    run_aggregator(dh_fleet, server, aggregate_interval, reloader,
+                                   watchdog, profiler)
+                except Exception:
+                    logging.exception("Exception in aggregator")
+                    dhsystemd.notify("STOPPING=1")
+                    logging.warning("Closing dhdynupdater...")
+                    logging.shutdown()
+                    sys.exit(9)
+            elif not args.monitor_only:
                 try:
-                    dh_dns = dhdns(api_key, api_url, local_hostname, configured_interfaces)
-                except:
-                    logging.critical("Exception in creating dh_dns: %s" % (sys.exc_info()[0]))
+                    dh_fleet = dhfleet(api_url, host_configs, configured_interfaces,
+                                       pool_size, load_state(state_file),
+                                       reconcile_interval, max_concurrency,
+                                       external, requests_per_minute, burst,
+                                       debounce_interval, selector,
+                                       setup_scheduler(config["Global"], update_interval,
+                                                       configured_interfaces),
+                                       reconcile_max_interval,
+                                       load_journal(journal_file),
+                                       verifier, load_history(history_file),
+                                       retry_policy, provider)
+                except Exception:
+                    logging.exception("Exception in creating dh_fleet")
+                    logging.shutdown()
+                    sys.exit(9)
             else:
-                interface = interfaces.interfaces(configured_interfaces)
+                interface = interfaces.interfaces(configured_interfaces, external, selector)
+                if not monitor_socket and not args.foreground:
+                    logging.warning("The dæmon has no stdout; set monitor_socket to "
+                                    "receive monitor events")
+                try:
+                    monitor = dhmonitor.event_feed(monitor_socket)
+                except OSError as error:
+                    logging.critical("Could not listen on %s: %s", monitor_socket, error)
+                    sys.exit(6)
+                monitor.update(configured_interfaces, interface.by_family)
+            dhsystemd.notify("READY=1")
             while True:
                 logging.warning("Starting dhdynupdater main loop...")
                 try:
+                    if reloader.requested:
+                        if args.monitor_only:
+                            reloader.requested = False
+                            logging.warning("Restart to reload the configuration in monitor mode")
+                        elif reloader.reload(dh_fleet):
+                            update_interval = int(reloader.running["update_interval"])
                     if args.monitor_only:
-                        interface.addresses = interface.get_if_addresses(configured_interfaces)
-                        print(interface.addresses)
+                        with profiler.cycle():
+                            interface.addresses = interface.get_if_addresses(configured_interfaces)
+                        monitor.update(configured_interfaces, interface.by_family)
+                        dhsystemd.notify("WATCHDOG=1")
+                        wait_for_change(watcher, update_interval, reloader, watchdog)
                     else:
-                        dh_dns.update_if_necessary()
-                    time.sleep(update_interval)
-                except:
-                    logging.critical("Exception in main loop: %s" % (sys.exc_info()[0]))
+                        try:
+                            with profiler.cycle():
+                                dh_fleet.update_if_necessary()
+                            wait = dh_fleet.wait_time(update_interval)
+                        except http_access.api_unavailable as error:
+                            # Nothing is lost: the change is still pending,
+                            # and is sent once DreamHost is back.
+                            wait = dh_fleet.retry_time()
+                            logging.error("%s; trying again in %.0fs", error, wait)
+                        logging.info("Schedule:\n%s", dh_fleet.scheduler)
+                        dhsystemd.notify("WATCHDOG=1")
+                        wait_for_change(watcher, wait, reloader, watchdog)
+                except Exception:
+                    # Exit with an error, so systemd (Restart=on-failure)
+                    # restarts us; the traceback says why.
+                    logging.exception("Exception in main loop")
+                    dhsystemd.notify("STOPPING=1")
                     logging.warning("Closing dhdynupdater...")
                     logging.shutdown()
-                    sys.exit(0)
+                    sys.exit(9)
                 logging.warning("looping dhdynupdater main loop...")
     else:
         if args.monitor_only:
-            interface = interfaces.interfaces(configured_interfaces)
-            print(interface.addresses)
+            interface = interfaces.interfaces(configured_interfaces, external, selector)
+            dhmonitor.event_feed().update(configured_interfaces, interface.by_family)
+        elif args.agent:
+            setup_logger(logfile, log_level, log_format, log_max_bytes,
+                         log_backup_count)
+            interface = interfaces.interfaces(configured_interfaces, external, selector)
+            if not send_reports(aggregator_url, aggregator_token, host_configs,
+                                hook_addresses + interface.addresses):
+                sys.exit(8)
+        elif args.aggregator:
+            setup_logger(logfile, log_level, log_format, log_max_bytes,
+                         log_backup_count)
+            logging.warning("Starting dhdynupdater aggregator...")
+            dh_fleet = dhfleet(api_url, host_configs, configured_interfaces,
+                               pool_size, load_state(state_file),
+                               reconcile_interval, max_concurrency,
+                               external, requests_per_minute, burst,
+                               debounce_interval, selector,
+                               journal=load_journal(journal_file),
+                               verifier=verifier,
+                               history=load_history(history_file),
+                               retry_policy=retry_policy,
+                               provider=provider)
+            server = dhaggregate.aggregator(
+                         dhaggregate.report_store(
+                             [hostname for api_key, hostname in host_configs],
+                             aggregator_token),
+                         aggregator_address, aggregator_port)
+            try:
+                run_aggregator(dh_fleet, server, aggregate_interval)
+            except KeyboardInterrupt:
+                server.close()
+        elif args.plan_only:
+            setup_logger(logfile, log_level, log_format, log_max_bytes,
+                         log_backup_count)
+            dh_fleet = dhfleet(api_url, host_configs, configured_interfaces,
+                               pool_size, load_state(state_file),
+                               reconcile_interval, max_concurrency,
+                               external, requests_per_minute, burst,
+                               0, selector,
+                               retry_policy=retry_policy,
+                               provider=provider)
+            profiler = None
+            if args.profile_cycles:
+                profiler = setup_profiler(profile_dir, profile_cycles)
+                profiler.request(1)
+            try:
+                with profiler.cycle() if profiler is not None else contextlib.nullcontext():
+                    plan = dh_fleet.plan(hook_addresses + dh_fleet.interface.addresses)
+            except http_access.api_unavailable as error:
+                logging.critical("%s", error)
+                print(error)
+                sys.exit(8)
+            print(plan)
         else:
-            setup_logger(logfile, log_level)
-            logging.warn("Starting dhdynupdater...")
-            dh_dns = dhdns(api_key, api_url, local_hostname, configured_interfaces)
-            dh_dns.update_if_necessary()
+            setup_logger(logfile, log_level, log_format, log_max_bytes,
+                         log_backup_count)
+            logging.warning("Starting dhdynupdater...")
+            # No debounce: we exit straight away, so a change held back
+            # would never be published.
+            dh_fleet = dhfleet(api_url, host_configs, configured_interfaces,
+                               pool_size, load_state(state_file),
+                               reconcile_interval, max_concurrency,
+                               external, requests_per_minute, burst,
+                               0, selector,
+                               journal=load_journal(journal_file),
+                               history=load_history(history_file),
+                               retry_policy=retry_policy,
+                               provider=provider)
+            profiler = None
+            if args.profile_cycles:
+                profiler = setup_profiler(profile_dir, profile_cycles)
+                profiler.request(1)
+            # The interfaces were just looked up by dhfleet; don't do it again.
+            try:
+                with profiler.cycle() if profiler is not None else contextlib.nullcontext():
+                    dh_fleet.update_if_necessary(hook_addresses +
+                                                 dh_fleet.interface.addresses)
+            except http_access.api_unavailable as error:
+                logging.critical("%s", error)
+                print(error)
+                sys.exit(8)
 
     logging.warning("Closing dhdynupdater...")
+    http_access.close_sessions()
     logging.shutdown()
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Runs DreamHost API operations concurrently.
+
+Operations on different records (hostname and record type) don't depend on
+each other, so they run in parallel on a bounded thread pool. Operations on
+the same record run in order, within a single task: the new record is added
+before the old one is removed, so if the add is refused the old record is
+kept.
+"""
+
+import concurrent.futures
+import logging
+
+# Default number of API requests in flight at once
+DEFAULT_CONCURRENCY = 8
+
+class dhexec():
+
+    def __init__(self, max_concurrency=DEFAULT_CONCURRENCY):
+        """Set up a thread pool running at most max_concurrency tasks"""
+        self.max_concurrency = max(1, max_concurrency)
+        # Started on first use; a cycle with one operation doesn't need it.
+        self.pool = None
+
+    def run(self, tasks):
+        """Run each task (a callable taking no arguments), and return their
+        results in order. Every task is allowed to finish; then the first
+        exception raised by a task, if any, is re-raised."""
+        if len(tasks) <= 1 or self.max_concurrency == 1:
+            return [task() for task in tasks]
+        logging.debug("Running %d tasks, %d at a time",
+                      len(tasks), self.max_concurrency)
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=self.max_concurrency,
+                            thread_name_prefix="dhexec")
+        futures = [self.pool.submit(task) for task in tasks]
+        concurrent.futures.wait(futures)
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""Updates many hostnames (config sections) from a single process"""
+
+import collections
+import functools
+import ipaddress
+import logging
+import metrics
+
+from dhdns import dhdns
+import dhexec
+import dhlog
+import dhplan
+import dhprovider
+import http_access
+import interfaces
+
+class dhfleet():
+
+    def __init__(self, api_url, host_configs, configured_interfaces,
+                 pool_size=http_access.DEFAULT_POOL_SIZE, state=None,
+                 reconcile_interval=0,
+                 max_concurrency=dhexec.DEFAULT_CONCURRENCY, external=None,
+                 requests_per_minute=0, burst=1, debounce_interval=0,
+                 selector=None, scheduler=None, reconcile_max_interval=0,
+                 journal=None, verifier=None, history=None, retry_policy=None,
+                 provider=None):
+        """Initialize a dhdns object for each (api_key, local_hostname) in
+        host_configs. The interfaces and the DreamHost API connection are
+        shared by all of them.
+
+        state (a dhstate object), reconcile_interval and debounce_interval
+        are passed on to each dhdns object. Up to max_concurrency API
+        operations are sent at once, and no more than requests_per_minute
+        (with bursts of burst) per api_key. external is the external_ip
+        object used for "-ipify.org", and selector the address_selector
+        choosing which interface addresses are published.
+
+        With a scheduler (a dhsched.scheduler), the external lookup is only
+        made when its "external" task is due, and each hostname gets its own
+        "hostname:" task for reconciling, backing off from
+        reconcile_interval to reconcile_max_interval. Without one, every
+        update reads every source.
+
+        journal (a dhjournal) records each update's operations as they're
+        applied, so an interrupted update can be finished by resume().
+        verifier (a dhverify.verifier) and history (a dhhistory) are passed
+        on to each dhdns object. retry_policy (an http_access.retry_policy)
+        sets the API timeouts, retries and circuit breaker.
+
+        provider (a dhprovider) keeps the records; by default, DreamHost at
+        api_url. The rate limit and retry policy only apply to DreamHost."""
+        self.api_url = api_url
+        self.state = state
+        self.configured_interfaces = configured_interfaces
+        self.interface = interfaces.interfaces(self.configured_interfaces, external,
+                                              selector)
+        self.executor = dhexec.dhexec(max_concurrency)
+        if provider is None:
+            # Every concurrent operation needs its own pooled connection
+            provider = dhprovider.dreamhost(http_access.http_access(
+                           api_url, max(pool_size, max_concurrency),
+                           requests_per_minute, burst, retry_policy))
+        self.provider = provider
+        # None unless the provider is DreamHost
+        self.dreamhost_accessor = provider.accessor
+        self.reconcile_interval = reconcile_interval
+        self.reconcile_max_interval = reconcile_max_interval
+        self.debounce_interval = debounce_interval
+        self.verifier = verifier
+        self.scheduler = scheduler
+        self.journal = journal
+        self.history = history
+        self.hosts = []
+        for api_key, local_hostname in host_configs:
+            self.add_host(api_key, local_hostname)
+
+    def add_host(self, api_key, local_hostname):
+        """Add a dhdns object for local_hostname; returns it"""
+        host = dhdns(api_key, self.api_url, local_hostname,
+                     self.configured_interfaces,
+                     interface=self.interface,
+                     provider=self.provider,
+                     state=self.state,
+                     reconcile_interval=self.reconcile_interval,
+                     debounce_interval=self.debounce_interval,
+                     verifier=self.verifier,
+                     history=self.history)
+        self.schedule_host(host)
+        self.hosts.append(host)
+        return host
+
+    def schedule_host(self, host):
+        """Give host its reconcile task, if we're scheduling"""
+        if self.scheduler is not None and self.reconcile_interval > 0:
+            host.schedule = self.scheduler.schedule("hostname:" + host.local_hostname,
+                                                    self.reconcile_interval,
+                                                    self.reconcile_max_interval,
+                                                    host.last_reconcile)
+
+    def set_hosts(self, host_configs):
+        """Change the hostnames to host_configs, a list of (api_key,
+        local_hostname). Hostnames that are already configured (with the same
+        api_key) keep their state. Returns the lists of hostnames added and
+        removed."""
+        wanted = list(host_configs)
+        kept = [host for host in self.hosts
+                if (host.api_key, host.local_hostname) in wanted]
+        removed = [host.local_hostname for host in self.hosts if host not in kept]
+        for host in self.hosts:
+            if host not in kept and self.scheduler is not None:
+                self.scheduler.tasks.pop("hostname:" + host.local_hostname, None)
+        self.hosts = kept
+        existing = [(host.api_key, host.local_hostname) for host in kept]
+        added = []
+        for api_key, local_hostname in wanted:
+            if (api_key, local_hostname) not in existing:
+                # A hostname moved to another api_key can't use what we
+                # knew about its records under the old one
+                if self.state is not None and local_hostname in removed:
+                    self.state.update(local_hostname, [], None, None)
+                self.add_host(api_key, local_hostname)
+                added.append(local_hostname)
+        return added, removed
+
+    def set_interfaces(self, configured_interfaces, external=None, selector=None):
+        """Change the interfaces (and how their addresses are chosen). The
+        next update reads them afresh."""
+        self.configured_interfaces = configured_interfaces
+        for host in self.hosts:
+            host.configured_interfaces = configured_interfaces
+        if external is not None:
+            self.interface.external = external
+        if selector is not None:
+            self.interface.selector = selector
+        # Forget the last snapshot, so the addresses are selected again
+        self.interface.snapshot_key = None
+
+    def set_options(self, reconcile_interval, reconcile_max_interval,
+                    debounce_interval, requests_per_minute, burst,
+                    verifier=None, scheduler=None, retry_policy=None):
+        """Change the per-hostname options, rate limit, verifier, scheduler
+        (None keeps the current scheduler) and retry policy, keeping each
+        hostname's state"""
+        reschedule = (scheduler is not None or
+                      (reconcile_interval, reconcile_max_interval) !=
+                      (self.reconcile_interval, self.reconcile_max_interval))
+        self.reconcile_interval = reconcile_interval
+        self.reconcile_max_interval = reconcile_max_interval
+        self.debounce_interval = debounce_interval
+        self.verifier = verifier
+        for host in self.hosts:
+            host.reconcile_interval = reconcile_interval
+            host.debounce_interval = debounce_interval
+            host.verifier = verifier
+        if self.dreamhost_accessor is not None:
+            self.dreamhost_accessor.set_rate_limit(requests_per_minute, burst)
+            self.dreamhost_accessor.set_retry_policy(retry_policy)
+        if scheduler is not None:
+            self.scheduler = scheduler
+        if reschedule and self.scheduler is not None:
+            for host in self.hosts:
+                host.schedule = None
+                self.scheduler.tasks.pop("hostname:" + host.local_hostname, None)
+                self.schedule_host(host)
+
+    def update_if_necessary(self, addresses=None):
+        """Read the interface addresses once, and update every hostname whose
+        addresses have changed. dns-list_records is only sent once per
+        api_key, no matter how many hostnames use it; hostnames with fresh
+        cached records don't need it at all.
+
+        addresses may be given instead of reading the interfaces. Each call
+        is a new logging cycle."""
+        dhlog.new_cycle()
+        self.resume()
+        generation = None
+        if addresses is None:
+            refresh_external = self.scheduler is None or self.scheduler.due("external")
+            with metrics.phase_seconds.time("discovery"):
+                addresses = self.interface.get_if_addresses(self.configured_interfaces,
+                                                            refresh_external)
+            generation = self.interface.generation
+            if self.scheduler is not None:
+                changed = self.interface.changed_sources
+                self.scheduler.done("local", "local" in changed)
+                if refresh_external:
+                    self.scheduler.done("external", "external" in changed)
+        self.interface.addresses = addresses
+
+        changed_hosts = []
+        for host in self.hosts:
+            # Nothing has changed since the last time round; skip comparing
+            if host.unchanged(generation):
+                continue
+            if host.address_changed(self.interface.addresses, generation) or \
+               host.reconcile_due():
+                changed_hosts.append(host)
+        self.publish(changed_hosts)
+
+    def update_reported(self, reports):
+        """Update the hostnames in reports, a dict of hostname: addresses
+        (ie. the agents' latest reports, see dhaggregate), all together.
+        Hostnames without a report keep their published addresses, but are
+        still reconciled when it's due. Each call is a new logging cycle."""
+        dhlog.new_cycle()
+        self.resume()
+        changed_hosts = []
+        for host in self.hosts:
+            if host.local_hostname in reports:
+                addresses = reports[host.local_hostname]
+            elif host.last_reconcile is not None:
+                addresses = host.prev_addresses
+            else:
+                # Never reported, or published; nothing to do
+                continue
+            if host.address_changed(addresses) or host.reconcile_due():
+                changed_hosts.append(host)
+        self.publish(changed_hosts)
+
+    def publish(self, hosts):
+        """Plan and apply the updates of hosts, and save the state"""
+        if not hosts:
+            return
+        plans = self.plan_hosts(hosts)
+        if self.journal is not None:
+            for host, plan in plans:
+                if plan.operations:
+                    self.journal.begin(host.local_hostname, host.addresses,
+                                       plan.operations)
+        self.apply_plans(plans)
+        self.save()
+
+    def save(self):
+        """Save the state; the journal isn't needed once it's saved"""
+        if self.state is not None:
+            self.state.save()
+        if self.journal is not None:
+            self.journal.clear()
+
+    def resume(self):
+        """Finish the updates left unfinished in the journal (ie. by a crash,
+        or an API error), without listing the records again"""
+        if self.journal is None:
+            return
+        unfinished = self.journal.unfinished()
+        if not unfinished:
+            return
+        by_hostname = dict((host.local_hostname, host) for host in self.hosts)
+        plans = []
+        done_results = {}
+        uncached = []
+        for hostname, (addresses, operations, done) in unfinished.items():
+            host = by_hostname.get(hostname)
+            if host is None:
+                logging.warning("Dropping unfinished update for unconfigured hostname %s",
+                                hostname)
+                continue
+            plan = dhplan.dhplan()
+            plan.operations = [operation for operation in operations
+                               if operation not in done]
+            logging.warning("Resuming update of %s: %d of %d operation(s) left",
+                            hostname, len(plan), len(operations))
+            host.addresses = [ipaddress.ip_address(address) for address in addresses]
+            host.host_records = list(host.records or [])
+            host.reconciled = False
+            if host.records is None:
+                uncached.append(host)
+            # The operations already done still count for the records cache
+            done_results[host] = [
+                (operation, True if operation.action == dhplan.REMOVE else
+                 {"record": operation.record, "type": operation.type,
+                  "value": operation.value, "editable": "1"})
+                for operation in operations if operation in done]
+            plans.append((host, plan))
+        self.apply_plans(plans, done_results)
+        for host in uncached:
+            # We only know part of its records; list them next time
+            host.last_reconcile = None
+            if self.state is not None:
+                self.state.update(host.local_hostname, host.prev_addresses,
+                                  host.records, host.last_reconcile)
+        self.save()
+
+    def apply_plans(self, plans, done_results=None):
+        """Apply a list of (host, dhplan). Each record's operations run in
+        order, but different records -- of any host -- run concurrently.
+        done_results are the (operation, result) pairs of each host already
+        applied (when resuming)."""
+        with metrics.phase_seconds.time("applying"):
+            tasks = []
+            for host, plan in plans:
+                for operations in plan.by_record().values():
+                    tasks.append((host, operations))
+            results = self.executor.run(
+                [functools.partial(host.run_operations, operations, self.journal)
+                 for host, operations in tasks])
+
+            host_results = collections.OrderedDict(
+                (host, list((done_results or {}).get(host, []))) for host, plan in plans)
+            for (host, operations), result in zip(tasks, results):
+                host_results[host].extend(result)
+            for host, result in host_results.items():
+                host.finish_plan(result)
+            self.provider.flush()
+
+    def wait_time(self, update_interval):
+        """How long to wait before the next update: update_interval (or
+        until the next scheduled task), or less if a debounced change is due
+        to be published sooner"""
+        wait = update_interval
+        if self.scheduler is not None and self.scheduler.tasks:
+            wait = self.scheduler.wait_time()
+        for host in self.hosts:
+            remaining = host.debounce_remaining()
+            if remaining is not None:
+                wait = min(wait, remaining)
+        return wait
+
+    def retry_time(self):
+        """How long to wait before trying again when DreamHost was
+        unavailable: until the circuit breaker lets a probe through, or
+        for as long as it would stay open"""
+        accessor = self.dreamhost_accessor
+        if accessor is None:
+            return 1.0
+        return max(1.0, accessor.breaker.remaining() or accessor.policy.breaker_reset)
+
+    def plan(self, addresses=None):
+        """Plan the changes for every hostname against freshly listed
+        DreamHost records, without applying them (ie. a dry run). Returns a
+        dhplan with all of the operations."""
+        if addresses is None:
+            with metrics.phase_seconds.time("discovery"):
+                addresses = self.interface.get_if_addresses(self.configured_interfaces)
+        self.interface.addresses = addresses
+        for host in self.hosts:
+            host.address_changed(self.interface.addresses)
+        full_plan = dhplan.dhplan()
+        for host, plan in self.plan_hosts(self.hosts, force_listing=True):
+            full_plan.extend(plan)
+        return full_plan
+
+    def plan_hosts(self, hosts, force_listing=False):
+        """Plan the updates for hosts; returns a list of (host, dhplan). The
+        records are listed once per api_key for the hosts that need them;
+        the others use their cached records."""
+        by_key = collections.OrderedDict()
+        for host in hosts:
+            by_key.setdefault(host.api_key, []).append(host)
+
+        # One dns-list_records per api_key, sent concurrently
+        listings = []
+        for api_key, key_hosts in by_key.items():
+            logging.info("Planning %d hostname(s) sharing an api_key", len(key_hosts))
+            listing_hosts = [host for host in key_hosts
+                             if force_listing or host.needs_listing()]
+            if listing_hosts:
+                listings.append((listing_hosts, functools.partial(
+                    listing_hosts[0].list_dh_dns_records,
+                    [host.local_hostname for host in listing_hosts])))
+        with metrics.phase_seconds.time("listing"):
+            results = self.executor.run([task for listing_hosts, task in listings])
+        host_records = {}
+        for (listing_hosts, task), dns_records in zip(listings, results):
+            for host in listing_hosts:
+                host_records[host] = dns_records
+
+        plans = []
+        with metrics.phase_seconds.time("planning"):
+            for host in hosts:
+                # Hosts that weren't listed use their cached records
+                plans.append((host, host.plan_update(host_records.get(host))))
+        return plans
+
+# vim: ts=4 sw=4 et
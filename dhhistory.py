@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Address history: every detected address change, and every DNS operation
+sent to DreamHost, appended to a compact binary file.
+
+The file is an 8 byte header followed by fixed-size 32 byte records:
+
+    timestamp (float64), hostname id (uint32), event (uint8),
+    family (uint8: 4, 6 or 0), 2 bytes padding, address (16 bytes)
+
+IPv4 addresses use the first 4 bytes of the address. Hostnames are numbered
+in the order they're first seen, and listed one per line in a ".names"
+file next to the history. Records are never rewritten; a record cut short
+by a crash is dropped the next time the file is opened for writing.
+
+Because every record is the same size, the file is read through mmap: a
+query binary searches for its start time, and streams the records from
+there, so months of history never need to be loaded into memory.
+
+    ./dhhistory.py counts --since 90
+    ./dhhistory.py churn --bucket 7
+    ./dhhistory.py outages --hostname your.domain.name
+"""
+
+import argparse
+import collections
+import configparser
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import dhplan
+
+MAGIC = b"DHHIST\x00\x01"
+RECORD = struct.Struct("<dIBB2x16s")
+
+# Events
+DETECTED = 1    # An address of the hostname's new set
+LOST = 2        # The hostname has no address of this family any more
+ADDED = 3       # A record DreamHost added
+REMOVED = 4     # A record DreamHost removed
+FAILED = 5      # An operation DreamHost refused
+EVENT_NAMES = {DETECTED: "detected", LOST: "lost", ADDED: "added",
+               REMOVED: "removed", FAILED: "failed"}
+
+# A decoded record; address is an ipaddress object, or None
+entry = collections.namedtuple("entry", ["timestamp", "hostname", "event", "family",
+                                         "address"])
+
+def pack_address(address):
+    """(family, 16 bytes) for an ipaddress object"""
+    return address.version, address.packed.ljust(16, b"\0")
+
+def unpack_address(family, packed):
+    if family == 4:
+        return ipaddress.IPv4Address(packed[:4])
+    if family == 6:
+        return ipaddress.IPv6Address(packed)
+    return None
+
+def names_path(path):
+    return path + ".names"
+
+def read_names(path):
+    """The hostnames, indexed by id"""
+    try:
+        with open(names_path(path), 'r') as names_file:
+            return names_file.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+class dhhistory():
+
+    def __init__(self, path):
+        """Open the history at path for appending, creating it if needed"""
+        self.path = path
+        self.lock = threading.Lock()
+        self.names = read_names(path)
+        self.ids = dict((name, index) for index, name in enumerate(self.names))
+        self.file = open(path, 'ab')
+        size = self.file.tell()
+        if size == 0:
+            self.file.write(MAGIC)
+            self.file.flush()
+        else:
+            with open(path, 'rb') as history_file:
+                if history_file.read(len(MAGIC)) != MAGIC:
+                    self.file.close()
+                    raise ValueError("%s is not a dhdynupdate history file" % (path))
+            # Drop a record cut short by a crash
+            whole = len(MAGIC) + (size - len(MAGIC)) // RECORD.size * RECORD.size
+            if whole != size:
+                logging.warning("Dropping a damaged record at the end of %s", path)
+                self.file.truncate(whole)
+        self.names_file = open(names_path(path), 'a')
+
+    def hostname_id(self, hostname):
+        hostname_id = self.ids.get(hostname)
+        if hostname_id is None:
+            hostname_id = self.ids[hostname] = len(self.names)
+            self.names.append(hostname)
+            self.names_file.write(hostname + "\n")
+            self.names_file.flush()
+        return hostname_id
+
+    def append(self, records):
+        """Append records, a list of (timestamp, hostname, event, address),
+        where address is an ipaddress object, or the family (4 or 6)"""
+        with self.lock:
+            data = []
+            for timestamp, hostname, event, address in records:
+                if isinstance(address, int):
+                    family, packed = address, bytes(16)
+                else:
+                    family, packed = pack_address(address)
+                data.append(RECORD.pack(timestamp, self.hostname_id(hostname),
+                                        event, family, packed))
+            self.file.write(b"".join(data))
+            self.file.flush()
+
+    def address_changed(self, hostname, old_addresses, new_addresses):
+        """Record a change of hostname's addresses"""
+        now = time.time()
+        records = [(now, hostname, DETECTED, address) for address in new_addresses]
+        new_families = set(address.version for address in new_addresses)
+        for family in sorted(set(address.version for address in old_addresses)
+                             - new_families):
+            records.append((now, hostname, LOST, family))
+        self.append(records)
+
+    def operations(self, hostname, results):
+        """Record the (operation, result) pairs sent for hostname (see
+        dhdns.run_operations)"""
+        now = time.time()
+        records = []
+        for operation, result in results:
+            if not result:
+                event = FAILED
+            elif operation.action == dhplan.REMOVE:
+                event = REMOVED
+            else:
+                event = ADDED
+            records.append((now, hostname, event, ipaddress.ip_address(operation.value)))
+        self.append(records)
+
+    def close(self):
+        self.file.close()
+        self.names_file.close()
+
+def read(path, since=None, until=None, hostname=None):
+    """Yield the entries of the history at path, from since to until
+    (timestamps), for hostname (or all). The file is memory mapped, and the
+    start found by binary search, assuming the clock didn't go backwards."""
+    names = read_names(path)
+    with open(path, 'rb') as history_file:
+        if history_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a dhdynupdate history file" % (path))
+        size = os.fstat(history_file.fileno()).st_size
+        count = (size - len(MAGIC)) // RECORD.size
+        if count == 0:
+            return
+        with mmap.mmap(history_file.fileno(), 0, access=mmap.ACCESS_READ) as history_map:
+            def timestamp(index):
+                return struct.unpack_from("<d", history_map,
+                                          len(MAGIC) + index * RECORD.size)[0]
+            low, high = 0, count
+            if since is not None:
+                while low < high:
+                    middle = (low + high) // 2
+                    if timestamp(middle) < since:
+                        low = middle + 1
+                    else:
+                        high = middle
+            hostname_id = None
+            if hostname is not None:
+                if hostname not in names:
+                    return
+                hostname_id = names.index(hostname)
+            view = memoryview(history_map)[len(MAGIC) + low * RECORD.size:
+                                           len(MAGIC) + count * RECORD.size]
+            try:
+                for record in RECORD.iter_unpack(view):
+                    when, record_id, event, family, packed = record
+                    if until is not None and when >= until:
+                        break
+                    if hostname_id is not None and record_id != hostname_id:
+                        continue
+                    yield entry(when, names[record_id] if record_id < len(names) else
+                                "#%d" % (record_id),
+                                event, family,
+                                None if event == LOST else unpack_address(family, packed))
+            finally:
+                view.release()
+
+def changes(entries):
+    """Group entries into address changes: yields (timestamp, hostname,
+    list of entries) for each DETECTED/LOST group"""
+    group = []
+    for history_entry in entries:
+        if history_entry.event not in (DETECTED, LOST):
+            continue
+        if group and (history_entry.timestamp, history_entry.hostname) != \
+                     (group[0].timestamp, group[0].hostname):
+            yield group[0].timestamp, group[0].hostname, group
+            group = []
+        group.append(history_entry)
+    if group:
+        yield group[0].timestamp, group[0].hostname, group
+
+def counts(entries):
+    """Per hostname, a Counter of address changes and of each operation
+    event"""
+    totals = collections.defaultdict(collections.Counter)
+    last_change = {}
+    for history_entry in entries:
+        hostname_totals = totals[history_entry.hostname]
+        if history_entry.event in (DETECTED, LOST):
+            # One change per timestamp, however many addresses it has
+            if last_change.get(history_entry.hostname) != history_entry.timestamp:
+                last_change[history_entry.hostname] = history_entry.timestamp
+                hostname_totals["changes"] += 1
+        else:
+            hostname_totals[EVENT_NAMES[history_entry.event]] += 1
+    return totals
+
+def churn(entries, bucket):
+    """Address changes per bucket (seconds): returns a dict of bucket start:
+    Counter of changes per hostname"""
+    buckets = collections.defaultdict(collections.Counter)
+    for timestamp, hostname, group in changes(entries):
+        buckets[timestamp - timestamp % bucket][hostname] += 1
+    return buckets
+
+def outages(entries, now=None):
+    """Windows in which a hostname had no address of a family: a list of
+    (hostname, family, start, end), where end is None if it's still out"""
+    lost = {}
+    windows = []
+    for timestamp, hostname, group in changes(entries):
+        for history_entry in group:
+            key = (hostname, history_entry.family)
+            if history_entry.event == LOST:
+                lost.setdefault(key, timestamp)
+            elif key in lost:
+                windows.append((hostname, history_entry.family, lost.pop(key), timestamp))
+    for (hostname, family), start in lost.items():
+        windows.append((hostname, family, start, None))
+    return sorted(windows, key=lambda window: window[2])
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+def parse_time(value):
+    """A YYYY-MM-DD date, or a number of days ago, as a timestamp"""
+    try:
+        return time.time() - float(value) * 86400
+    except ValueError:
+        return time.mktime(time.strptime(value, "%Y-%m-%d"))
+
+def main(argv=None):
+    cmd_parser = argparse.ArgumentParser(description="Query the dhdynupdate address history")
+    cmd_parser.add_argument("-f", "--config-file", default="/etc/dhdynupdate.conf",
+                            metavar="path", dest="configfile_path",
+                            help="Configuration file path, for history_file")
+    cmd_parser.add_argument("--history-file", default=None, metavar="path",
+                            help="History file path; overrides the configuration")
+    cmd_parser.add_argument("--since", default=None, metavar="when",
+                            help="Start at a YYYY-MM-DD date, or this many days ago")
+    cmd_parser.add_argument("--until", default=None, metavar="when",
+                            help="End at a YYYY-MM-DD date, or this many days ago")
+    cmd_parser.add_argument("--hostname", default=None,
+                            help="Only this hostname")
+    subparsers = cmd_parser.add_subparsers(dest="query", required=True)
+    subparsers.add_parser("counts", help="Address changes and DNS operations per hostname")
+    churn_parser = subparsers.add_parser("churn", help="Address changes per day (or bucket)")
+    churn_parser.add_argument("--bucket", type=float, default=1.0, metavar="days",
+                              help="Bucket size in days")
+    subparsers.add_parser("outages", help="Windows without an address of a family")
+    subparsers.add_parser("dump", help="Every record")
+    args = cmd_parser.parse_args(argv)
+
+    path = args.history_file
+    if path is None:
+        config = configparser.ConfigParser()
+        config.read(args.configfile_path)
+        path = config["Global"].get("history_file", "") if config.has_section("Global") else ""
+        if not path:
+            print("No history_file configured in %s; use --history-file"
+                  % (args.configfile_path))
+            sys.exit(4)
+    since = parse_time(args.since) if args.since is not None else None
+    until = parse_time(args.until) if args.until is not None else None
+    try:
+        entries = read(path, since, until, args.hostname)
+        if args.query == "counts":
+            totals = counts(entries)
+            print("%-40s %8s %8s %8s %8s" % ("hostname", "changes", "added", "removed", "failed"))
+            for hostname, hostname_totals in sorted(totals.items()):
+                print("%-40s %8d %8d %8d %8d" % (hostname, hostname_totals["changes"],
+                                                 hostname_totals["added"],
+                                                 hostname_totals["removed"],
+                                                 hostname_totals["failed"]))
+        elif args.query == "churn":
+            bucket = args.bucket * 86400
+            buckets = churn(entries, bucket)
+            total = collections.Counter()
+            for start, hostname_counts in sorted(buckets.items()):
+                print("%s  %6d" % (format_time(start), sum(hostname_counts.values())))
+                total.update(hostname_counts)
+            if buckets:
+                days = (max(buckets) + bucket - min(buckets)) / 86400
+                print()
+                for hostname, count in sorted(total.items()):
+                    print("%-40s %6d changes, %.2f per day" % (hostname, count, count / days))
+        elif args.query == "outages":
+            for hostname, family, start, end in outages(entries):
+                if end is None:
+                    print("%-40s IPv%d  %s  -  ongoing" % (hostname, family, format_time(start)))
+                else:
+                    print("%-40s IPv%d  %s  -  %s  (%ds)" % (hostname, family,
+                                                            format_time(start),
+                                                            format_time(end),
+                                                            end - start))
+        else:
+            for history_entry in entries:
+                print("%s  %-30s %-8s %s" % (format_time(history_entry.timestamp),
+                                             history_entry.hostname,
+                                             EVENT_NAMES.get(history_entry.event,
+                                                             history_entry.event),
+                                             history_entry.address or
+                                             "IPv%d" % (history_entry.family)))
+    except (OSError, ValueError) as error:
+        print(error)
+        sys.exit(3)
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Operation journal, so an update interrupted half way (a crash, a kill, an
+API error) is finished after a restart, rather than waiting for the next
+full reconcile.
+
+Before a plan is applied, each hostname's operations and the addresses
+they publish are appended to the journal, and the file is synced. As each
+operation completes, a "done" line is appended. Once the whole update has
+been applied and the state saved, the journal is emptied. Anything still
+in it at startup is unfinished work; see dhfleet.resume().
+
+The journal is JSON lines:
+
+    {"hostname": "host.example.com", "addresses": [...], "operations": [[action, record, type, value], ...]}
+    {"hostname": "host.example.com", "done": [action, record, type, value]}
+"""
+
+import json
+import logging
+import os
+import threading
+
+import dhplan
+
+class dhjournal():
+
+    def __init__(self, path):
+        """Open the journal at path, reading any unfinished plans"""
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        # Set once the journal can't be written; updates go on without it
+        self.disabled = False
+        # hostname: (addresses, operations, set of done operations)
+        self.plans = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return
+        except OSError as error:
+            logging.warning("Could not read journal %s: %s", self.path, error)
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                hostname = entry["hostname"]
+                if "operations" in entry:
+                    self.plans[hostname] = (entry["addresses"],
+                                            [dhplan.dns_operation(*operation)
+                                             for operation in entry["operations"]],
+                                            set())
+                elif hostname in self.plans:
+                    self.plans[hostname][2].add(dhplan.dns_operation(*entry["done"]))
+            except (ValueError, KeyError, TypeError):
+                # The last line can be cut short by a crash; everything
+                # before it was synced.
+                logging.warning("Ignoring damaged journal entry in %s", self.path)
+
+    def unfinished(self):
+        """The plans that weren't finished, as a dict of hostname:
+        (addresses, operations, done operations)"""
+        return dict(self.plans)
+
+    def write(self, entries):
+        """Append entries, and sync them to disk. If the journal can't be
+        written, the error is logged, and it isn't kept from then on."""
+        with self.lock:
+            if self.disabled:
+                return
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a')
+                for entry in entries:
+                    self.file.write(json.dumps(entry) + "\n")
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as error:
+                logging.error("Not keeping the journal %s: %s", self.path, error)
+                self.disabled = True
+                if self.file is not None:
+                    try:
+                        self.file.close()
+                    except OSError:
+                        pass
+                    self.file = None
+
+    def begin(self, hostname, addresses, operations):
+        """Record the plan for hostname before it's applied"""
+        self.plans[hostname] = ([str(address) for address in addresses],
+                                list(operations), set())
+        self.write([{"hostname": hostname,
+                     "addresses": self.plans[hostname][0],
+                     "operations": [list(operation) for operation in operations]}])
+
+    def done(self, hostname, operation):
+        """Record that an operation has completed"""
+        self.write([{"hostname": hostname, "done": list(operation)}])
+        with self.lock:
+            if hostname in self.plans:
+                self.plans[hostname][2].add(operation)
+
+    def clear(self):
+        """Every plan has been applied, and the state saved"""
+        with self.lock:
+            self.plans = {}
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                logging.error("Could not remove journal %s: %s", self.path, error)
+
+# vim: ts=4 sw=4 et
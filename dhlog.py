@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Logging setup for dhdynupdate.
+
+Records are put on a queue by the thread that logs them, and formatted and
+written by a background thread, so a slow disk never stalls an update.
+Only the message itself is rendered when a record is queued (its arguments
+may change afterwards); timestamps, JSON encoding and file I/O all happen in
+the background. Messages below the log level are never formatted at all, as
+long as callers pass their arguments to the logging call rather than
+formatting the message themselves.
+
+Every record carries the correlation ID of the update cycle it was logged
+in (see new_cycle), so the messages of one cycle can be found together.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+import uuid
+
+LOG_FORMATS = ("text", "json")
+TEXT_FORMAT = "%(levelname)s:%(message)s"
+# Default size (bytes) at which the log file is rotated
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+# Default number of rotated log files kept
+DEFAULT_BACKUP_COUNT = 5
+
+# The correlation ID of the current update cycle; there's only ever one
+# cycle running, but its work is spread over several threads.
+_cycle = "-"
+_listener = None
+_listener_lock = threading.Lock()
+
+def new_cycle():
+    """Start a new update cycle, with a new correlation ID. Returns the ID."""
+    global _cycle
+    _cycle = uuid.uuid4().hex[:12]
+    return _cycle
+
+def current_cycle():
+    """The correlation ID of the current update cycle"""
+    return _cycle
+
+class cycle_filter(logging.Filter):
+    """Tags each record with the current cycle's correlation ID"""
+
+    def filter(self, record):
+        record.cycle = _cycle
+        return True
+
+class json_formatter(logging.Formatter):
+    """Formats records as JSON lines"""
+
+    def format(self, record):
+        entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+                         + ".%03dZ" % (record.msecs),
+                 "level": record.levelname,
+                 "cycle": getattr(record, "cycle", "-"),
+                 "thread": record.threadName,
+                 "module": record.module,
+                 "message": record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+class queue_handler(logging.handlers.QueueHandler):
+    """A QueueHandler that leaves formatting to the listener thread"""
+
+    def prepare(self, record):
+        # Render the message now, since its arguments might be changed
+        # before the listener gets to it; the rest can wait.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks hold references to frames that won't live long
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def file_handler(logfile, log_format="text", max_bytes=DEFAULT_MAX_BYTES,
+                 backup_count=DEFAULT_BACKUP_COUNT):
+    """A handler appending to logfile, rotated at max_bytes (0 never
+    rotates), keeping backup_count old files"""
+    if log_format not in LOG_FORMATS:
+        raise ValueError("log_format must be one of %s" % (", ".join(LOG_FORMATS)))
+    handler = logging.handlers.RotatingFileHandler(logfile, mode="a",
+                                                   maxBytes=max_bytes,
+                                                   backupCount=backup_count)
+    if log_format == "json":
+        handler.setFormatter(json_formatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return handler
+
+def setup(handler, log_level):
+    """Send the root logger's records to handler, through a queue drained
+    by a background thread"""
+    global _listener
+    records = queue.SimpleQueue()
+    front = queue_handler(records)
+    front.addFilter(cycle_filter())
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(front)
+    root.setLevel(log_level)
+    # urllib3 logs each request's URL at DEBUG, and the URL has the api_key
+    logging.getLogger("urllib3").setLevel(logging.INFO)
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+        else:
+            # Flush the queue when the program exits, however it exits
+            atexit.register(shutdown)
+        _listener = logging.handlers.QueueListener(records, handler)
+        _listener.start()
+
+def shutdown():
+    """Write out any queued records, and stop the background thread"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+# vim: ts=4 sw=4 et
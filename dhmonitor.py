@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Address change events for monitor mode (-m), as newline-delimited JSON.
+
+An event is written whenever the addresses selected for a configured
+interface and family change:
+
+    {"time": "2016-05-01T12:00:00.000Z", "interface": "eth0", "family": "AF_INET", "old": ["192.0.2.2"], "new": ["192.0.2.9"]}
+
+"old" and "new" are lists, as address_selection = all can publish several
+addresses (with "first", they hold at most one); an empty "new" means the
+family has no usable address any more. The first event of each interface
+and family has "old": null.
+
+Events go to stdout, or to every client connected to a Unix socket. Socket
+clients are sent the current addresses (with "old": null) when they
+connect, so they never have to poll. Every event is flushed as soon as
+it's written.
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+# Seconds a socket client may take to accept an event before it's dropped
+CLIENT_TIMEOUT = 1.0
+
+def timestamp(when=None):
+    if when is None:
+        when = time.time()
+    return (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(when)) +
+            ".%03dZ" % (int(when * 1000) % 1000))
+
+class event_feed():
+
+    def __init__(self, socket_path=None, stream=None):
+        """Write events to socket_path (a Unix socket, created here), or
+        without one, to stream (by default, stdout)"""
+        self.socket_path = socket_path
+        self.stream = stream if stream is not None else sys.stdout
+        # (interface, family): list of addresses (as strings)
+        self.current = {}
+        self.lock = threading.Lock()
+        self.clients = []
+        self.server = None
+        if socket_path:
+            try:
+                os.unlink(socket_path)
+            except FileNotFoundError:
+                pass
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(socket_path)
+            self.server.listen(16)
+            threading.Thread(target=self.accept, daemon=True,
+                             name="monitor").start()
+            logging.info("Sending monitor events to %s", socket_path)
+
+    def accept(self):
+        """Accept socket clients, sending each the current addresses"""
+        while True:
+            try:
+                client, address = self.server.accept()
+            except OSError:
+                # Closed
+                return
+            client.settimeout(CLIENT_TIMEOUT)
+            with self.lock:
+                lines = [self.encode(interface, family, None, addresses)
+                         for (interface, family), addresses in sorted(self.current.items())]
+                try:
+                    client.sendall("".join(lines).encode("utf-8"))
+                except OSError:
+                    client.close()
+                    continue
+                self.clients.append(client)
+
+    def encode(self, interface, family, old, new, when=None):
+        return json.dumps({"time": timestamp(when), "interface": interface,
+                           "family": family, "old": old, "new": new}) + "\n"
+
+    def update(self, configured_interfaces, by_family, when=None):
+        """Compare the selected addresses of each family (see
+        interfaces.by_family) with the last ones, and send an event for
+        each that changed. Returns the number of events sent."""
+        lines = []
+        with self.lock:
+            for family, interface in sorted(configured_interfaces.items()):
+                new = [str(address) for address in by_family.get(family, [])]
+                key = (interface, family)
+                old = self.current.get(key)
+                if old == new:
+                    continue
+                self.current[key] = new
+                lines.append(self.encode(interface, family, old, new, when))
+            if lines:
+                self.send("".join(lines))
+        return len(lines)
+
+    def send(self, text):
+        if self.server is None:
+            self.stream.write(text)
+            self.stream.flush()
+            return
+        data = text.encode("utf-8")
+        for client in list(self.clients):
+            try:
+                client.sendall(data)
+            except OSError as error:
+                # Gone away, or not keeping up
+                logging.info("Dropping monitor client: %s", error)
+                client.close()
+                self.clients.remove(client)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            with self.lock:
+                for client in self.clients:
+                    client.close()
+                self.clients = []
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Plans the DNS record changes needed to publish a set of addresses.
+
+For each (hostname, record type), the records to add and to remove are the
+set differences between the addresses we want published and the editable
+records DreamHost has. Read-only records can't be changed, so a record type
+with a read-only record is left alone; so is a record type we have no
+address for, as that usually means a lookup failed rather than that the
+family has gone away.
+
+A record's additions come before its removals, so there's always at least
+one record for the hostname while it's being updated.
+"""
+
+import collections
+import ipaddress
+import logging
+
+# The record types we manage; everything else is left alone.
+MANAGED_TYPES = ("A", "AAAA")
+
+ADD = "add"
+REMOVE = "remove"
+
+# A single DreamHost API operation
+dns_operation = collections.namedtuple("dns_operation",
+                                       ["action", "record", "type", "value"])
+
+def record_type(address):
+    """The DNS record type for an ipaddress address"""
+    return "A" if address.version == 4 else "AAAA"
+
+def index_records(entries):
+    """Index DNS records by (record, type), so a hostname's records can be
+    found without scanning every record in the account"""
+    index = {}
+    for entry in entries:
+        index.setdefault((entry["record"], entry["type"]), []).append(entry)
+    return index
+
+class dhplan():
+
+    def __init__(self):
+        """An empty plan"""
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __str__(self):
+        if not self.operations:
+            return "No changes"
+        return "\n".join("%-6s %s %s %s" % operation
+                         for operation in self.operations)
+
+    def plan_hostname(self, hostname, addresses, dns_records):
+        """Add the operations needed to publish addresses for hostname.
+        dns_records is an index from index_records(). A record type without
+        any address in addresses is left as it is. Returns the operations
+        added."""
+        wanted = {}
+        for address in addresses:
+            wanted.setdefault(record_type(address), set()).add(address)
+
+        operations = []
+        for rtype in MANAGED_TYPES:
+            entries = dns_records.get((hostname, rtype), [])
+            if any(entry["editable"] != "1" for entry in entries):
+                logging.info("Not operating on %s %s, as it's read-only", hostname, rtype)
+                continue
+            # DreamHost's value, keyed by the address it represents, so
+            # differently formatted IPv6 addresses still compare equal.
+            existing = {}
+            for entry in entries:
+                existing[ipaddress.ip_address(entry["value"])] = entry["value"]
+            want = wanted.get(rtype)
+            if not want:
+                # No address of this family (ie. the interface has none, or
+                # the lookup failed); leave what's published alone.
+                continue
+            for address in sorted(want - existing.keys()):
+                operations.append(dns_operation(ADD, hostname, rtype,
+                                                address.compressed))
+            for address in sorted(existing.keys() - want):
+                operations.append(dns_operation(REMOVE, hostname, rtype,
+                                                existing[address]))
+        self.operations.extend(operations)
+        return operations
+
+    def extend(self, plan):
+        """Append the operations of another plan"""
+        self.operations.extend(plan.operations)
+
+    def by_record(self):
+        """The operations grouped by (hostname, record type), in order"""
+        groups = collections.OrderedDict()
+        for operation in self.operations:
+            groups.setdefault((operation.record, operation.type), []).append(operation)
+        return groups
+
+# vim: ts=4 sw=4 et
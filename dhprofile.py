@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Profiling for the long-running dæmon.
+
+When asked to (--profile, or SIGUSR1), the next few update cycles are run
+under cProfile, and tracemalloc snapshots are taken between them. Each
+profiling run gets its own directory under profile_dir, holding:
+
+* profile.pstats - the cProfile stats of every profiled cycle, for pstats
+  or snakeviz
+* profile.txt - the functions with the most cumulative time
+* memory-N.txt - where memory was allocated (and freed) during cycle N
+* summary.txt - each cycle's duration, the time spent in each phase
+  (discovery, listing, planning, applying) and the traced memory
+
+cProfile only sees the main thread; time spent in the worker threads shows
+up as waiting for them, so the phase timers are the better guide there.
+Nothing is traced outside of a profiling run.
+"""
+
+import contextlib
+import cProfile
+import io
+import logging
+import metrics
+import os
+import pstats
+import time
+import tracemalloc
+
+DEFAULT_CYCLES = 5
+# Lines written for the profile and each memory diff
+DEFAULT_TOP = 30
+# Stack frames kept for each allocation
+TRACE_FRAMES = 5
+
+def phase_totals():
+    """The total time spent in each phase so far, from the phase metric"""
+    with metrics.phase_seconds.lock:
+        return dict((labels[0], counts[-1])
+                    for labels, counts in metrics.phase_seconds.values.items())
+
+class profiler():
+
+    def __init__(self, directory, cycles=DEFAULT_CYCLES, top=DEFAULT_TOP):
+        """Profiles cycles update cycles at a time, writing the results
+        under directory"""
+        self.directory = directory
+        self.cycles = cycles
+        self.top = top
+        # Cycles asked for by request(), but not started yet
+        self.requested = 0
+        # Cycles left in the current run
+        self.remaining = 0
+        self.run_directory = None
+        self.profile = None
+        self.snapshot = None
+        self.started_tracing = False
+        self.cycle_number = 0
+        self.summary = []
+
+    def request(self, cycles=None):
+        """Profile the next cycles (by default, self.cycles) cycles. Only
+        sets a flag, so it's safe to call from a signal handler."""
+        self.requested = cycles or self.cycles
+
+    def handle(self, signum, frame):
+        self.request()
+
+    @contextlib.contextmanager
+    def cycle(self):
+        """Context manager around one update cycle; profiles it if a run is
+        in progress or has been requested"""
+        if self.requested and not self.remaining:
+            self.start()
+        if not self.remaining:
+            yield
+            return
+        self.cycle_number += 1
+        phases = phase_totals()
+        start = time.perf_counter()
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            self.end_cycle(time.perf_counter() - start, phases)
+
+    def start(self):
+        """Begin a profiling run; if its directory can't be created, the
+        error is logged and the request dropped"""
+        cycles = self.requested
+        self.requested = 0
+        self.run_directory = os.path.join(self.directory,
+                                          time.strftime("profile-%Y%m%d-%H%M%S"))
+        try:
+            os.makedirs(self.run_directory, exist_ok=True)
+        except OSError as error:
+            logging.error("Not profiling: %s", error)
+            return
+        self.remaining = cycles
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start(TRACE_FRAMES)
+        self.snapshot = self.take_snapshot()
+        self.profile = cProfile.Profile()
+        self.cycle_number = 0
+        self.summary = ["cycle  seconds  " +
+                        "  ".join("%-10s" % (phase) for phase in metrics.PHASES) +
+                        "  traced KiB  peak KiB"]
+        logging.warning("Profiling the next %d cycle(s) into %s",
+                        self.remaining, self.run_directory)
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def end_cycle(self, elapsed, phases):
+        """Write the memory diff of the cycle just run, and finish the run
+        after its last cycle"""
+        snapshot = self.take_snapshot()
+        differences = snapshot.compare_to(self.snapshot, "lineno")
+        self.snapshot = snapshot
+        traced, peak = tracemalloc.get_traced_memory()
+        try:
+            with open(os.path.join(self.run_directory,
+                                   "memory-%d.txt" % (self.cycle_number)), "w") as memory_file:
+                memory_file.write("Traced memory: %d KiB (peak %d KiB)\n\n"
+                                  % (traced / 1024, peak / 1024))
+                for difference in differences[:self.top]:
+                    memory_file.write("%s\n" % (difference))
+        except OSError as error:
+            logging.error("Abandoning the profiling run: %s", error)
+            self.stop()
+            return
+        after = phase_totals()
+        self.summary.append("%5d  %7.3f  " % (self.cycle_number, elapsed) +
+                            "  ".join("%-10.4f" % (after.get(phase, 0.0) -
+                                                   phases.get(phase, 0.0))
+                                      for phase in metrics.PHASES) +
+                            "  %10d  %8d" % (traced / 1024, peak / 1024))
+        self.remaining -= 1
+        if not self.remaining:
+            self.finish()
+
+    def finish(self):
+        """Write the profile and summary, and stop tracing"""
+        try:
+            self.profile.dump_stats(os.path.join(self.run_directory, "profile.pstats"))
+            stream = io.StringIO()
+            pstats.Stats(self.profile, stream=stream).sort_stats("cumulative").print_stats(self.top)
+            with open(os.path.join(self.run_directory, "profile.txt"), "w") as profile_file:
+                profile_file.write(stream.getvalue())
+            with open(os.path.join(self.run_directory, "summary.txt"), "w") as summary_file:
+                summary_file.write("\n".join(self.summary) + "\n")
+        except OSError as error:
+            logging.error("Could not write the profile: %s", error)
+        else:
+            logging.warning("Profile of %d cycle(s) written to %s",
+                            self.cycle_number, self.run_directory)
+        self.stop()
+
+    def stop(self):
+        """End the profiling run, and stop tracing"""
+        self.remaining = 0
+        if self.started_tracing:
+            tracemalloc.stop()
+        self.profile = None
+        self.snapshot = None
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""
+DNS providers: where the records are kept.
+
+A provider lists the A and AAAA records of some hostnames, and applies
+batches of dhplan operations to them. dhdns plans against what
+list_records() returns, and hands each record's operations to apply() as
+one batch.
+
+* dreamhost: the DreamHost API, through an http_access object.
+* memory: records kept in memory, and optionally in a JSON file. It needs
+  no network, so it's useful for testing dhdynupdate, and for benchmarking
+  the planning and execution pipeline at scale.
+
+A provider that can change a record's values in one step sets
+atomic_replace and implements replace(); apply() then sends each record's
+removals and additions together, so there's never a moment with both the
+old and new addresses published, or neither.
+"""
+
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+
+import dhplan
+import http_access
+
+# The comment on the records we add
+COMMENT = "Automated DNS update by dhdynupdate"
+
+# Bump when the file format of the memory provider changes
+FILE_VERSION = 1
+
+class provider():
+    # Can replace() change a record's values atomically?
+    atomic_replace = False
+    # The http_access object, if the provider is reached over HTTP
+    accessor = None
+
+    def list_records(self, api_key, hostnames):
+        """The A and AAAA records of hostnames, as a list of dicts with
+        record, type, value and editable ("1" or "0")"""
+        raise NotImplementedError
+
+    def add_record(self, api_key, record, rtype, value):
+        """Add a record; returns the added record, or None if it wasn't
+        added"""
+        raise NotImplementedError
+
+    def remove_record(self, api_key, record, rtype, value):
+        """Remove a record; returns True if it was removed"""
+        raise NotImplementedError
+
+    def replace(self, api_key, record, rtype, removed, added):
+        """Remove the values in removed and add the values in added, all at
+        once or not at all. Returns the added records, or None if nothing
+        was changed. Only needed with atomic_replace."""
+        raise NotImplementedError
+
+    def apply(self, api_key, operations):
+        """Apply operations (dhplan.dns_operation), in order, yielding an
+        (operation, result) pair as each is done; result is as from
+        add_record() or remove_record(). If a record's add fails, its
+        removals are skipped, so the old record stays until the next
+        update."""
+        plan = dhplan.dhplan()
+        plan.operations = list(operations)
+        for (record, rtype), group in plan.by_record().items():
+            removed = [operation.value for operation in group
+                       if operation.action == dhplan.REMOVE]
+            added = [operation.value for operation in group
+                     if operation.action == dhplan.ADD]
+            if self.atomic_replace and removed and added:
+                logging.info("Replacing DNS entries %s %s: %s -> %s",
+                             record, rtype, removed, added)
+                entries = self.replace(api_key, record, rtype, removed, added)
+                if entries is None:
+                    logging.error("Could not replace entries for %s %s", record, rtype)
+                    for operation in group:
+                        if operation.action == dhplan.ADD:
+                            yield operation, None
+                    continue
+                by_value = dict((entry["value"], entry) for entry in entries)
+                for operation in group:
+                    if operation.action == dhplan.ADD:
+                        yield operation, by_value[operation.value]
+                    else:
+                        yield operation, True
+                continue
+            add_failed = False
+            for operation in group:
+                if operation.action == dhplan.REMOVE:
+                    if add_failed:
+                        logging.warning("Not removing %s %s %s, as its replacement failed",
+                                        operation.record, operation.type, operation.value)
+                        continue
+                    result = self.remove_record(api_key, operation.record,
+                                                operation.type, operation.value)
+                else:
+                    result = self.add_record(api_key, operation.record,
+                                             operation.type, operation.value)
+                    if not result:
+                        add_failed = True
+                yield operation, result
+
+    def flush(self):
+        """Called once the apply() calls of an update have all finished; a
+        provider that writes its records out does it here"""
+
+class dreamhost(provider):
+
+    def __init__(self, accessor):
+        """The DreamHost API, reached through accessor (an http_access).
+        DreamHost can't modify records; they're removed and added."""
+        self.accessor = accessor
+
+    def list_records(self, api_key, hostnames):
+        """The response is parsed as it arrives; records for other
+        hostnames are never kept in memory. If DreamHost refuses,
+        http_access.api_unavailable is raised, so the update is tried
+        again later."""
+        hostnames = frozenset(hostnames)
+        def keep(entry):
+            return (entry.get("record") in hostnames and
+                    entry.get("type") in dhplan.MANAGED_TYPES)
+        request_params = {"key": api_key, "cmd": "dns-list_records", "format": "json"}
+        logging.info("Connecting to DreamHost API to obtain current DNS records")
+        output = self.accessor.request_get(request_params, keep)
+        if output.get("result") != "success":
+            raise http_access.api_unavailable("DreamHost could not list the records: %s"
+                                              % (output.get("data")))
+        return output["data"]
+
+    def add_record(self, api_key, record, rtype, value):
+        request_params = {"key": api_key, "cmd": "dns-add_record",
+                          "record": record, "type": rtype, "value": value,
+                          "comment": COMMENT, "format": "json"}
+        logging.info("Adding DNS entry %s %s %s", record, rtype, value)
+        try:
+            output = self.accessor.request_get(request_params)
+        except http_access.api_unavailable as error:
+            logging.error("Could not update entry for address %s: %s", value, error)
+            return None
+        if output["result"] != "success":
+            logging.error("Could not update entry for address %s", value)
+            return None
+        return {"record": record, "type": rtype, "value": value, "editable": "1"}
+
+    def remove_record(self, api_key, record, rtype, value):
+        # DreamHost only allows record, type and value for deletion
+        request_params = {"key": api_key, "cmd": "dns-remove_record",
+                          "record": record, "type": rtype, "value": value,
+                          "format": "json"}
+        logging.info("Removing DNS entry %s %s %s", record, rtype, value)
+        try:
+            output = self.accessor.request_get(request_params)
+        except http_access.api_unavailable as error:
+            logging.error("Could not remove entry for address %s: %s", value, error)
+            return False
+        if output["result"] != "success":
+            logging.error("Could not remove entry for address %s", value)
+            return False
+        return True
+
+class memory(provider):
+    atomic_replace = True
+
+    def __init__(self, path=None, records=()):
+        """Records kept in memory, starting with records (dicts with
+        record, type, value and editable). With a path, they're loaded from
+        that JSON file if it exists, and written back to it by flush(),
+        once per update.
+
+        The api_key is ignored; every hostname is in the same account."""
+        self.path = path
+        self.lock = threading.Lock()
+        # Have the records changed since they were last written?
+        self.dirty = False
+        # (record, type) -> the records, so listing a few hostnames doesn't
+        # scan the whole account
+        self.records = collections.defaultdict(list)
+        for entry in records:
+            self.records[(entry["record"], entry["type"])].append(dict(entry))
+        if path is not None:
+            self.load()
+
+    def load(self):
+        """Read the records file; a missing file is an empty account"""
+        try:
+            with open(self.path, 'r') as records_file:
+                contents = json.load(records_file)
+        except FileNotFoundError:
+            logging.info("No records file at %s", self.path)
+            return
+        if not isinstance(contents, dict) or contents.get("version") != FILE_VERSION:
+            raise ValueError("%s is not a records file" % (self.path))
+        for entry in contents["records"]:
+            self.records[(entry["record"], entry["type"])].append(entry)
+
+    def save(self):
+        """Atomically write the records file"""
+        with self.lock:
+            self.dirty = False
+            contents = {"version": FILE_VERSION,
+                        "records": [entry for entries in self.records.values()
+                                    for entry in entries]}
+            directory = os.path.dirname(os.path.abspath(self.path))
+            try:
+                fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".dhrecords")
+                try:
+                    with os.fdopen(fd, 'w') as records_file:
+                        json.dump(contents, records_file, sort_keys=True)
+                        records_file.flush()
+                        os.fsync(records_file.fileno())
+                    os.replace(temp_path, self.path)
+                except:
+                    os.unlink(temp_path)
+                    raise
+            except OSError as error:
+                logging.error("Could not write records file %s: %s", self.path, error)
+
+    def list_records(self, api_key, hostnames):
+        with self.lock:
+            return [dict(entry) for hostname in set(hostnames)
+                    for rtype in dhplan.MANAGED_TYPES
+                    for entry in self.records.get((hostname, rtype), ())]
+
+    def find(self, record, rtype, value):
+        """The record with value, or None; call with the lock held"""
+        for entry in self.records.get((record, rtype), ()):
+            if entry["value"] == value:
+                return entry
+        return None
+
+    def add_record(self, api_key, record, rtype, value):
+        with self.lock:
+            return self.add(record, rtype, [value])[0]
+
+    def remove_record(self, api_key, record, rtype, value):
+        with self.lock:
+            return self.remove(record, rtype, [value])
+
+    def replace(self, api_key, record, rtype, removed, added):
+        with self.lock:
+            if not self.removable(record, rtype, removed) or \
+               not self.addable(record, rtype, added):
+                return None
+            self.remove(record, rtype, removed)
+            return self.add(record, rtype, added)
+
+    def addable(self, record, rtype, values):
+        return all(self.find(record, rtype, value) is None for value in values)
+
+    def removable(self, record, rtype, values):
+        for value in values:
+            entry = self.find(record, rtype, value)
+            if entry is None or entry["editable"] != "1":
+                return False
+        return True
+
+    def add(self, record, rtype, values):
+        """Add records for values; returns the added records, or [None] if
+        any of them already exists. Call with the lock held."""
+        if not self.addable(record, rtype, values):
+            logging.error("Could not add %s %s %s: it already exists",
+                          record, rtype, values)
+            return [None]
+        self.dirty = True
+        entries = []
+        for value in values:
+            entry = {"record": record, "type": rtype, "value": value,
+                     "editable": "1", "comment": COMMENT}
+            self.records[(record, rtype)].append(entry)
+            entries.append({key: entry[key]
+                            for key in ("record", "type", "value", "editable")})
+        return entries
+
+    def remove(self, record, rtype, values):
+        """Remove the (editable) records for values; returns False if any of
+        them can't be removed. Call with the lock held."""
+        if not self.removable(record, rtype, values):
+            logging.error("Could not remove %s %s %s", record, rtype, values)
+            return False
+        self.dirty = True
+        self.records[(record, rtype)] = [entry for entry in self.records[(record, rtype)]
+                                         if entry["value"] not in values]
+        if not self.records[(record, rtype)]:
+            del self.records[(record, rtype)]
+        return True
+
+    def flush(self):
+        if self.path is not None and self.dirty:
+            self.save()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Adaptive polling schedule.
+
+Each address source (the local interfaces, and the external lookup) and each
+hostname's DreamHost check is a task with its own interval. When a task
+runs and finds nothing changed, its interval grows by backoff, up to
+max_interval; when it finds a change, it drops back to the minimum. Every
+run is moved by up to +/- jitter (a fraction of the interval), so machines
+started together -- and hostnames checked by the same machine -- drift
+apart rather than all hitting DreamHost or the lookup services at once.
+
+Times are wall clock (time.time()), so a task can be scheduled from a time
+saved in the state file.
+"""
+
+import collections
+import logging
+import metrics
+import random
+import time
+
+DEFAULT_BACKOFF = 2.0
+DEFAULT_JITTER = 0.1
+
+class task():
+
+    def __init__(self, name, interval, max_interval=None,
+                 backoff=DEFAULT_BACKOFF, jitter=DEFAULT_JITTER, last_run=None):
+        """A task run every interval seconds, backing off to max_interval
+        (by default, interval; ie. no backoff). If last_run is given, the
+        first run is an interval after it; otherwise it's due now."""
+        self.name = name
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval or interval)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = interval
+        if last_run is None:
+            self.next_run = time.time()
+        else:
+            self.next_run = last_run + self.jittered()
+        metrics.next_run.set(self.name, value=self.next_run)
+
+    def jittered(self):
+        """The current interval, moved by up to +/- jitter"""
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.next_run
+
+    def remaining(self, now=None):
+        """Seconds until the task is due"""
+        if now is None:
+            now = time.time()
+        return max(0.0, self.next_run - now)
+
+    def done(self, changed, now=None):
+        """The task has run, and found a change (or not); schedule its next
+        run"""
+        if now is None:
+            now = time.time()
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        self.next_run = now + self.jittered()
+        metrics.next_run.set(self.name, value=self.next_run)
+        logging.debug("Next %s run in %.0fs", self.name, self.next_run - now)
+
+class scheduler():
+
+    def __init__(self, backoff=DEFAULT_BACKOFF, jitter=DEFAULT_JITTER):
+        """backoff and jitter are used by the tasks created by schedule()"""
+        self.backoff = backoff
+        self.jitter = jitter
+        self.tasks = collections.OrderedDict()
+
+    def add(self, new_task):
+        """Add (or replace) a task; returns it"""
+        self.tasks[new_task.name] = new_task
+        return new_task
+
+    def schedule(self, name, interval, max_interval=None, last_run=None):
+        """Add a task with our backoff and jitter; returns it"""
+        return self.add(task(name, interval, max_interval, self.backoff,
+                             self.jitter, last_run))
+
+    def get(self, name):
+        """The task called name, or None"""
+        return self.tasks.get(name)
+
+    def due(self, name, now=None):
+        """Is the task called name due? Tasks that don't exist always are."""
+        scheduled = self.tasks.get(name)
+        return scheduled is None or scheduled.due(now)
+
+    def done(self, name, changed, now=None):
+        scheduled = self.tasks.get(name)
+        if scheduled is not None:
+            scheduled.done(changed, now)
+
+    def wait_time(self, now=None):
+        """Seconds until the next task is due, or None without tasks"""
+        if not self.tasks:
+            return None
+        if now is None:
+            now = time.time()
+        return min(scheduled.remaining(now) for scheduled in self.tasks.values())
+
+    def next_runs(self):
+        """(name, next run time, current interval) for every task, soonest
+        first"""
+        return sorted(((scheduled.name, scheduled.next_run, scheduled.interval)
+                       for scheduled in self.tasks.values()),
+                      key=lambda run: run[1])
+
+    def __str__(self):
+        now = time.time()
+        return "\n".join("%-30s in %6.0fs (every %.0fs)"
+                         % (name, next_run - now, interval)
+                         for name, next_run, interval in self.next_runs())
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Persistent state, so a restart doesn't have to treat every address as new.
+
+For each hostname we store the addresses last published to DreamHost, the
+DreamHost records we last knew about for it, and when we last did a full
+reconcile (a dns-list_records).  The file is JSON; it's written to a
+temporary file and renamed over the old one, so a crash never leaves a
+partial state file behind.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+# Bump when the file format changes; older state files are discarded.
+STATE_VERSION = 1
+
+class dhstate():
+
+    def __init__(self, path):
+        """Load the state file at path, if it exists"""
+        self.path = path
+        self.hosts = {}
+        self.load()
+
+    def load(self):
+        """Read the state file; an unreadable or outdated file is ignored,
+        which just means a full reconcile happens"""
+        try:
+            with open(self.path, 'r') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            logging.info("No state file at %s", self.path)
+            return
+        except (OSError, ValueError) as error:
+            logging.warning("Could not read state file %s: %s", self.path, error)
+            return
+        if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+            logging.warning("Ignoring state file %s with unknown version", self.path)
+            return
+        self.hosts = state.get("hosts", {})
+
+    def get(self, hostname):
+        """Returns the stored state for hostname, or None"""
+        return self.hosts.get(hostname)
+
+    def update(self, hostname, addresses, records, last_reconcile):
+        """Store the state for hostname; call save() to write it out"""
+        self.hosts[hostname] = {
+            "addresses": [address.compressed for address in addresses],
+            "records": records,
+            "last_reconcile": last_reconcile,
+        }
+
+    def save(self):
+        """Atomically write the state file"""
+        state = {"version": STATE_VERSION, "hosts": self.hosts}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".dhstate")
+            try:
+                with os.fdopen(fd, 'w') as state_file:
+                    json.dump(state, state_file, sort_keys=True)
+                    state_file.flush()
+                    os.fsync(state_file.fileno())
+                os.replace(temp_path, self.path)
+            except:
+                os.unlink(temp_path)
+                raise
+        except OSError as error:
+            logging.error("Could not write state file %s: %s", self.path, error)
+
+# vim: ts=4 sw=4 et
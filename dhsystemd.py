@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Tells systemd how we're doing, for services with Type=notify. See
+[sd_notify(3)](https://www.freedesktop.org/software/systemd/man/sd_notify.html)
+
+Only the datagram protocol is implemented, so libsystemd isn't needed. When
+we're not started by systemd (NOTIFY_SOCKET isn't set), notify() does
+nothing.
+
+The main loop sends WATCHDOG=1 between cycles. A cycle can legitimately
+take longer than WatchdogSec (a rate limited fleet, an API request being
+retried), so the places where it waits call alive() too.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+# When alive() last sent WATCHDOG=1
+_last_alive = 0.0
+_alive_lock = threading.Lock()
+
+def notify(*states):
+    """Send states (ie. "READY=1", "WATCHDOG=1") to systemd. Returns False
+    if there's nobody to tell, or the message couldn't be sent."""
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return False
+    # A leading "@" is a socket in the abstract namespace
+    if path.startswith("@"):
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto("\n".join(states).encode("utf-8"), path)
+    except OSError as error:
+        logging.debug("Could not notify systemd: %s", error)
+        return False
+    return True
+
+def watchdog_interval():
+    """How often (in seconds) to send WATCHDOG=1 -- half of WatchdogSec --
+    or None if the watchdog isn't enabled for us"""
+    try:
+        usec = int(os.environ.get("WATCHDOG_USEC", ""))
+    except ValueError:
+        return None
+    watchdog_pid = os.environ.get("WATCHDOG_PID")
+    if usec <= 0 or (watchdog_pid and watchdog_pid != str(os.getpid())):
+        return None
+    return usec / 2000000.0
+
+def alive():
+    """Send WATCHDOG=1 from the middle of an update, at most twice per
+    watchdog interval; safe to call from any thread"""
+    global _last_alive
+    interval = watchdog_interval()
+    if interval is None:
+        return
+    now = time.monotonic()
+    with _alive_lock:
+        if now - _last_alive < interval / 2:
+            return
+        _last_alive = now
+    notify("WATCHDOG=1")
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""
+Checks that DNS updates have reached the nameservers.
+
+After DreamHost has accepted an update, the hostname's A and AAAA records
+are queried directly from each configured nameserver -- with hand built
+DNS queries over UDP (or TCP), so no resolver or cache gets in the way --
+until every nameserver answers with the published addresses. The queries
+to all the nameservers are sent in parallel, and repeated with exponential
+backoff. The time it took is recorded per hostname, in the
+dhdynupdate_propagation_seconds metric.
+
+Verification runs in the background, so it never holds up an update.
+"""
+
+import concurrent.futures
+import ipaddress
+import logging
+import metrics
+import random
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_MAX_WAIT = 600.0
+DEFAULT_FIRST_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+DEFAULT_BACKOFF = 2.0
+DNS_PORT = 53
+
+QTYPES = {"A": 1, "AAAA": 28}
+CLASS_IN = 1
+# Header flag bits
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+RCODE_MASK = 0x000f
+RCODE_NXDOMAIN = 3
+
+def parse_nameserver(nameserver):
+    """"host", "host:port" or "[v6 address]:port" -> (host, port)"""
+    if nameserver.startswith("["):
+        host, _, port = nameserver[1:].partition("]")
+        return host, int(port.lstrip(":") or DNS_PORT)
+    if nameserver.count(":") == 1:
+        host, port = nameserver.split(":")
+        return host, int(port)
+    return nameserver, DNS_PORT
+
+def build_query(query_id, hostname, rtype):
+    """A DNS query for the rtype records of hostname. Recursion isn't
+    asked for: the nameservers are expected to be authoritative."""
+    question = b""
+    for label in hostname.rstrip(".").split("."):
+        encoded = label.encode("idna")
+        question += bytes([len(encoded)]) + encoded
+    question += b"\0" + struct.pack("!HH", QTYPES[rtype], CLASS_IN)
+    return struct.pack("!HHHHHH", query_id, 0, 1, 0, 0, 0) + question
+
+def skip_name(message, offset):
+    """The offset just after the (possibly compressed) name at offset"""
+    while True:
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            # A pointer ends the name
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+def parse_response(message, query_id, rtype):
+    """The set of rtype addresses in a DNS response. Raises ValueError if
+    it isn't a usable answer to query query_id; returns None if it was
+    truncated."""
+    try:
+        response_id, flags, qdcount, ancount, nscount, arcount = \
+            struct.unpack_from("!HHHHHH", message)
+        if response_id != query_id or not flags & FLAG_QR:
+            raise ValueError("Not a response to our query")
+        if flags & FLAG_TC:
+            return None
+        rcode = flags & RCODE_MASK
+        if rcode == RCODE_NXDOMAIN:
+            return set()
+        if rcode != 0:
+            raise ValueError("Nameserver returned error %d" % (rcode))
+        offset = 12
+        for index in range(qdcount):
+            offset = skip_name(message, offset) + 4
+        addresses = set()
+        for index in range(ancount):
+            offset = skip_name(message, offset)
+            answer_type, answer_class, ttl, length = struct.unpack_from("!HHIH", message, offset)
+            offset += 10
+            if answer_type == QTYPES[rtype] and answer_class == CLASS_IN:
+                addresses.add(ipaddress.ip_address(message[offset:offset + length]))
+            offset += length
+    except (struct.error, IndexError) as error:
+        raise ValueError("Malformed DNS response: %s" % (error))
+    return addresses
+
+def query(nameserver, hostname, rtype, timeout=DEFAULT_TIMEOUT, protocol="udp"):
+    """Ask nameserver ("host[:port]") for the rtype records of hostname;
+    returns a set of ipaddress objects. A truncated UDP answer is asked
+    again over TCP. Raises OSError or ValueError on failure."""
+    host, port = parse_nameserver(nameserver)
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    query_id = random.randrange(0x10000)
+    message = build_query(query_id, hostname, rtype)
+    if protocol == "udp":
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect((host, port))
+            sock.send(message)
+            deadline = time.monotonic() + timeout
+            while True:
+                # Ignore stray datagrams that aren't our answer
+                try:
+                    addresses = parse_response(sock.recv(65535), query_id, rtype)
+                    break
+                except ValueError:
+                    if time.monotonic() >= deadline:
+                        raise
+        if addresses is not None:
+            return addresses
+    with socket.create_connection((host, port), timeout) as sock:
+        sock.sendall(struct.pack("!H", len(message)) + message)
+        length = struct.unpack("!H", recv_exactly(sock, 2))[0]
+        addresses = parse_response(recv_exactly(sock, length), query_id, rtype)
+    if addresses is None:
+        raise ValueError("Truncated DNS response over TCP")
+    return addresses
+
+def recv_exactly(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ValueError("Nameserver closed the connection")
+        data += chunk
+    return data
+
+class verifier():
+
+    def __init__(self, nameservers, timeout=DEFAULT_TIMEOUT,
+                 max_wait=DEFAULT_MAX_WAIT, first_delay=DEFAULT_FIRST_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, backoff=DEFAULT_BACKOFF,
+                 protocol="udp"):
+        """Verify updates against nameservers (a list of "host[:port]").
+        Each round of queries waits up to timeout seconds; rounds are
+        first_delay seconds apart at first, growing by backoff up to
+        max_delay, and verification gives up after max_wait seconds."""
+        if protocol not in ("udp", "tcp"):
+            raise ValueError("verify_protocol must be one of udp, tcp")
+        self.nameservers = list(nameservers)
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.protocol = protocol
+        self.pool = None
+        self.query_pool = None
+        self.pool_lock = threading.Lock()
+
+    def matches(self, nameserver, hostname, expected):
+        """Does nameserver serve exactly the expected addresses (a dict of
+        rtype: set of addresses)?"""
+        for rtype, addresses in expected.items():
+            try:
+                answer = query(nameserver, hostname, rtype, self.timeout, self.protocol)
+            except (OSError, ValueError) as error:
+                logging.debug("DNS query for %s %s to %s failed: %s",
+                              hostname, rtype, nameserver, error)
+                return False
+            if answer != addresses:
+                return False
+        return True
+
+    def verify(self, hostname, addresses, start=None):
+        """Wait until every nameserver serves addresses for hostname.
+        Returns the seconds it took, or None if it didn't happen within
+        max_wait. The time is counted from start (a time.monotonic()
+        value), by default now."""
+        expected = {}
+        for address in addresses:
+            expected.setdefault("A" if address.version == 4 else "AAAA",
+                                set()).add(address)
+        if start is None:
+            start = time.monotonic()
+        pending = list(self.nameservers)
+        delay = self.first_delay
+        while True:
+            futures = [(nameserver, self.query_pool.submit(self.matches, nameserver,
+                                                           hostname, expected))
+                       for nameserver in pending]
+            pending = [nameserver for nameserver, future in futures
+                       if not future.result()]
+            elapsed = time.monotonic() - start
+            if not pending:
+                break
+            if elapsed + delay > self.max_wait:
+                logging.warning("%s hasn't reached %s after %.0fs",
+                                hostname, ", ".join(pending), elapsed)
+                return None
+            time.sleep(delay)
+            delay = min(delay * self.backoff, self.max_delay)
+        metrics.propagation_seconds.observe(hostname, value=elapsed)
+        logging.info("%s propagated to %d nameserver(s) in %.1fs",
+                     hostname, len(self.nameservers), elapsed)
+        return elapsed
+
+    def submit(self, hostname, addresses):
+        """Verify in the background; returns a Future of verify()'s
+        result. A newer update of hostname doesn't wait for the previous
+        verification, which just finishes (or times out) on its own. The
+        time is counted from now, including any wait for a free worker."""
+        start = time.monotonic()
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(
+                                max_workers=4, thread_name_prefix="verify")
+                self.query_pool = concurrent.futures.ThreadPoolExecutor(
+                                      max_workers=4 * max(1, len(self.nameservers)),
+                                      thread_name_prefix="dnsquery")
+        return self.pool.submit(self.verify, hostname, list(addresses), start)
+
+    def shutdown(self):
+        for pool in (self.pool, self.query_pool):
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+# vim: ts=4 sw=4 et
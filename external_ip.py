@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Looks up our external addresses using "what is my IP" echo services.
+
+Used for the special "-ipify.org" interface. Several providers can be
+configured for each address family; the lookup is hedged: the first
+provider is asked, and if it hasn't answered within hedge_delay (or has
+failed), the next one is asked too, and so on. The first valid answer wins
+-- or, with a quorum greater than 1, the first answer that enough providers
+agree on. IPv4 and IPv6 are looked up in parallel, every request has a
+timeout, and answers are cached for cache_ttl seconds.
+"""
+
+import collections
+import concurrent.futures
+import ipaddress
+import logging
+import threading
+import time
+
+DEFAULT_PROVIDERS = {
+    "AF_INET": ["https://api.ipify.org", "https://ipv4.icanhazip.com",
+                "https://v4.ident.me"],
+    "AF_INET6": ["https://api6.ipify.org", "https://ipv6.icanhazip.com",
+                 "https://v6.ident.me"],
+}
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_HEDGE_DELAY = 0.25
+DEFAULT_CACHE_TTL = 60.0
+DEFAULT_QUORUM = 1
+
+VERSIONS = {"AF_INET": 4, "AF_INET6": 6}
+
+class external_ip():
+
+    def __init__(self, providers=None, timeout=DEFAULT_TIMEOUT,
+                 hedge_delay=DEFAULT_HEDGE_DELAY, cache_ttl=DEFAULT_CACHE_TTL,
+                 quorum=DEFAULT_QUORUM):
+        """providers maps "AF_INET"/"AF_INET6" to a list of URLs that return
+        the caller's address as plain text"""
+        self.providers = dict(DEFAULT_PROVIDERS)
+        if providers:
+            self.providers.update(providers)
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.cache_ttl = cache_ttl
+        self.quorum = max(1, quorum)
+        # addr_type -> (address, expiry time)
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.pool = None
+
+    def lookup(self, addr_types):
+        """Look up the external address for each addr_type in parallel.
+        Returns a dict of addr_type -> ipaddress address, or None if no
+        answer could be had."""
+        if self.pool is None:
+            workers = sum(len(urls) for urls in self.providers.values()) + len(self.providers)
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix="external_ip")
+        futures = {addr_type: self.pool.submit(self.lookup_family, addr_type)
+                   for addr_type in addr_types}
+        return {addr_type: future.result() for addr_type, future in futures.items()}
+
+    def lookup_family(self, addr_type):
+        """Look up the external addr_type address, hedging across the
+        configured providers"""
+        now = time.monotonic()
+        with self.cache_lock:
+            cached = self.cache.get(addr_type)
+        if cached is not None and cached[1] > now:
+            logging.debug("Using cached external %s address %s", addr_type, cached[0])
+            return cached[0]
+
+        providers = list(self.providers.get(addr_type, []))
+        deadline = now + self.timeout
+        answers = collections.Counter()
+        pending = set()
+        next_provider = 0
+        address = None
+        while address is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Start another provider if there's nothing in flight, or the
+            # ones in flight are slow.
+            if next_provider < len(providers):
+                pending.add(self.pool.submit(self.ask_provider, addr_type,
+                                             providers[next_provider], remaining))
+                next_provider += 1
+            elif not pending:
+                break
+            if next_provider < len(providers):
+                wait_time = min(self.hedge_delay, remaining)
+            else:
+                wait_time = remaining
+            done, pending = concurrent.futures.wait(
+                                pending, timeout=wait_time,
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                answer = future.result()
+                if answer is None:
+                    continue
+                answers[answer] += 1
+                if answers[answer] >= self.quorum:
+                    address = answer
+                    break
+            # A failed provider is replaced right away, rather than after
+            # hedge_delay; the loop starts the next one.
+
+        if address is None:
+            logging.warning("External %s address lookup failed (answers: %s)",
+                            addr_type, dict(answers))
+            return None
+        with self.cache_lock:
+            self.cache[addr_type] = (address, time.monotonic() + self.cache_ttl)
+        return address
+
+    def ask_provider(self, addr_type, url, timeout):
+        """Ask one provider for our address; returns None if it fails or
+        gives a bad answer"""
+        import requests
+        try:
+            response = requests.get(url, timeout=timeout)
+            response.raise_for_status()
+            address = ipaddress.ip_address(response.text.strip())
+        except (requests.exceptions.RequestException, ValueError) as exception:
+            logging.info("External address lookup from %s failed: %s", url, exception)
+            return None
+        # Reject answers that can't be our external address
+        if address.version != VERSIONS[addr_type] or not address.is_global:
+            logging.warning("Ignoring bad %s address %s from %s", addr_type, address, url)
+            return None
+        return address
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+# vim: ts=4 sw=4 et
@@ -28,45 +28,338 @@
 # those of the authors and should not be interpreted as representing official
 # policies, either expressed or implied.
 
+import breaker
+import codecs
+import collections
+import dhsystemd
 import json
 import logging
-import requests
-import sys
+import metrics
+import random
+import ratelimit
+import threading
+import time
 import uuid
 
+# Default number of pooled connections kept per API URL
+DEFAULT_POOL_SIZE = 10
+
+# How requests time out and are retried, and when the endpoint's circuit
+# breaker opens (see request_get() and the breaker module). Timeouts and
+# backoffs are in seconds.
+retry_policy = collections.namedtuple("retry_policy",
+                                      ["connect_timeout", "read_timeout",
+                                       "retries", "backoff", "max_backoff",
+                                       "breaker_threshold", "breaker_reset",
+                                       "deadline"])
+# The deadline bounds a request, retries and all; it's kept under half of
+# the systemd unit's WatchdogSec (120s).
+DEFAULT_RETRY_POLICY = retry_policy(connect_timeout=5.0, read_timeout=30.0,
+                                    retries=3, backoff=1.0, max_backoff=30.0,
+                                    breaker_threshold=5, breaker_reset=60.0,
+                                    deadline=45.0)
+
+class api_unavailable(Exception):
+    """DreamHost couldn't be reached: the retries ran out, or the circuit
+    breaker is open. Nothing was changed by the request, or it's safe to
+    send again."""
+# Bytes read at a time when streaming a response
+STREAM_CHUNK_SIZE = 65536
+
+# One requests.Session per API URL, shared by every http_access object, so
+# connections (and TLS sessions) are kept alive between requests.
+# requests is imported when the first session is created; it's slow to
+# import, and isn't needed by every invocation.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(api_url, pool_size=DEFAULT_POOL_SIZE):
+    """Return the pooled, keep-alive session for api_url, creating it if
+    needed"""
+    with _sessions_lock:
+        session = _sessions.get(api_url)
+        if session is None:
+            import requests
+            import requests.adapters
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size)
+            session.mount(api_url, adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate",
+                                    "Connection": "keep-alive"})
+            _sessions[api_url] = session
+        return session
+
+def close_sessions():
+    """Close all pooled sessions"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+class _json_stream():
+    """Incremental reader for a JSON document arriving in chunks"""
+
+    whitespace = " \t\r\n"
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read another chunk; returns False at the end of the document"""
+        if self.eof:
+            return False
+        # Drop what we've already parsed, so memory use is bounded by the
+        # size of one item, rather than the size of the document.
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        try:
+            self.buffer += next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        return True
+
+    def peek(self):
+        """Skip whitespace, and return the next character ("" at the end)"""
+        while True:
+            while self.pos < len(self.buffer) and \
+                  self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, characters):
+        """Consume the next character, which must be one of characters"""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of %r at offset %d in JSON response"
+                             % (characters, self.pos))
+        self.pos += 1
+        return character
+
+    def value(self):
+        """Decode the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer might continue in the
+                # next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+def parse_json_stream(chunks, keep, list_key="data"):
+    """Parse a JSON object from an iterable of text chunks. The items of the
+    list under list_key are parsed one at a time, and only those for which
+    keep(item) is true are kept; everything else is decoded normally."""
+    stream = _json_stream(chunks)
+    result = {}
+    stream.expect("{")
+    if stream.peek() == "}":
+        return result
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if key == list_key and stream.peek() == "[":
+            stream.expect("[")
+            items = []
+            if stream.peek() != "]":
+                while True:
+                    item = stream.value()
+                    if keep(item):
+                        items.append(item)
+                    if stream.expect(",]") == "]":
+                        break
+            else:
+                stream.expect("]")
+            result[key] = items
+        else:
+            result[key] = stream.value()
+        if stream.expect(",}") == "}":
+            return result
+
+def _iter_text(response):
+    """Yield the (decompressed) body of a streamed response as text"""
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
 class http_access():
     # Initialize...
-    def __init__(self, api_url):
-        """Initialize HTTP(S) Goo"""
+    def __init__(self, api_url, pool_size=DEFAULT_POOL_SIZE,
+                 requests_per_minute=0, burst=1, policy=None):
+        """Initialize HTTP(S) Goo
+
+        Requests are limited to requests_per_minute (0 for no limit) per
+        api_key, with bursts of up to burst requests. policy is the
+        retry_policy; by default, DEFAULT_RETRY_POLICY."""
         self.api_url = api_url
+        self.pool_size = pool_size
+        self.rate = requests_per_minute / 60.0
+        self.burst = burst
+        self.policy = policy or DEFAULT_RETRY_POLICY
+
+    def set_rate_limit(self, requests_per_minute, burst):
+        """Change the rate limit; buckets already in use are replaced"""
+        rate = requests_per_minute / 60.0
+        if (rate, burst) != (self.rate, self.burst):
+            ratelimit.forget()
+        self.rate = rate
+        self.burst = burst
+
+    def set_retry_policy(self, policy):
+        self.policy = policy or DEFAULT_RETRY_POLICY
+
+    @property
+    def breaker(self):
+        """The circuit breaker shared by every request to our API URL"""
+        return breaker.get_breaker(self.api_url, self.policy.breaker_threshold,
+                                   self.policy.breaker_reset)
+
+    @property
+    def session(self):
+        """The pooled session for our API URL; created on first use, so a
+        run that doesn't talk to DreamHost never loads requests."""
+        return get_session(self.api_url, self.pool_size)
+
+    def request_get(self, request_params, keep=None):
+        """HTTP(S) GET Request
+
+        If keep is given, the response is parsed as it's received, and only
+        the items of its "data" list for which keep(item) is true are kept.
+        This keeps large responses (ie. dns-list_records) from being held in
+        memory all at once.
 
-    def request_get(self, request_params):
-        """HTTP(S) GET Request"""
+        Timeouts, connection errors, server errors (HTTP 5xx and 429) and
+        garbled responses are retried, up to policy.retries times, with
+        exponential backoff and jitter, as long as policy.deadline seconds
+        haven't passed since the first attempt. Every attempt sends the same
+        unique_id, so DreamHost carries out the request at most once, however
+        many times it's sent. If every attempt fails, or the circuit breaker
+        is open, api_unavailable is raised."""
+        # Requests is loaded by the session; it's needed for its exceptions
+        import requests
         # Use a UUID to ensure our request is unique, only processed once.
         request_params["unique_id"]=str(uuid.uuid4())
-        try:
-            dreamhost_response = requests.get(self.api_url, params=request_params)
-        except:
-            logging.critical("Unexpected error:", sys.exc_info()[0])
-            print("Unexpected error:", sys.exc_info()[0])
-            message="Could not contact host %(api_url)s.  Exiting"
-            print(message)
-            logging.critical(message)
-            raise
-            sys.exit(8)
-        dreamhost_response.close()
-        logging.debug("API URL:" + self.api_url)
-        logging.debug(dreamhost_response.request.headers)
-        logging.debug(dreamhost_response.request.url)
-        response_json = dreamhost_response.json()
+        cmd = request_params.get("cmd", "")
+        policy = self.policy
+        circuit = self.breaker
+        if not circuit.allow():
+            raise api_unavailable("DreamHost API %s is unavailable; next try in %.0fs"
+                                  % (self.api_url, circuit.remaining()))
+        deadline = None
+        for attempt in range(policy.retries + 1):
+            if attempt and circuit.is_open():
+                # Other requests have found DreamHost down; stop retrying
+                raise api_unavailable("DreamHost API %s is unavailable" % (self.api_url))
+            ratelimit.acquire(request_params.get("key"), self.rate, self.burst)
+            # However long the cycle takes, each request keeps the watchdog fed
+            dhsystemd.alive()
+            if deadline is None:
+                deadline = time.monotonic() + policy.deadline
+            # No attempt may run past the deadline
+            remaining = max(0.1, deadline - time.monotonic())
+            timeout = (min(policy.connect_timeout, remaining),
+                       min(policy.read_timeout, remaining))
+            start = time.perf_counter()
+            try:
+                dreamhost_response, response_json = self.send(request_params, keep,
+                                                              timeout)
+            except (requests.RequestException, ValueError) as error:
+                metrics.api_request_seconds.observe(cmd, value=time.perf_counter() - start)
+                # Full jitter: anywhere up to the exponential backoff
+                delay = random.uniform(0, min(policy.max_backoff,
+                                              policy.backoff * 2 ** attempt))
+                if attempt == policy.retries or time.monotonic() + delay >= deadline:
+                    # Only requests that fail every attempt count towards
+                    # opening the breaker, so a flaky connection doesn't.
+                    circuit.failure()
+                    raise api_unavailable("Could not contact DreamHost API %s: %s"
+                                          % (self.api_url, describe_error(error))) from error
+                logging.warning("DreamHost API request %s failed (%s); retrying in %.1fs",
+                                cmd, describe_error(error), delay)
+                metrics.api_retries.inc(cmd)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # Not a sign DreamHost is down, but don't leave a half-open
+                # breaker waiting for this probe
+                circuit.release()
+                raise
+            metrics.api_request_seconds.observe(cmd, value=time.perf_counter() - start)
+            circuit.success()
+            break
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("API URL: %s", self.api_url)
+            logging.debug(dreamhost_response.request.headers)
+            logging.debug("API request: %s", redact(request_params))
         if response_json["result"] != "success":
-            logging.error("DreamHost did not complete the request: %s"
-                          % (request_params))
-        else:
-            logging.info("Successful Request:  %s, %s"
-                          % (response_json["result"],
-                            (json.dumps(dreamhost_response.json(),
-                            sort_keys=True, indent=4))))
+            logging.error("DreamHost did not complete the request: %s",
+                          redact(request_params))
+        elif logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Successful Request:  %s, %s",
+                          response_json["result"],
+                            (json.dumps(response_json,
+                            sort_keys=True, indent=4)))
         return response_json
 
+    def send(self, request_params, keep=None, timeout=None):
+        """Send one request; returns the response and its parsed JSON. Raises
+        requests.RequestException (or ValueError, for a garbled response) if
+        it should be retried. timeout is (connect, read) in seconds; by
+        default, the policy's."""
+        if timeout is None:
+            timeout = (self.policy.connect_timeout, self.policy.read_timeout)
+        if keep is None:
+            dreamhost_response = self.session.get(self.api_url, params=request_params,
+                                                  timeout=timeout)
+            check_status(dreamhost_response)
+            # Reading the whole body returns the connection to the pool.
+            return dreamhost_response, dreamhost_response.json()
+        dreamhost_response = self.session.get(self.api_url, params=request_params,
+                                              stream=True, timeout=timeout)
+        try:
+            check_status(dreamhost_response)
+            return dreamhost_response, parse_json_stream(_iter_text(dreamhost_response),
+                                                         keep)
+        finally:
+            dreamhost_response.close()
+
+def redact(request_params):
+    """request_params, with the api_key hidden, for logging"""
+    redacted = dict(request_params)
+    if "key" in redacted:
+        redacted["key"] = "********"
+    return redacted
+
+def describe_error(error):
+    """A short description of a failed request; requests' own messages
+    include the URL, and so the api_key"""
+    import requests
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return "HTTP %d" % (error.response.status_code)
+    if isinstance(error, requests.Timeout):
+        return "timed out"
+    if isinstance(error, requests.ConnectionError):
+        return "connection failed"
+    if isinstance(error, requests.RequestException):
+        return error.__class__.__name__
+    return "invalid response: %s" % (error)
+
+def check_status(response):
+    """Raise requests.HTTPError for responses worth retrying"""
+    if response.status_code >= 500 or response.status_code == 429:
+        response.raise_for_status()
+
 # vim: ts=4 sw=4 et
@@ -28,19 +28,27 @@
 # those of the authors and should not be interpreted as representing official
 # policies, either expressed or implied.
 
+import collections
+import external_ip
 import ipaddress
 import logging
-import netifaces
+import metrics
+import netlink
+import socket
 import sys
-import requests
+import time
 
 """
 This module gets the current IPv4 and/or IPv6 addresses of the network
 interfaces provided.
 
-While we could get the full set of interface information using
-netifaces, for this module, we are only interested in one IPv4 and one
-IPv6 address, each having been provided by the configuration
+Every address on the system is read in one snapshot per lookup -- using a
+netlink dump where available (Linux), which also reports whether an address
+is temporary or deprecated, and netifaces otherwise. The addresses of each
+configured interface and family are then filtered by an address_selector.
+The snapshot is kept as plain tuples; if it's the same as last cycle's, the
+previous selection is reused, and the generation counter doesn't change, so
+callers can tell nothing happened without comparing addresses themselves.
 
 See [netifaces documentation](https://pypi.python.org/pypi/netifaces)
 
@@ -49,84 +57,233 @@ information, such as IP addresses.
 
 Technically, interfaces can have multiple IP addresses, but multiple
 addresses is not often the case with home users.
-* This chooses the first address for the interface, which covers the use
-  case of many users who only use one ip address per interface.
+* By default, this chooses the first usable address for the interface,
+  which covers the use case of many users who only use one ip address per
+  interface.
+* With address_selection = all, every address that passes the filters is
+  published, as multiple A/AAAA records.
+
+The special interface "-ipify.org" looks up our external address instead;
+see external_ip.
 
 Also handles the case where an address family isn't used:
 * Not everybody has IPv6.
 * Maybe a user is behind a NAT on IPv4, and is only updating their IPv6
   address in DNS.
 """
+
+# An address on an interface; family is "AF_INET" or "AF_INET6", and address
+# an ipaddress object.
+if_address = collections.namedtuple("if_address",
+                                    ["interface", "family", "address",
+                                     "prefixlen", "flags"])
+
+FAMILY_NAMES = {socket.AF_INET: "AF_INET", socket.AF_INET6: "AF_INET6"}
+
+def interface_names():
+    """The names of the system's network interfaces"""
+    try:
+        return [name for index, name in socket.if_nameindex()]
+    except (OSError, AttributeError):
+        import netifaces
+        return netifaces.interfaces()
+
+def address_snapshot(names):
+    """Every address of the interfaces in names, read all at once. Returns
+    a tuple of (source, snapshot), where source is "netlink" or
+    "netifaces", and snapshot a tuple of (interface, family, address,
+    prefixlen, flags) tuples in the order the system lists them, with the
+    address as a string. It's compact and hashable, so snapshots are cheap
+    to compare."""
+    names = set(names)
+    try:
+        dump = netlink.dump_addresses()
+    except (OSError, AttributeError) as error:
+        logging.debug("Netlink address dump failed, using netifaces: %s", error)
+    else:
+        return "netlink", tuple((name, FAMILY_NAMES[family], address, prefixlen, flags)
+                                for name, family, address, prefixlen, flags in dump
+                                if name in names and family in FAMILY_NAMES)
+
+    import netifaces
+    snapshot = []
+    for name in sorted(names):
+        try:
+            interface_addresses = netifaces.ifaddresses(name)
+        except ValueError as exception:
+            # Interface doesn't exist (anymore)
+            logging.warning("Could not get addresses from interface %s.", name)
+            logging.warning("Exception: %s", exception)
+            continue
+        for family, family_name in ((netifaces.AF_INET, "AF_INET"),
+                                    (netifaces.AF_INET6, "AF_INET6")):
+            for address in interface_addresses.get(family, []):
+                # IPv6 link-local addresses carry a %interface suffix.
+                value = address["addr"].split("%")[0]
+                netmask = address.get("netmask", "")
+                if "/" in netmask:
+                    prefixlen = int(netmask.split("/")[1])
+                elif netmask:
+                    prefixlen = ipaddress.ip_network("0.0.0.0/" + netmask).prefixlen
+                else:
+                    prefixlen = 32 if family_name == "AF_INET" else 128
+                # netifaces doesn't tell us about temporary/deprecated
+                snapshot.append((name, family_name, value, prefixlen, 0))
+    return "netifaces", tuple(snapshot)
+
+class address_selector():
+
+    def __init__(self, selection="first", scope="all", allow=(), deny=(),
+                 include_temporary=False, include_deprecated=False):
+        """Chooses which of an interface's addresses to publish.
+
+        selection is "first" (one address per family) or "all". scope is
+        "all", "global" (globally routable only) or "private" (RFC 1918 and
+        ULA only). allow and deny are lists of networks (CIDR strings); if
+        allow isn't empty, addresses must be in one of them, and must not be
+        in any of deny. Temporary (privacy) and deprecated addresses are
+        skipped unless include_temporary/include_deprecated are set."""
+        if selection not in ("first", "all"):
+            raise ValueError("address_selection must be one of first, all")
+        if scope not in ("all", "global", "private"):
+            raise ValueError("address_scope must be one of all, global, private")
+        self.selection = selection
+        self.scope = scope
+        self.allow = [ipaddress.ip_network(network, strict=False) for network in allow]
+        self.deny = [ipaddress.ip_network(network, strict=False) for network in deny]
+        self.include_temporary = include_temporary
+        self.include_deprecated = include_deprecated
+
+    def usable(self, candidate):
+        """Does candidate (an if_address) pass the filters?"""
+        address = candidate.address
+        # Link-local addresses can't be reached from elsewhere, and
+        # tentative addresses haven't finished duplicate address detection.
+        if address.is_link_local:
+            return False
+        if candidate.flags & (netlink.IFA_F_TENTATIVE | netlink.IFA_F_DADFAILED):
+            return False
+        if candidate.flags & netlink.IFA_F_TEMPORARY and not self.include_temporary:
+            return False
+        if candidate.flags & netlink.IFA_F_DEPRECATED and not self.include_deprecated:
+            return False
+        if self.scope == "global" and not address.is_global:
+            return False
+        if self.scope == "private" and not address.is_private:
+            return False
+        if self.allow and not any(address in network for network in self.allow
+                                  if network.version == address.version):
+            return False
+        if any(address in network for network in self.deny
+               if network.version == address.version):
+            return False
+        return True
+
+    def select(self, candidates):
+        """The addresses (ipaddress objects) to publish from candidates, a
+        list of if_address for one interface and family"""
+        selected = []
+        for candidate in candidates:
+            if not self.usable(candidate) or candidate.address in selected:
+                continue
+            selected.append(candidate.address)
+            if self.selection == "first":
+                break
+        return selected
+
 class interfaces():
 
-    def __init__(self,configured_interfaces):
+    def __init__(self,configured_interfaces, external=None, selector=None):
+        """external is the external_ip object used for "-ipify.org"; one
+        with the default providers is created if needed. selector is the
+        address_selector choosing which addresses to publish; by default,
+        the first usable address of each family.
+
+        generation counts the distinct snapshots seen; it only changes when
+        something about the configured interfaces' addresses has changed."""
+        self.external = external
+        if selector is None:
+            selector = address_selector()
+        self.selector = selector
+        self.generation = 0
+        self.snapshot_key = None
+        # The last external lookup, and which sources ("local",
+        # "external") changed in the last get_if_addresses()
+        self.external_addresses = {}
+        self.changed_sources = set()
+        self.selected = []
+        # The selected addresses of each configured family
+        self.by_family = {}
         self.addresses = self.get_if_addresses(configured_interfaces)
 
-    def get_if_addresses(self, interfaces):
-        """Get IP addresses from configured interfaces"""
+    def get_if_addresses(self, interfaces, refresh_external=True):
+        """Get IP addresses from configured interfaces. If the snapshot is
+        the same as last time, the addresses selected last time are
+        returned as they are. Without refresh_external, the last external
+        lookup is reused, if there's been one."""
+
+        # External lookups are slow, so all families are looked up at once.
+        external_types = [addr_type for addr_type in interfaces
+                          if interfaces[addr_type] == "-ipify.org"]
+        external_addresses = {}
+        if external_types and not refresh_external and \
+           set(external_types) <= set(self.external_addresses):
+            external_addresses = self.external_addresses
+        elif external_types:
+            if self.external is None:
+                self.external = external_ip.external_ip()
+            with metrics.interface_lookup_seconds.time("ipify"):
+                external_addresses = self.external.lookup(external_types)
+
+        # One snapshot of every local address
+        local_interfaces = set(interfaces[addr_type] for addr_type in interfaces
+                               if addr_type not in external_addresses)
+        snapshot = ()
+        if local_interfaces:
+            start = time.perf_counter()
+            source, snapshot = address_snapshot(local_interfaces)
+            metrics.interface_lookup_seconds.observe(source,
+                                                     value=time.perf_counter() - start)
+
+        self.external_addresses = external_addresses
+        snapshot_key = (tuple(interfaces.items()), snapshot,
+                        tuple(sorted(external_addresses.items(), key=str)))
+        self.changed_sources = set()
+        if snapshot_key == self.snapshot_key:
+            logging.debug("Interface addresses unchanged (generation %d)",
+                          self.generation)
+            return self.selected
+        if self.snapshot_key is None or snapshot_key[:2] != self.snapshot_key[:2]:
+            self.changed_sources.add("local")
+        if self.snapshot_key is None or snapshot_key[2] != self.snapshot_key[2]:
+            self.changed_sources.add("external")
+        self.snapshot_key = snapshot_key
+        self.generation += 1
 
         addresses = []
+        by_family = {}
         for addr_type in interfaces:
-            address_retrieved = True
-
-            # Perform special external lookup
-            if interfaces[addr_type] == "-ipify.org":
-                try:
-                    if addr_type == "AF_INET6":
-                        new_address = requests.get('https://api6.ipify.org').text
-                    elif addr_type == "AF_INET":
-                        new_address = requests.get('https://api.ipify.org').text
-                except requests.exceptions.ConnectionError as exception:
-                    logging.warning("External %s address lookup for %s failed."
-                                    % (addr_type, interfaces[addr_type]))
-                    logging.warning("Exception: %s" % (exception))
-                    address_retrieved = False
+            if addr_type in external_addresses:
+                if external_addresses[addr_type] is None:
+                    by_family[addr_type] = []
+                    continue
+                selected = [external_addresses[addr_type]]
             else:
-                # Netifaces has a lookup for address families. The index
-                # number is os-dependent, so we look up the index using the
-                # method provided by netifaces.
-                if addr_type == "AF_INET6":
-                    address_family = netifaces.AF_INET6
-                elif addr_type == "AF_INET":
-                    address_family = netifaces.AF_INET
-                interface_addresses = netifaces.ifaddresses(interfaces[addr_type])
-                try:
-                    if addr_type == "AF_INET6":
-                        # I'm not counting on IPv6 to only have one address;
-                        # mulitple is common as there's always link-local in
-                        # addition to an internet-routable address.
-                        # Make sure we don't get a link-local IPv6 Address.
-                        # These are in the subnet fe80:://10
-                        for address in interface_addresses[address_family]:
-                            address_retrieved = True
-                            if address["addr"].split(':')[0] != "fe80":
-                                new_address = address["addr"]
-                                break
-                            # We haven't found a non-link-local IPv6 Address
-                            address_retrieved = False
-                    else:
-                        new_address = interface_addresses[address_family][0]["addr"]
-                except ValueError as exception:
-                    # Interface doesn't have an address we could report.
-                    logging.warning("Could not get %s address from interface %s."
-                                    % (addr_type, interfaces[addr_type]))
-                    logging.warning("Exception: %s" % (exception))
-                    address_retrieved = False
-                except KeyError as index:
-                    # Most likely, there is no IP address for the address family
-                    # (ie. no IPv4 or IPv6 address on the interface)
-                    if str(index) == str(address_family):
-                        logging.warning("No %s address is assigned to interface %s." 
-                                        % (addr_type, interfaces[addr_type]))
-                    else:
-                        logging.error("Unknown KeyError %s in finding %s address"
-                                      % (index, addr_type))
-                    address_retrieved = False
-            if address_retrieved:
-                new_address = ipaddress.ip_address(new_address)
+                selected = self.selector.select(
+                    [if_address(name, family, ipaddress.ip_address(address),
+                                prefixlen, flags)
+                     for name, family, address, prefixlen, flags in snapshot
+                     if name == interfaces[addr_type] and family == addr_type])
+                if not selected:
+                    logging.warning("No usable %s address is assigned to interface %s.",
+                                    addr_type, interfaces[addr_type])
+            by_family[addr_type] = selected
+            for new_address in selected:
                 addresses.append(new_address)
-                logging.info("The current %s Address on %s is: %s"
-                             % (addr_type, interfaces[addr_type], new_address))
+                logging.info("The current %s Address on %s is: %s",
+                             addr_type, interfaces[addr_type], new_address)
+        self.selected = addresses
+        self.by_family = by_family
         return addresses
 
 # vim: ts=4 sw=4 et
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Prometheus metrics, served over HTTP in the Prometheus text format.
+
+The metrics are always collected -- it only costs a lock and a few
+additions per event -- but they're only served if metrics_port is set in the
+configuration:
+
+    curl http://127.0.0.1:9405/metrics
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+# Histogram buckets, in seconds; API requests take between a few
+# milliseconds and a few seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=""):
+    """Format label names and values as {name="value",...}"""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class _metric():
+    metric_type = "untyped"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        # label values -> value
+        self.values = {}
+
+    def header(self):
+        return ["# HELP %s %s" % (self.name, self.help_text),
+                "# TYPE %s %s" % (self.name, self.metric_type)]
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name,
+                                          _format_labels(self.label_names, labels),
+                                          _format_value(value)))
+        return lines
+
+    def remove(self, *labels):
+        """Forget the value for labels (ie. a hostname that's gone away)"""
+        with self.lock:
+            self.values.pop(labels, None)
+
+class counter(_metric):
+    metric_type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class gauge(_metric):
+    metric_type = "gauge"
+
+    def set(self, *labels, value):
+        with self.lock:
+            self.values[labels] = value
+
+class histogram(_metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # A count per bucket (plus +Inf), then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        """Context manager observing the time spent in its block"""
+        return _timer(self, labels)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labels, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (
+                        self.name,
+                        _format_labels(self.label_names, labels,
+                                       'le="%s"' % (_format_value(bound))),
+                        cumulative))
+                label_text = _format_labels(self.label_names, labels)
+                lines.append("%s_sum%s %s" % (self.name, label_text,
+                                              _format_value(counts[-1])))
+                lines.append("%s_count%s %d" % (self.name, label_text, cumulative))
+        return lines
+
+class _timer():
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(*self.labels,
+                               value=time.perf_counter() - self.start)
+        return False
+
+class registry():
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics, in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = registry()
+
+api_request_seconds = REGISTRY.register(histogram(
+    "dhdynupdate_api_request_seconds",
+    "Time taken by DreamHost API requests", ["cmd"]))
+interface_lookup_seconds = REGISTRY.register(histogram(
+    "dhdynupdate_interface_lookup_seconds",
+    "Time taken to look up an interface address", ["source"]))
+records_added = REGISTRY.register(counter(
+    "dhdynupdate_records_added_total",
+    "DNS records added", ["type"]))
+records_removed = REGISTRY.register(counter(
+    "dhdynupdate_records_removed_total",
+    "DNS records removed", ["type"]))
+operation_failures = REGISTRY.register(counter(
+    "dhdynupdate_operation_failures_total",
+    "DNS record operations DreamHost refused", ["cmd"]))
+address_changes = REGISTRY.register(counter(
+    "dhdynupdate_address_changes_total",
+    "Address changes detected"))
+last_sync = REGISTRY.register(gauge(
+    "dhdynupdate_last_sync_timestamp_seconds",
+    "When DreamHost was last successfully updated for a hostname", ["hostname"]))
+propagation_seconds = REGISTRY.register(histogram(
+    "dhdynupdate_propagation_seconds",
+    "Time from an update until every verified nameserver served it", ["hostname"],
+    buckets=(1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)))
+next_run = REGISTRY.register(gauge(
+    "dhdynupdate_next_run_timestamp_seconds",
+    "When a polling task (address source or hostname check) next runs", ["task"]))
+
+api_retries = REGISTRY.register(counter(
+    "dhdynupdate_api_retries_total",
+    "DreamHost API requests retried after a timeout or transport error", ["cmd"]))
+api_circuit_state = REGISTRY.register(gauge(
+    "dhdynupdate_api_circuit_state",
+    "DreamHost API circuit breaker state: 0 closed, 1 open, 2 half-open", ["endpoint"]))
+# The phases of an update cycle, timed by phase_seconds
+PHASES = ("discovery", "listing", "planning", "applying")
+phase_seconds = REGISTRY.register(histogram(
+    "dhdynupdate_phase_seconds",
+    "Time spent in each phase of an update cycle: discovery (interface "
+    "lookups), listing (dns-list_records), planning and applying", ["phase"]))
+
+def serve(address, port, metrics_registry=REGISTRY):
+    """Serve the metrics on address:port from a background thread. Returns
+    the server."""
+    # Only imported when metrics are served
+    import http.server
+
+    class _metrics_handler(http.server.BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer((address, port), _metrics_handler)
+    server.daemon_threads = True
+    server.registry = metrics_registry
+    thread = threading.Thread(target=server.serve_forever, daemon=True,
+                              name="metrics")
+    thread.start()
+    logging.info("Serving metrics on http://%s:%d/metrics", *server.server_address[:2])
+    return server
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+A local stand-in for the DreamHost API, for benchmarks and testing.
+
+Implements dns-list_records, dns-add_record and dns-remove_record against an
+in-memory account, with a configurable number of unrelated records (to make
+dns-list_records realistically large), added latency, a random error rate,
+and a random rate of HTTP 503 (unavailable) responses. Two extra commands,
+mock-stats and mock-reset, report and reset the per-command request counts.
+
+    ./mock_dreamhost.py --port 8080 --records 10000 --latency 0.05
+
+then set api_url = http://127.0.0.1:8080/ in dhdynupdate.conf.
+
+With --dns-port, the account's A and AAAA records are also served by a stub
+authoritative nameserver (UDP and TCP), which only sees changes after
+--propagation-delay seconds; point verify_nameservers at it.
+"""
+
+import argparse
+import collections
+import gzip
+import http.server
+import json
+import ipaddress
+import random
+import socketserver
+import struct
+import threading
+import time
+import urllib.parse
+
+# Number of unique_ids remembered, so repeated requests are only done once
+UNIQUE_ID_HISTORY = 100000
+
+class mock_account():
+
+    def __init__(self, record_count=0, zones=100, seed=0):
+        """An account with record_count filler records spread over zones
+        domains"""
+        self.lock = threading.Lock()
+        # (record, type, value) -> record entry
+        self.records = collections.OrderedDict()
+        # (record, type, value) -> (when it was added or removed, added),
+        # for the stub nameserver's propagation delay
+        self.changes = {}
+        self.populate(record_count, zones, seed)
+
+    def populate(self, record_count, zones, seed=0):
+        """Add record_count filler records, in the same shape DreamHost
+        returns them"""
+        rng = random.Random(seed)
+        types = ("A", "AAAA", "CNAME", "MX", "TXT")
+        for index in range(record_count):
+            zone = "zone%d.example.com" % (index % max(1, zones))
+            rtype = types[index % len(types)]
+            if rtype == "A":
+                value = "198.51.%d.%d" % (rng.randrange(256), rng.randrange(1, 255))
+            elif rtype == "AAAA":
+                value = "2001:db8::%x" % (rng.randrange(1, 0xffff))
+            elif rtype == "MX":
+                value = "10 mail.%s" % (zone)
+            else:
+                value = "filler-%d.%s" % (index, zone)
+            self.add("host%d.%s" % (index, zone), rtype, value, zone,
+                     editable="0" if index % 50 == 0 else "1")
+        # Filler records have always been there, as far as the stub
+        # nameserver is concerned
+        with self.lock:
+            self.changes.clear()
+
+    def add(self, record, rtype, value, zone=None, editable="1", comment=""):
+        """Add a record; returns False if it already exists"""
+        if zone is None:
+            zone = record.split(".", 1)[-1]
+        key = (record, rtype, value)
+        with self.lock:
+            if key in self.records:
+                return False
+            self.records[key] = {"account_id": "000000", "zone": zone,
+                                 "record": record, "type": rtype,
+                                 "value": value, "comment": comment,
+                                 "editable": editable}
+            self.changes[key] = (time.monotonic(), True)
+        return True
+
+    def remove(self, record, rtype, value):
+        """Remove an editable record; returns False if there's no such
+        (editable) record"""
+        key = (record, rtype, value)
+        with self.lock:
+            entry = self.records.get(key)
+            if entry is None or entry["editable"] != "1":
+                return False
+            del self.records[key]
+            self.changes[key] = (time.monotonic(), False)
+        return True
+
+    def lookup(self, record, rtype):
+        """The values of the records for record and rtype"""
+        with self.lock:
+            return [entry["value"] for entry in self.records.values()
+                    if entry["record"] == record and entry["type"] == rtype]
+
+    def published(self, record, rtype, delay=0.0):
+        """The values a nameserver would serve for record and rtype, if
+        changes take delay seconds to reach it"""
+        now = time.monotonic()
+        with self.lock:
+            values = [key[2] for key in self.records
+                      if key[0] == record and key[1] == rtype and
+                         now - self.changes.get(key, (0, True))[0] >= delay]
+            # Removed, but the nameserver hasn't heard yet
+            values.extend(key[2] for key, (when, added) in self.changes.items()
+                          if key[0] == record and key[1] == rtype and
+                             not added and now - when < delay)
+        return values
+
+    def listing(self):
+        """A snapshot of every record"""
+        with self.lock:
+            return list(self.records.values())
+
+class mock_handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; don't let Nagle's algorithm
+    # hold the body back.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        cmd = params.get("cmd", "")
+        with server.stats_lock:
+            server.stats[cmd] += 1
+
+        if cmd == "mock-stats":
+            with server.stats_lock:
+                return self.reply({"result": "success", "data": dict(server.stats)})
+        if cmd == "mock-reset":
+            with server.stats_lock:
+                server.stats.clear()
+            return self.reply({"result": "success", "data": ""})
+
+        if random.random() < server.unavailable_rate:
+            # Refused before doing anything, like an overloaded server
+            self.send_error(503)
+            return
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        unique_id = params.get("unique_id")
+        if unique_id is not None:
+            with server.stats_lock:
+                if unique_id in server.unique_ids:
+                    return self.reply(server.unique_ids[unique_id])
+        if random.random() < server.error_rate:
+            response = {"result": "error", "data": "internal_error_updating_zone"}
+        elif not params.get("key"):
+            response = {"result": "error", "data": "no_key"}
+        elif cmd == "dns-list_records":
+            response = {"result": "success", "data": server.account.listing()}
+        elif cmd == "dns-add_record":
+            if server.account.add(params.get("record", ""), params.get("type", ""),
+                                  params.get("value", ""),
+                                  comment=params.get("comment", "")):
+                response = {"result": "success", "data": "record_added"}
+            else:
+                response = {"result": "error", "data": "record_already_exists_not_editable"}
+        elif cmd == "dns-remove_record":
+            if server.account.remove(params.get("record", ""), params.get("type", ""),
+                                     params.get("value", "")):
+                response = {"result": "success", "data": "record_removed"}
+            else:
+                response = {"result": "error", "data": "no_such_record"}
+        else:
+            response = {"result": "error", "data": "unknown_command"}
+        if unique_id is not None:
+            with server.stats_lock:
+                server.unique_ids[unique_id] = response
+                if len(server.unique_ids) > UNIQUE_ID_HISTORY:
+                    server.unique_ids.popitem(last=False)
+        self.reply(response)
+
+    def reply(self, response):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class mock_dns():
+    """A stub authoritative nameserver for an account's A and AAAA records"""
+
+    qtypes = {1: "A", 28: "AAAA"}
+
+    def __init__(self, address=("127.0.0.1", 0), account=None,
+                 propagation_delay=0.0):
+        """Serve account on address, over UDP and TCP; port 0 picks a free
+        port. Changes are only served after propagation_delay seconds."""
+        self.account = account if account is not None else mock_account()
+        self.propagation_delay = propagation_delay
+        self.queries = 0
+        stub = self
+
+        class _udp_handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                sock.sendto(stub.answer(data), self.client_address)
+
+        class _tcp_handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                length = struct.unpack("!H", self.request.recv(2))[0]
+                data = b""
+                while len(data) < length:
+                    data += self.request.recv(length - len(data))
+                response = stub.answer(data)
+                self.request.sendall(struct.pack("!H", len(response)) + response)
+
+        self.udp_server = socketserver.ThreadingUDPServer(address, _udp_handler)
+        self.udp_server.daemon_threads = True
+        self.tcp_server = socketserver.ThreadingTCPServer(
+                              (address[0], self.udp_server.server_address[1]),
+                              _tcp_handler)
+        self.tcp_server.daemon_threads = True
+
+    @property
+    def nameserver(self):
+        return "%s:%d" % self.udp_server.server_address[:2]
+
+    def answer(self, message):
+        """The response to a DNS query"""
+        self.queries += 1
+        query_id, flags = struct.unpack_from("!HH", message)
+        offset = 12
+        labels = []
+        while message[offset]:
+            labels.append(message[offset + 1:offset + 1 + message[offset]].decode("ascii"))
+            offset += 1 + message[offset]
+        qtype, qclass = struct.unpack_from("!HH", message, offset + 1)
+        question = message[12:offset + 5]
+        answers = b""
+        count = 0
+        rtype = self.qtypes.get(qtype)
+        if rtype is not None:
+            for value in self.account.published(".".join(labels), rtype,
+                                                self.propagation_delay):
+                rdata = ipaddress.ip_address(value).packed
+                # The name is a pointer to the question
+                answers += struct.pack("!HHHIH", 0xc00c, qtype, 1, 60, len(rdata)) + rdata
+                count += 1
+        # QR and AA set
+        return struct.pack("!HHHHHH", query_id, 0x8400, 1, count, 0, 0) + question + answers
+
+    def start(self):
+        """Serve from background threads"""
+        for server in (self.udp_server, self.tcp_server):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def close(self):
+        for server in (self.udp_server, self.tcp_server):
+            server.shutdown()
+            server.server_close()
+
+class mock_dreamhost(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), account=None, latency=0.0,
+                 error_rate=0.0, unavailable_rate=0.0):
+        """Serve account (a mock_account) on address; port 0 picks a free
+        port. latency is the mean added delay per request, in seconds.
+        error_rate and unavailable_rate are the fractions of requests
+        answered with an API error, and with HTTP 503."""
+        super().__init__(address, mock_handler)
+        self.account = account if account is not None else mock_account()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unavailable_rate = unavailable_rate
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+        self.unique_ids = collections.OrderedDict()
+
+    @property
+    def api_url(self):
+        return "http://%s:%d/" % self.server_address[:2]
+
+    def start(self):
+        """Serve from a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+def main(argv=None):
+    cmd_parser = argparse.ArgumentParser(description="Mock DreamHost API server")
+    cmd_parser.add_argument("--address", default="127.0.0.1",
+                            help="Address to listen on")
+    cmd_parser.add_argument("--port", type=int, default=8080,
+                            help="Port to listen on; 0 picks a free port")
+    cmd_parser.add_argument("--records", type=int, default=1000,
+                            help="Number of filler records in the account")
+    cmd_parser.add_argument("--zones", type=int, default=100,
+                            help="Number of domains the filler records are spread over")
+    cmd_parser.add_argument("--latency", type=float, default=0.0,
+                            help="Mean added latency per request, in seconds")
+    cmd_parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="Fraction of requests that fail")
+    cmd_parser.add_argument("--unavailable-rate", type=float, default=0.0,
+                            help="Fraction of requests answered with HTTP 503")
+    cmd_parser.add_argument("--dns-port", type=int, default=None,
+                            help="Also serve the A/AAAA records as a nameserver on this port (UDP and TCP); 0 picks a free port")
+    cmd_parser.add_argument("--propagation-delay", type=float, default=0.0,
+                            help="Seconds before the nameserver serves a change")
+    args = cmd_parser.parse_args(argv)
+
+    account = mock_account(args.records, args.zones)
+    server = mock_dreamhost((args.address, args.port), account,
+                            args.latency, args.error_rate,
+                            args.unavailable_rate)
+    print(server.api_url, flush=True)
+    if args.dns_port is not None:
+        nameserver = mock_dns((args.address, args.dns_port), account,
+                              args.propagation_delay)
+        nameserver.start()
+        print(nameserver.nameserver, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 et
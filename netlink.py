@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Watches for kernel address changes using rtnetlink (Linux only).
+
+Rather than polling the interfaces every update_interval, we subscribe to
+the RTM_NEWADDR/RTM_DELADDR multicast groups, and wake up when an address is
+added to, or removed from, one of the configured interfaces. While nothing
+changes, we're blocked in select() and use no CPU.
+
+dump_addresses() lists every address on the system, with the flags
+(temporary, deprecated, ...) netifaces doesn't report, in a single request.
+
+See rtnetlink(7) and netlink(7) for the message formats.
+"""
+
+import logging
+import select
+import socket
+import struct
+import time
+
+# From linux/rtnetlink.h
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+# Address attributes
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+# Address flags
+IFA_F_TEMPORARY = 0x01
+IFA_F_DADFAILED = 0x08
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+
+# struct nlmsghdr:  length, type, flags, sequence number, port id
+NLMSGHDR = struct.Struct("=LHHLL")
+# struct ifaddrmsg:  family, prefix length, flags, scope, interface index
+IFADDRMSG = struct.Struct("=BBBBI")
+# struct rtattr:  length, type
+RTATTR = struct.Struct("=HH")
+
+# Families we care about, keyed by the configuration name
+FAMILIES = {"AF_INET": socket.AF_INET, "AF_INET6": socket.AF_INET6}
+
+def parse_messages(data):
+    """Parse a buffer of netlink messages, returning a list of
+    (message type, address family, interface index) tuples for address
+    messages"""
+    messages = []
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        msg_len, msg_type, flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+        if msg_len < NLMSGHDR.size:
+            break
+        if msg_type in (RTM_NEWADDR, RTM_DELADDR) and \
+           msg_len >= NLMSGHDR.size + IFADDRMSG.size:
+            family, prefixlen, ifa_flags, scope, index = \
+                IFADDRMSG.unpack_from(data, offset + NLMSGHDR.size)
+            messages.append((msg_type, family, index))
+        # Messages are aligned to 4 bytes
+        offset += (msg_len + 3) & ~3
+    return messages
+
+def parse_attributes(data, offset, end):
+    """Parse the rtattrs between offset and end into a dict of type -> data"""
+    attributes = {}
+    while offset + RTATTR.size <= end:
+        attr_len, attr_type = RTATTR.unpack_from(data, offset)
+        if attr_len < RTATTR.size:
+            break
+        attributes[attr_type] = data[offset + RTATTR.size:offset + attr_len]
+        offset += (attr_len + 3) & ~3
+    return attributes
+
+def parse_address(data, offset, msg_len):
+    """Parse an RTM_NEWADDR message at offset into a tuple of (interface
+    index, family, address, prefix length, flags)"""
+    family, prefixlen, ifa_flags, scope, index = \
+        IFADDRMSG.unpack_from(data, offset + NLMSGHDR.size)
+    attributes = parse_attributes(data, offset + NLMSGHDR.size + IFADDRMSG.size,
+                                  offset + msg_len)
+    # For IPv4, IFA_LOCAL is our address (IFA_ADDRESS is the peer's, on a
+    # point-to-point link); IPv6 only has IFA_ADDRESS.
+    raw_address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+    if raw_address is None:
+        return None
+    # The 8 bit ifa_flags can't hold the newer flags; IFA_FLAGS can.
+    if IFA_FLAGS in attributes and len(attributes[IFA_FLAGS]) >= 4:
+        ifa_flags = struct.unpack_from("=I", attributes[IFA_FLAGS])[0]
+    return (index, family, socket.inet_ntop(family, raw_address), prefixlen,
+            ifa_flags)
+
+def dump_addresses():
+    """List every address on the system. Returns a list of (interface name,
+    family, address, prefix length, flags) tuples. Raises OSError (or
+    AttributeError on non-Linux systems) if netlink isn't available."""
+    names = dict(socket.if_nameindex())
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        seq = int(time.time()) & 0xffffffff
+        request = NLMSGHDR.pack(NLMSGHDR.size + IFADDRMSG.size, RTM_GETADDR,
+                                NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + \
+                  IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        sock.send(request)
+        addresses = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                msg_len, msg_type, flags, msg_seq, pid = \
+                    NLMSGHDR.unpack_from(data, offset)
+                if msg_len < NLMSGHDR.size:
+                    return addresses
+                if msg_type == NLMSG_DONE:
+                    return addresses
+                if msg_type == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", data, offset + NLMSGHDR.size)[0]
+                    raise OSError(-error, "Netlink address dump failed")
+                if msg_type == RTM_NEWADDR and msg_seq == seq:
+                    address = parse_address(data, offset, msg_len)
+                    if address is not None and address[0] in names:
+                        addresses.append((names[address[0]],) + address[1:])
+                offset += (msg_len + 3) & ~3
+    finally:
+        sock.close()
+
+class netlink_watcher():
+
+    def __init__(self, configured_interfaces, settle_time=0.2):
+        """Subscribe to address change events for the configured interfaces.
+        Raises OSError (or AttributeError on non-Linux systems) if netlink
+        isn't available."""
+        self.watch(configured_interfaces)
+        # Address changes usually come in bursts (ie. a new prefix removes
+        # and adds several addresses); wait this long for the burst to end.
+        self.settle_time = settle_time
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  socket.NETLINK_ROUTE)
+        self.sock.setblocking(False)
+        self.sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        # interrupt() writes to this pair to end a wait() early
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.interrupted = False
+
+    def watch(self, configured_interfaces):
+        """Change the interfaces we're watching"""
+        # (family, interface name) pairs we want to hear about; the external
+        # "-ipify.org" lookup can't be watched, it relies on the poll timeout.
+        self.watched = set()
+        for addr_type, interface in configured_interfaces.items():
+            if addr_type in FAMILIES and interface != "-ipify.org":
+                self.watched.add((FAMILIES[addr_type], interface))
+
+    def interrupt(self):
+        """End the current (or next) wait() straight away; safe to call
+        from a signal handler"""
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            # Already interrupted
+            pass
+
+    def relevant(self, messages):
+        """Is any message about one of our watched interfaces?"""
+        for msg_type, family, index in messages:
+            try:
+                name = socket.if_indextoname(index)
+            except OSError:
+                # The interface has already gone away
+                continue
+            if (family, name) in self.watched:
+                logging.debug("%s for %s on interface %s",
+                              "RTM_NEWADDR" if msg_type == RTM_NEWADDR
+                              else "RTM_DELADDR", family, name)
+                return True
+        return False
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds for netlink messages; returns True if a
+        message for a watched interface arrived"""
+        readable, writable, errored = select.select([self.sock, self.wake_reader],
+                                                    [], [], timeout)
+        if self.wake_reader in readable:
+            try:
+                while self.wake_reader.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+            self.interrupted = True
+        if self.sock not in readable:
+            return False
+        changed = False
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as error:
+                # ENOBUFS: the kernel dropped messages; assume a change.
+                logging.warning("Netlink receive error: %s", error)
+                changed = True
+                break
+            if self.relevant(parse_messages(data)):
+                changed = True
+        return changed
+
+    def wait(self, timeout):
+        """Block until an address on a watched interface changes, or until
+        timeout seconds have passed, or interrupt() is called. Returns True
+        if a change was seen."""
+        deadline = time.monotonic() + timeout
+        self.interrupted = False
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.read_events(remaining):
+                # Let the rest of the burst arrive before we act on it.
+                while self.read_events(self.settle_time):
+                    pass
+                return True
+            if self.interrupted:
+                return False
+
+    def close(self):
+        self.sock.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+# vim: ts=4 sw=4 et
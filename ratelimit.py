@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+"""
+Token bucket rate limiting for DreamHost API requests.
+
+DreamHost limits the rate of API requests per key; exceeding it gets the
+key throttled for every host using it. Every request made with an api_key
+takes a token from that key's bucket, which is shared by every dhdns object
+and thread in the process. Tokens are added at a steady rate, up to a
+burst; when the bucket is empty, the request waits.
+"""
+
+import logging
+import threading
+import time
+
+import dhsystemd
+
+# The longest single sleep while waiting for a token, so the systemd
+# watchdog hears from us during a long wait
+MAX_SLEEP = 1.0
+
+# One bucket per api_key
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+class token_bucket():
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        """rate is in tokens per second; burst is the most tokens that can
+        be saved up. clock and sleep are replaced by the tests."""
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty. Returns the
+        time spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            wait = min(wait, MAX_SLEEP)
+            self.sleep(wait)
+            waited += wait
+            dhsystemd.alive()
+
+def get_bucket(api_key, rate, burst):
+    """The shared bucket for api_key; rate is in requests per second. Returns
+    None if rate is 0 (no limit)."""
+    if not rate:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(api_key)
+        if bucket is None:
+            bucket = _buckets[api_key] = token_bucket(rate, burst)
+        return bucket
+
+def forget():
+    """Drop every bucket, ie. when the limits change"""
+    with _buckets_lock:
+        _buckets.clear()
+
+def acquire(api_key, rate, burst):
+    """Take a token from api_key's bucket"""
+    bucket = get_bucket(api_key, rate, burst)
+    if bucket is None:
+        return
+    waited = bucket.acquire()
+    if waited:
+        logging.info("Rate limited; waited %.2fs for an API request", waited)
+
+# vim: ts=4 sw=4 et
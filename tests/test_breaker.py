@@ -0,0 +1,109 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for the DreamHost API circuit breaker (breaker)"""
+
+import unittest
+
+import breaker
+
+class circuit_breaker_tests(unittest.TestCase):
+
+    def test_opens_at_threshold(self):
+        circuit = breaker.circuit_breaker("test", 3, 60.0)
+        for failure in range(2):
+            circuit.failure()
+            self.assertEqual(circuit.state, breaker.CLOSED)
+            self.assertTrue(circuit.allow())
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        self.assertFalse(circuit.allow())
+        self.assertGreater(circuit.remaining(), 0.0)
+
+    def test_success_resets_count(self):
+        circuit = breaker.circuit_breaker("test", 2, 60.0)
+        circuit.failure()
+        circuit.success()
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+    def test_no_threshold(self):
+        circuit = breaker.circuit_breaker("test", 0, 60.0)
+        for failure in range(100):
+            circuit.failure()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+    def test_half_open_probe(self):
+        circuit = breaker.circuit_breaker("test", 1, 0.0)
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        # Only one probe at a time
+        self.assertTrue(circuit.allow())
+        self.assertEqual(circuit.state, breaker.HALF_OPEN)
+        self.assertFalse(circuit.allow())
+        circuit.success()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+        self.assertTrue(circuit.allow())
+
+    def test_failed_probe_reopens(self):
+        circuit = breaker.circuit_breaker("test", 3, 0.0)
+        for failure in range(3):
+            circuit.failure()
+        self.assertTrue(circuit.allow())
+        self.assertEqual(circuit.state, breaker.HALF_OPEN)
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+
+    def test_released_probe(self):
+        circuit = breaker.circuit_breaker("test", 1, 0.0)
+        circuit.failure()
+        failures = circuit.failures
+        self.assertTrue(circuit.allow())
+        circuit.release()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        self.assertEqual(circuit.failures, failures)
+        # Another probe may go straight away
+        self.assertTrue(circuit.allow())
+
+    def test_release_when_closed(self):
+        circuit = breaker.circuit_breaker("test", 1, 60.0)
+        circuit.release()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+        self.assertEqual(circuit.failures, 0)
+
+    def test_shared_per_endpoint(self):
+        first = breaker.get_breaker("http://one.example/", 5, 60.0)
+        self.assertIs(breaker.get_breaker("http://one.example/", 2, 30.0), first)
+        self.assertEqual((first.threshold, first.reset_timeout), (2, 30.0))
+        self.assertIsNot(breaker.get_breaker("http://two.example/", 5, 60.0), first)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
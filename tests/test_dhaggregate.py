@@ -0,0 +1,91 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for parsing and storing agents' reports (dhaggregate)"""
+
+import ipaddress
+import unittest
+
+import dhaggregate
+
+ADDRESSES = [ipaddress.ip_address("192.0.2.1"), ipaddress.ip_address("2001:db8::1")]
+
+class parse_report_tests(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = dhaggregate.encode_report("host.example.com", ADDRESSES)
+        self.assertEqual(dhaggregate.parse_report(data),
+                         ("host.example.com", ADDRESSES))
+
+    def test_token(self):
+        data = dhaggregate.encode_report("host.example.com", ADDRESSES, "secret")
+        self.assertEqual(dhaggregate.parse_report(data, "secret"),
+                         ("host.example.com", ADDRESSES))
+        with self.assertRaises(ValueError):
+            dhaggregate.parse_report(data, "other")
+        with self.assertRaises(ValueError):
+            dhaggregate.parse_report(dhaggregate.encode_report("host.example.com",
+                                                               ADDRESSES), "secret")
+
+    def test_no_addresses(self):
+        data = dhaggregate.encode_report("host.example.com", [])
+        self.assertEqual(dhaggregate.parse_report(data), ("host.example.com", []))
+
+    def test_malformed(self):
+        for data in (b"", b"not json", b"\xff\xfe", b"[]", b"{}",
+                     b'{"hostname": "host.example.com"}',
+                     b'{"hostname": 7, "addresses": []}',
+                     b'{"hostname": "host.example.com", "addresses": "192.0.2.1"}',
+                     b'{"hostname": "host.example.com", "addresses": ["192.0.2.300"]}',
+                     b'{"hostname": "host.example.com", "addresses": [7]}'):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    dhaggregate.parse_report(data)
+
+class report_store_tests(unittest.TestCase):
+
+    def test_latest(self):
+        store = dhaggregate.report_store(["a.example.com", "b.example.com"])
+        self.assertTrue(store.add(dhaggregate.encode_report("a.example.com", ADDRESSES)))
+        self.assertTrue(store.add(dhaggregate.encode_report("a.example.com", ADDRESSES[:1])))
+        self.assertEqual(store.latest(), {"a.example.com": ADDRESSES[:1]})
+
+    def test_refused(self):
+        store = dhaggregate.report_store(["a.example.com"], "secret")
+        with self.assertLogs(level="WARNING"):
+            self.assertFalse(store.add(dhaggregate.encode_report("c.example.com",
+                                                                 ADDRESSES, "secret")))
+            self.assertFalse(store.add(dhaggregate.encode_report("a.example.com", ADDRESSES)))
+            self.assertFalse(store.add(b"garbage"))
+        self.assertEqual(store.latest(), {})
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,92 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for one-shot and hook runs of dhdynupdate.py, against the file
+provider"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "dhdynupdate.py")
+
+CONFIG = """[Global]
+api_url = http://127.0.0.1:9/
+provider = file
+provider_file = %(directory)s/records.json
+AF_INET = lo
+AF_INET6 =
+log_file = %(directory)s/dhdynupdate.log
+update_interval = 3600
+pidfile = %(directory)s/dhdynupdate.pid
+state_file = %(directory)s/state.json
+debounce_interval = 30
+
+[host]
+api_key = key
+local_hostname = host.example.com
+"""
+
+class one_shot_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.directory.name, "dhdynupdate.conf")
+        with open(self.config_path, "w") as config_file:
+            config_file.write(CONFIG % {"directory": self.directory.name})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_hook(self, address):
+        subprocess.run([sys.executable, SCRIPT, "-f", self.config_path, "-c", "host",
+                        "--address", address],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def published(self):
+        with open(os.path.join(self.directory.name, "records.json")) as records_file:
+            return sorted(entry["value"] for entry in json.load(records_file)["records"]
+                          if entry["record"] == "host.example.com")
+
+    def test_hook_publishes_despite_debounce(self):
+        self.run_hook("192.0.2.3")
+        self.assertEqual(self.published(), ["192.0.2.3"])
+        # The state file now exists; a second run mustn't hold the change
+        # back for a debounce interval it won't live to see
+        self.run_hook("192.0.2.4")
+        self.assertEqual(self.published(), ["192.0.2.4"])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,129 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for the address history file format (dhhistory)"""
+
+import ipaddress
+import os
+import tempfile
+import unittest
+
+import dhhistory
+
+V4 = ipaddress.ip_address("192.0.2.1")
+V6 = ipaddress.ip_address("2001:db8::1")
+
+class history_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "history")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, records):
+        history = dhhistory.dhhistory(self.path)
+        history.append(records)
+        history.close()
+
+    def test_format(self):
+        self.assertEqual(dhhistory.RECORD.size, 32)
+        self.write([(1000.0, "a.example.com", dhhistory.DETECTED, V4),
+                    (1000.0, "b.example.com", dhhistory.ADDED, V6)])
+        with open(self.path, 'rb') as history_file:
+            data = history_file.read()
+        self.assertEqual(data[:len(dhhistory.MAGIC)], dhhistory.MAGIC)
+        self.assertEqual(len(data), len(dhhistory.MAGIC) + 2 * dhhistory.RECORD.size)
+        self.assertEqual(dhhistory.RECORD.unpack_from(data, len(dhhistory.MAGIC)),
+                         (1000.0, 0, dhhistory.DETECTED, 4, V4.packed + bytes(12)))
+        with open(dhhistory.names_path(self.path), 'r') as names_file:
+            self.assertEqual(names_file.read(), "a.example.com\nb.example.com\n")
+
+    def test_round_trip(self):
+        self.write([(1000.0, "a.example.com", dhhistory.DETECTED, V4),
+                    (1000.0, "a.example.com", dhhistory.LOST, 6),
+                    (1001.0, "a.example.com", dhhistory.FAILED, V6)])
+        self.assertEqual(list(dhhistory.read(self.path)),
+                         [dhhistory.entry(1000.0, "a.example.com", dhhistory.DETECTED, 4, V4),
+                          dhhistory.entry(1000.0, "a.example.com", dhhistory.LOST, 6, None),
+                          dhhistory.entry(1001.0, "a.example.com", dhhistory.FAILED, 6, V6)])
+
+    def test_names_kept_across_opens(self):
+        self.write([(1000.0, "a.example.com", dhhistory.DETECTED, V4)])
+        self.write([(1001.0, "b.example.com", dhhistory.DETECTED, V4),
+                    (1002.0, "a.example.com", dhhistory.DETECTED, V6)])
+        self.assertEqual([(history_entry.hostname, history_entry.address)
+                          for history_entry in dhhistory.read(self.path)],
+                         [("a.example.com", V4), ("b.example.com", V4),
+                          ("a.example.com", V6)])
+
+    def test_time_range_and_hostname(self):
+        self.write([(float(timestamp), "a.example.com" if timestamp % 2 else "b.example.com",
+                     dhhistory.DETECTED, V4) for timestamp in range(100)])
+        selected = list(dhhistory.read(self.path, since=10, until=20,
+                                       hostname="a.example.com"))
+        self.assertEqual([history_entry.timestamp for history_entry in selected],
+                         [11.0, 13.0, 15.0, 17.0, 19.0])
+        self.assertEqual(list(dhhistory.read(self.path, hostname="c.example.com")), [])
+        self.assertEqual(list(dhhistory.read(self.path, since=1000)), [])
+
+    def test_damaged_record_dropped(self):
+        self.write([(1000.0, "a.example.com", dhhistory.DETECTED, V4)])
+        with open(self.path, 'ab') as history_file:
+            history_file.write(b"\1" * 10)
+        with self.assertLogs(level="WARNING"):
+            self.write([(1001.0, "a.example.com", dhhistory.DETECTED, V6)])
+        self.assertEqual([history_entry.address
+                          for history_entry in dhhistory.read(self.path)], [V4, V6])
+
+    def test_not_a_history_file(self):
+        with open(self.path, 'wb') as history_file:
+            history_file.write(b"something else")
+        with self.assertRaises(ValueError):
+            dhhistory.dhhistory(self.path)
+        with self.assertRaises(ValueError):
+            list(dhhistory.read(self.path))
+
+    def test_outages(self):
+        history = dhhistory.dhhistory(self.path)
+        history.append([(1000.0, "a.example.com", dhhistory.DETECTED, V4),
+                        (1000.0, "a.example.com", dhhistory.LOST, 6),
+                        (1060.0, "a.example.com", dhhistory.DETECTED, V4),
+                        (1060.0, "a.example.com", dhhistory.DETECTED, V6)])
+        history.close()
+        self.assertEqual(dhhistory.outages(dhhistory.read(self.path)),
+                         [("a.example.com", 6, 1000.0, 1060.0)])
+        self.assertEqual(dhhistory.counts(dhhistory.read(self.path))["a.example.com"]["changes"],
+                         2)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,106 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for dhjournal, and resuming an interrupted update from it"""
+
+import os
+import tempfile
+import unittest
+
+import dhjournal
+import dhplan
+import dhprovider
+from dhfleet import dhfleet
+
+HOSTNAME = "host.example.com"
+ADD = dhplan.dns_operation(dhplan.ADD, HOSTNAME, "A", "192.0.2.2")
+REMOVE = dhplan.dns_operation(dhplan.REMOVE, HOSTNAME, "A", "192.0.2.1")
+
+class journal_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_unfinished(self):
+        journal = dhjournal.dhjournal(self.path)
+        journal.begin(HOSTNAME, ["192.0.2.2"], [ADD, REMOVE])
+        journal.done(HOSTNAME, ADD)
+        self.assertEqual(dhjournal.dhjournal(self.path).unfinished(),
+                         {HOSTNAME: (["192.0.2.2"], [ADD, REMOVE], {ADD})})
+
+    def test_cleared(self):
+        journal = dhjournal.dhjournal(self.path)
+        journal.begin(HOSTNAME, ["192.0.2.2"], [ADD, REMOVE])
+        journal.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(dhjournal.dhjournal(self.path).unfinished(), {})
+
+    def test_damaged_last_line(self):
+        journal = dhjournal.dhjournal(self.path)
+        journal.begin(HOSTNAME, ["192.0.2.2"], [ADD, REMOVE])
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"hostname": "host.exa')
+        with self.assertLogs(level="WARNING"):
+            unfinished = dhjournal.dhjournal(self.path).unfinished()
+        self.assertEqual(unfinished, {HOSTNAME: (["192.0.2.2"], [ADD, REMOVE], set())})
+
+    def test_unwritable(self):
+        journal = dhjournal.dhjournal(os.path.join(self.path, "missing", "journal"))
+        with self.assertLogs(level="ERROR"):
+            journal.begin(HOSTNAME, ["192.0.2.2"], [ADD, REMOVE])
+        self.assertTrue(journal.disabled)
+        journal.done(HOSTNAME, ADD)
+
+    def test_resume(self):
+        # Interrupted after the add, before the remove
+        journal = dhjournal.dhjournal(self.path)
+        journal.begin(HOSTNAME, ["192.0.2.2"], [ADD, REMOVE])
+        journal.done(HOSTNAME, ADD)
+        provider = dhprovider.memory(records=[
+            {"record": HOSTNAME, "type": "A", "value": "192.0.2.1", "editable": "1"},
+            {"record": HOSTNAME, "type": "A", "value": "192.0.2.2", "editable": "1"}])
+        fleet = dhfleet("", [("key", HOSTNAME)], {}, max_concurrency=1,
+                        journal=dhjournal.dhjournal(self.path), provider=provider)
+        fleet.resume()
+        self.assertEqual([entry["value"] for entry in provider.list_records("key", [HOSTNAME])],
+                         ["192.0.2.2"])
+        host = fleet.hosts[0]
+        self.assertEqual([str(address) for address in host.prev_addresses], ["192.0.2.2"])
+        # Only part of the records are known, so they're listed next time
+        self.assertIsNone(host.last_reconcile)
+        self.assertFalse(os.path.exists(self.path))
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,102 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for dhplan"""
+
+import ipaddress
+import unittest
+
+import dhplan
+
+def entry(record, rtype, value, editable="1"):
+    return {"record": record, "type": rtype, "value": value, "editable": editable}
+
+def addresses(*values):
+    return [ipaddress.ip_address(value) for value in values]
+
+class plan_hostname_tests(unittest.TestCase):
+
+    def plan(self, wanted, entries):
+        plan = dhplan.dhplan()
+        plan.plan_hostname("host.example.com", wanted, dhplan.index_records(entries))
+        return plan.operations
+
+    def test_new_hostname(self):
+        self.assertEqual(self.plan(addresses("192.0.2.1", "2001:db8::1"), []),
+                         [dhplan.dns_operation(dhplan.ADD, "host.example.com", "A", "192.0.2.1"),
+                          dhplan.dns_operation(dhplan.ADD, "host.example.com", "AAAA", "2001:db8::1")])
+
+    def test_unchanged(self):
+        self.assertEqual(self.plan(addresses("192.0.2.1"),
+                                   [entry("host.example.com", "A", "192.0.2.1")]), [])
+
+    def test_changed_adds_before_removing(self):
+        self.assertEqual(self.plan(addresses("192.0.2.2"),
+                                   [entry("host.example.com", "A", "192.0.2.1")]),
+                         [dhplan.dns_operation(dhplan.ADD, "host.example.com", "A", "192.0.2.2"),
+                          dhplan.dns_operation(dhplan.REMOVE, "host.example.com", "A", "192.0.2.1")])
+
+    def test_ipv6_formatting(self):
+        # DreamHost may spell an address differently; it's still the same one
+        self.assertEqual(self.plan(addresses("2001:db8::1"),
+                                   [entry("host.example.com", "AAAA", "2001:0db8:0:0::1")]),
+                         [])
+
+    def test_missing_family_left_alone(self):
+        # An IPv4-only address set mustn't withdraw the AAAA records
+        self.assertEqual(self.plan(addresses("192.0.2.1"),
+                                   [entry("host.example.com", "A", "192.0.2.1"),
+                                    entry("host.example.com", "AAAA", "2001:db8::1")]),
+                         [])
+
+    def test_no_addresses(self):
+        self.assertEqual(self.plan([], [entry("host.example.com", "A", "192.0.2.1")]), [])
+
+    def test_read_only(self):
+        self.assertEqual(self.plan(addresses("192.0.2.2"),
+                                   [entry("host.example.com", "A", "192.0.2.1", "0")]), [])
+
+    def test_other_hostnames(self):
+        self.assertEqual(self.plan(addresses("192.0.2.1"),
+                                   [entry("other.example.com", "A", "192.0.2.9"),
+                                    entry("host.example.com", "A", "192.0.2.1")]), [])
+
+    def test_by_record(self):
+        plan = dhplan.dhplan()
+        plan.plan_hostname("host.example.com", addresses("192.0.2.2", "2001:db8::2"),
+                           dhplan.index_records([entry("host.example.com", "A", "192.0.2.1")]))
+        self.assertEqual([(key, [operation.action for operation in operations])
+                          for key, operations in plan.by_record().items()],
+                         [(("host.example.com", "A"), [dhplan.ADD, dhplan.REMOVE]),
+                          (("host.example.com", "AAAA"), [dhplan.ADD])])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
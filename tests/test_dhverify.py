@@ -0,0 +1,215 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for dhverify: parsing DNS responses, and waiting for the stub
+nameserver in mock_dreamhost to serve an update"""
+
+import ipaddress
+import socketserver
+import struct
+import unittest
+
+import dhverify
+import mock_dreamhost
+
+HOSTNAME = "host.example.com"
+QUERY_ID = 0x1234
+
+def response(answers, flags=0x8400, query_id=QUERY_ID, rtype="A"):
+    """A response to build_query(query_id, HOSTNAME, rtype), with answers
+    (a list of (name, type, rdata)) after the question"""
+    query = dhverify.build_query(query_id, HOSTNAME, rtype)
+    message = struct.pack("!HHHHHH", query_id, flags, 1, len(answers), 0, 0)
+    message += query[12:]
+    for name, qtype, rdata in answers:
+        message += name + struct.pack("!HHIH", qtype, 1, 60, len(rdata)) + rdata
+    return message
+
+# A pointer to the name in the question
+POINTER = b"\xc0\x0c"
+
+class parse_response_tests(unittest.TestCase):
+
+    def test_compressed_name(self):
+        message = response([(POINTER, 1, bytes([192, 0, 2, 1])),
+                            (POINTER, 1, bytes([192, 0, 2, 2]))])
+        self.assertEqual(dhverify.parse_response(message, QUERY_ID, "A"),
+                         {ipaddress.ip_address("192.0.2.1"),
+                          ipaddress.ip_address("192.0.2.2")})
+
+    def test_partly_compressed_name(self):
+        # "www" followed by a pointer to "example.com" in the question
+        name = b"\x03www\xc0\x11"
+        message = response([(name, 1, bytes([192, 0, 2, 1]))])
+        self.assertEqual(dhverify.parse_response(message, QUERY_ID, "A"),
+                         {ipaddress.ip_address("192.0.2.1")})
+
+    def test_uncompressed_name(self):
+        name = b"\x04host\x07example\x03com\x00"
+        message = response([(name, 1, bytes([192, 0, 2, 1]))])
+        self.assertEqual(dhverify.parse_response(message, QUERY_ID, "A"),
+                         {ipaddress.ip_address("192.0.2.1")})
+
+    def test_aaaa(self):
+        address = ipaddress.ip_address("2001:db8::1")
+        message = response([(POINTER, 28, address.packed)], rtype="AAAA")
+        self.assertEqual(dhverify.parse_response(message, QUERY_ID, "AAAA"), {address})
+
+    def test_other_types_skipped(self):
+        # A CNAME, then the A record it points to
+        cname = b"\x05other\xc0\x11"
+        message = response([(POINTER, 5, cname), (cname, 1, bytes([192, 0, 2, 1]))])
+        self.assertEqual(dhverify.parse_response(message, QUERY_ID, "A"),
+                         {ipaddress.ip_address("192.0.2.1")})
+
+    def test_no_answers(self):
+        self.assertEqual(dhverify.parse_response(response([]), QUERY_ID, "A"), set())
+
+    def test_nxdomain(self):
+        message = response([], flags=0x8400 | dhverify.RCODE_NXDOMAIN)
+        self.assertEqual(dhverify.parse_response(message, QUERY_ID, "A"), set())
+
+    def test_server_failure(self):
+        with self.assertRaises(ValueError):
+            dhverify.parse_response(response([], flags=0x8402), QUERY_ID, "A")
+
+    def test_truncated_flag(self):
+        message = response([], flags=0x8400 | dhverify.FLAG_TC)
+        self.assertIsNone(dhverify.parse_response(message, QUERY_ID, "A"))
+
+    def test_cut_short(self):
+        message = response([(POINTER, 1, bytes([192, 0, 2, 1]))])
+        for end in range(len(message)):
+            with self.subTest(end=end):
+                with self.assertRaises(ValueError):
+                    dhverify.parse_response(message[:end], QUERY_ID, "A")
+
+    def test_not_our_response(self):
+        with self.assertRaises(ValueError):
+            dhverify.parse_response(response([], query_id=QUERY_ID + 1), QUERY_ID, "A")
+        with self.assertRaises(ValueError):
+            # A query, not a response
+            dhverify.parse_response(dhverify.build_query(QUERY_ID, HOSTNAME, "A"),
+                                    QUERY_ID, "A")
+
+class truncating_dns(mock_dreamhost.mock_dns):
+    """A stub nameserver whose UDP answers are all truncated"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        stub = self
+
+        class _truncating_handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                answer = bytearray(stub.answer(data)[:12])
+                struct.pack_into("!HHHH", answer, 4, 0, 0, 0, 0)
+                answer[2] |= dhverify.FLAG_TC >> 8
+                sock.sendto(bytes(answer), self.client_address)
+
+        self.udp_server.RequestHandlerClass = _truncating_handler
+
+class nameserver_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.account = mock_dreamhost.mock_account()
+        self.account.add(HOSTNAME, "A", "192.0.2.1")
+        self.account.add(HOSTNAME, "AAAA", "2001:db8::1")
+        self.stubs = []
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.close()
+
+    def stub(self, stub_class=mock_dreamhost.mock_dns, **kwargs):
+        stub = stub_class(account=self.account, **kwargs)
+        stub.start()
+        self.stubs.append(stub)
+        return stub.nameserver
+
+    def test_query(self):
+        nameserver = self.stub()
+        for protocol in ("udp", "tcp"):
+            with self.subTest(protocol=protocol):
+                self.assertEqual(dhverify.query(nameserver, HOSTNAME, "A",
+                                                protocol=protocol),
+                                 {ipaddress.ip_address("192.0.2.1")})
+                self.assertEqual(dhverify.query(nameserver, HOSTNAME, "AAAA",
+                                                protocol=protocol),
+                                 {ipaddress.ip_address("2001:db8::1")})
+                self.assertEqual(dhverify.query(nameserver, "other.example.com", "A",
+                                                protocol=protocol),
+                                 set())
+
+    def test_truncated_retried_over_tcp(self):
+        nameserver = self.stub(truncating_dns)
+        self.assertEqual(dhverify.query(nameserver, HOSTNAME, "A"),
+                         {ipaddress.ip_address("192.0.2.1")})
+        self.assertEqual(self.stubs[0].queries, 2)
+
+    def verifier(self, nameservers, **kwargs):
+        checker = dhverify.verifier(nameservers, timeout=1.0, first_delay=0.05,
+                                    max_delay=0.1, **kwargs)
+        self.addCleanup(checker.shutdown)
+        return checker
+
+    def test_verified(self):
+        checker = self.verifier([self.stub(), self.stub()])
+        addresses = [ipaddress.ip_address("192.0.2.1"),
+                     ipaddress.ip_address("2001:db8::1")]
+        self.assertIsNotNone(checker.submit(HOSTNAME, addresses).result())
+
+    def test_waits_for_every_nameserver(self):
+        fast = self.stub()
+        slow = self.stub(propagation_delay=0.3)
+        self.account.remove(HOSTNAME, "A", "192.0.2.1")
+        self.account.add(HOSTNAME, "A", "192.0.2.2")
+        checker = self.verifier([fast, slow])
+        addresses = [ipaddress.ip_address("192.0.2.2"),
+                     ipaddress.ip_address("2001:db8::1")]
+        elapsed = checker.submit(HOSTNAME, addresses).result()
+        self.assertGreaterEqual(elapsed, 0.3)
+        # The fast nameserver agreed at once, and wasn't asked again
+        self.assertEqual(self.stubs[0].queries, 2)
+        self.assertGreater(self.stubs[1].queries, 2)
+
+    def test_gives_up(self):
+        checker = self.verifier([self.stub()], max_wait=0.3)
+        addresses = [ipaddress.ip_address("192.0.2.9")]
+        self.assertIsNone(checker.submit(HOSTNAME, addresses).result())
+
+    def test_unreachable_nameserver(self):
+        checker = self.verifier(["127.0.0.1:9"], max_wait=0.2, protocol="tcp")
+        addresses = [ipaddress.ip_address("192.0.2.1")]
+        self.assertIsNone(checker.submit(HOSTNAME, addresses).result())
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,232 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for http_access: parsing streamed responses, and retries, the
+deadline and the circuit breaker, against mock_dreamhost"""
+
+import json
+import time
+import unittest
+
+import breaker
+import http_access
+import mock_dreamhost
+
+# No backoff, so the tests don't sleep
+POLICY = http_access.retry_policy(connect_timeout=5.0, read_timeout=5.0,
+                                  retries=3, backoff=0.0, max_backoff=0.0,
+                                  breaker_threshold=2, breaker_reset=60.0,
+                                  deadline=30.0)
+
+def list_records():
+    return {"key": "testkey", "cmd": "dns-list_records", "format": "json"}
+
+# Strings with escapes, and numbers, to be split across chunks
+LISTING = """{"result": "success", "data": [
+    {"record": "host.example.com", "type": "A", "value": "192.0.2.1",
+     "comment": "say \\"hi\\" \\\\ caf\\u00e9 \\ud83d\\ude00", "ttl": 14400},
+    {"record": "other.example.com", "type": "TXT", "value": "x,]}",
+     "comment": "", "ttl": -1.5e3},
+    {"record": "host.example.com", "type": "AAAA", "value": "2001:db8::1",
+     "comment": "", "ttl": 123456789}
+]}"""
+
+def keep_host(item):
+    return item["record"] == "host.example.com"
+
+def chunked(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+class parse_json_stream_tests(unittest.TestCase):
+
+    def expected(self, text, keep):
+        document = json.loads(text)
+        if isinstance(document.get("data"), list):
+            document["data"] = [item for item in document["data"] if keep(item)]
+        return document
+
+    def test_whole(self):
+        self.assertEqual(http_access.parse_json_stream([LISTING], keep_host),
+                         self.expected(LISTING, keep_host))
+        self.assertEqual(len(self.expected(LISTING, keep_host)["data"]), 2)
+
+    def test_split_anywhere(self):
+        expected = self.expected(LISTING, keep_host)
+        for split in range(1, len(LISTING)):
+            with self.subTest(split=split):
+                chunks = [LISTING[:split], LISTING[split:]]
+                self.assertEqual(http_access.parse_json_stream(chunks, keep_host),
+                                 expected)
+
+    def test_small_chunks(self):
+        expected = self.expected(LISTING, keep_host)
+        for size in (1, 2, 3, 7):
+            with self.subTest(size=size):
+                self.assertEqual(http_access.parse_json_stream(chunked(LISTING, size),
+                                                               keep_host),
+                                 expected)
+
+    def test_number_at_chunk_end(self):
+        chunks = ['{"data": [1', '23', '4, 5', '], "count": 1', '0}']
+        self.assertEqual(http_access.parse_json_stream(chunks, lambda item: True),
+                         {"data": [1234, 5], "count": 10})
+
+    def test_empty_chunks(self):
+        chunks = ["", '{"data"', "", ": []}", ""]
+        self.assertEqual(http_access.parse_json_stream(chunks, keep_host), {"data": []})
+
+    def test_empty_list(self):
+        for text in ('{"result": "success", "data": []}',
+                     '{ "data" : [ ] , "result" : "success" }'):
+            with self.subTest(text=text):
+                self.assertEqual(http_access.parse_json_stream(chunked(text, 1),
+                                                               keep_host),
+                                 {"result": "success", "data": []})
+
+    def test_empty_object(self):
+        self.assertEqual(http_access.parse_json_stream(["{ }"], keep_host), {})
+
+    def test_error_reply(self):
+        text = '{"result": "error", "data": "no_key"}'
+        self.assertEqual(http_access.parse_json_stream(chunked(text, 3), keep_host),
+                         {"result": "error", "data": "no_key"})
+
+    def test_other_list_key(self):
+        text = '{"data": "x", "items": [{"record": "a"}]}'
+        self.assertEqual(http_access.parse_json_stream([text], keep_host, "items"),
+                         {"data": "x", "items": []})
+
+    def test_truncated(self):
+        for end in range(len(LISTING)):
+            with self.subTest(end=end):
+                with self.assertRaises(ValueError):
+                    http_access.parse_json_stream(chunked(LISTING[:end], 16),
+                                                  keep_host)
+
+    def test_garbled(self):
+        for text in ('["data"]', '{"data": [1 2]}', '{"data" [1]}', '{"data": [1]]'):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    http_access.parse_json_stream([text], lambda item: True)
+
+class http_access_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mock_dreamhost.mock_dreamhost()
+        self.server.start()
+        self.access = http_access.http_access(self.server.api_url, policy=POLICY)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        http_access.close_sessions()
+
+    def attempts(self):
+        return self.server.stats["dns-list_records"]
+
+    def test_success(self):
+        self.assertEqual(self.access.request_get(list_records())["result"], "success")
+        self.assertEqual(self.attempts(), 1)
+        self.assertEqual(self.access.breaker.state, breaker.CLOSED)
+
+    def test_retries(self):
+        self.server.unavailable_rate = 1.0
+        with self.assertRaises(http_access.api_unavailable):
+            self.access.request_get(list_records())
+        self.assertEqual(self.attempts(), POLICY.retries + 1)
+        # All the retries count once
+        self.assertEqual(self.access.breaker.failures, 1)
+        self.assertEqual(self.access.breaker.state, breaker.CLOSED)
+
+    def test_deadline(self):
+        self.server.latency = 2.0
+        self.access.set_retry_policy(POLICY._replace(deadline=0.5))
+        start = time.monotonic()
+        with self.assertRaises(http_access.api_unavailable):
+            self.access.request_get(list_records())
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_breaker(self):
+        self.server.unavailable_rate = 1.0
+        for request in range(POLICY.breaker_threshold):
+            with self.assertRaises(http_access.api_unavailable):
+                self.access.request_get(list_records())
+        self.assertEqual(self.access.breaker.state, breaker.OPEN)
+        # While open, nothing is sent
+        attempts = self.attempts()
+        with self.assertRaises(http_access.api_unavailable):
+            self.access.request_get(list_records())
+        self.assertEqual(self.attempts(), attempts)
+        # Once reset_timeout has passed, a probe gets through
+        self.server.unavailable_rate = 0.0
+        self.access.set_retry_policy(POLICY._replace(breaker_reset=0.0))
+        self.assertEqual(self.access.request_get(list_records())["result"], "success")
+        self.assertEqual(self.access.breaker.state, breaker.CLOSED)
+
+    def test_failed_probe(self):
+        self.server.unavailable_rate = 1.0
+        self.access.set_retry_policy(POLICY._replace(retries=0, breaker_threshold=1,
+                                                     breaker_reset=0.0))
+        with self.assertRaises(http_access.api_unavailable):
+            self.access.request_get(list_records())
+        with self.assertRaises(http_access.api_unavailable):
+            self.access.request_get(list_records())
+        self.assertEqual(self.attempts(), 2)
+        self.assertEqual(self.access.breaker.state, breaker.OPEN)
+
+    def test_other_errors_not_counted(self):
+        def keep(item):
+            raise KeyError("value")
+        self.server.account.add("host.example.com", "A", "192.0.2.1")
+        for request in range(POLICY.breaker_threshold + 1):
+            with self.assertRaises(KeyError):
+                self.access.request_get(list_records(), keep)
+        self.assertEqual(self.access.breaker.failures, 0)
+        self.assertEqual(self.access.breaker.state, breaker.CLOSED)
+
+    def test_other_errors_release_probe(self):
+        def keep(item):
+            raise KeyError("value")
+        self.server.account.add("host.example.com", "A", "192.0.2.1")
+        circuit = self.access.breaker
+        circuit.reset_timeout = 0.0
+        circuit.threshold = 1
+        circuit.failure()
+        self.access.set_retry_policy(POLICY._replace(breaker_threshold=1,
+                                                     breaker_reset=0.0))
+        with self.assertRaises(KeyError):
+            self.access.request_get(list_records(), keep)
+        # The next request is the new probe, and closes the breaker
+        self.assertEqual(self.access.request_get(list_records())["result"], "success")
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et
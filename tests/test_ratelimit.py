@@ -0,0 +1,112 @@
+# Copyright (c) 2016, Troy Telford
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied.
+
+
+"""Tests for the API rate limiter (ratelimit)"""
+
+import unittest
+
+import ratelimit
+
+class fake_clock():
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class token_bucket_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock()
+
+    def bucket(self, rate, burst):
+        return ratelimit.token_bucket(rate, burst, self.clock, self.clock.sleep)
+
+    def test_burst(self):
+        bucket = self.bucket(1.0, 5)
+        self.assertEqual([bucket.acquire() for request in range(5)], [0.0] * 5)
+        self.assertEqual(self.clock.slept, [])
+        self.assertAlmostEqual(bucket.acquire(), 1.0)
+
+    def test_refill_rate(self):
+        bucket = self.bucket(2.0, 1)
+        bucket.acquire()
+        start = self.clock.now
+        for request in range(10):
+            bucket.acquire()
+        # Two requests a second
+        self.assertAlmostEqual(self.clock.now - start, 5.0)
+
+    def test_refill_capped_at_burst(self):
+        bucket = self.bucket(1.0, 3)
+        for request in range(3):
+            bucket.acquire()
+        self.clock.now += 3600
+        self.assertEqual([bucket.acquire() for request in range(3)], [0.0] * 3)
+        self.assertGreater(bucket.acquire(), 0.0)
+
+    def test_long_wait_in_slices(self):
+        bucket = self.bucket(0.125, 1)
+        bucket.acquire()
+        self.assertAlmostEqual(bucket.acquire(), 8.0)
+        self.assertTrue(all(seconds <= ratelimit.MAX_SLEEP for seconds in self.clock.slept))
+
+class bucket_registry_tests(unittest.TestCase):
+
+    def setUp(self):
+        ratelimit.forget()
+
+    def tearDown(self):
+        ratelimit.forget()
+
+    def test_per_api_key(self):
+        first = ratelimit.get_bucket("key1", 1.0, 2)
+        self.assertIs(ratelimit.get_bucket("key1", 1.0, 2), first)
+        second = ratelimit.get_bucket("key2", 1.0, 2)
+        self.assertIsNot(second, first)
+        first.acquire()
+        first.acquire()
+        # key1's bucket is empty; key2's isn't touched
+        self.assertEqual(second.tokens, 2.0)
+        self.assertEqual(second.acquire(), 0.0)
+
+    def test_no_limit(self):
+        self.assertIsNone(ratelimit.get_bucket("key", 0, 1))
+        ratelimit.acquire("key", 0, 1)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: ts=4 sw=4 et